@@ -0,0 +1,29 @@
+"""backfill progress
+
+Revision ID: 2c6e1d8f0a9
+Revises: 4b81bd61b38
+Create Date: 2026-10-18 09:02:11.514208
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = "2c6e1d8f0a9"
+down_revision = "4b81bd61b38"
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    # One row per symbol while a sharded backfill of it is unfinished. Every bar
+    # with ts at or below watermark has been written.
+    op.create_table(
+        "backfill_progress",
+        sa.Column("exchange", sa.CHAR(8), primary_key=True),
+        sa.Column("symbol", sa.CHAR(12), primary_key=True),
+        sa.Column("watermark", sa.Integer, nullable=False),
+    )
+
+
+def downgrade():
+    op.drop_table("backfill_progress")
@@ -0,0 +1,48 @@
+"""deduplicate bars and funding, add unique (exchange, symbol, ts) keys
+
+Revision ID: 5a0f7c3e91b
+Revises: 2c6e1d8f0a9
+Create Date: 2026-10-18 09:41:37.082113
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = "5a0f7c3e91b"
+down_revision = "2c6e1d8f0a9"
+
+from alembic import op
+import sqlalchemy as sa
+
+# ts span deduplicated per statement, so no single DELETE locks or logs much
+CHUNK_SECS = 7 * 24 * 60 * 60
+
+
+def _dedup(table):
+    """Deletes all but the lowest id of each (exchange, symbol, ts), one symbol and
+    CHUNK_SECS of ts at a time. Each chunk commits on its own."""
+    conn = op.get_bind()
+    # a plain index first, so each chunk is an index range instead of a table scan
+    op.create_index("ix_" + table + "_dedup", table, ["exchange", "symbol", "ts"])
+    with op.get_context().autocommit_block():
+        pairs = conn.execute(sa.text(
+            "SELECT exchange, symbol, MIN(ts), MAX(ts) FROM " + table + " GROUP BY exchange, symbol")).fetchall()
+        for exchange, symbol, lo, hi in pairs:
+            while lo <= hi:
+                conn.execute(sa.text(
+                    "DELETE t1 FROM " + table + " t1 JOIN " + table + " t2"
+                    " ON t2.exchange = t1.exchange AND t2.symbol = t1.symbol AND t2.ts = t1.ts AND t2.id < t1.id"
+                    " WHERE t1.exchange = :exchange AND t1.symbol = :symbol AND t1.ts >= :lo AND t1.ts < :hi"),
+                    exchange=exchange, symbol=symbol, lo=lo, hi=lo + CHUNK_SECS)
+                lo += CHUNK_SECS
+    op.create_unique_constraint("uq_" + table + "_exchange_symbol_ts", table, ["exchange", "symbol", "ts"])
+    op.drop_index("ix_" + table + "_dedup", table)
+
+
+def upgrade():
+    _dedup("bars_1_min")
+    _dedup("perpfunding")
+
+
+def downgrade():
+    op.drop_constraint("uq_perpfunding_exchange_symbol_ts", "perpfunding", type_="unique")
+    op.drop_constraint("uq_bars_1_min_exchange_symbol_ts", "bars_1_min", type_="unique")
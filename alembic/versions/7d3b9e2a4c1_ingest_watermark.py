@@ -0,0 +1,39 @@
+"""ingest watermark
+
+Revision ID: 7d3b9e2a4c1
+Revises: 5a0f7c3e91b
+Create Date: 2026-10-18 11:47:30.228619
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = "7d3b9e2a4c1"
+down_revision = "5a0f7c3e91b"
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    # Earliest and latest ts and the row count of every symbol, kept up to date by
+    # the writers in the same transaction as the rows they write.
+    op.create_table(
+        "ingest_watermark",
+        sa.Column("exchange", sa.CHAR(8), primary_key=True),
+        sa.Column("tbl", sa.CHAR(16), primary_key=True),
+        sa.Column("symbol", sa.CHAR(12), primary_key=True),
+        sa.Column("earliest", sa.Integer, nullable=False),
+        sa.Column("latest", sa.Integer, nullable=False),
+        sa.Column("row_count", sa.BigInteger, nullable=False),
+    )
+    for table in ("bars_1_min", "perpfunding"):
+        # served from the (exchange, symbol, ts) unique index
+        op.execute(
+            "INSERT INTO ingest_watermark (exchange, tbl, symbol, earliest, latest, row_count) "
+            "SELECT exchange, '{0}', symbol, MIN(ts), MAX(ts), COUNT(*) FROM {0} "
+            "GROUP BY exchange, symbol".format(table)
+        )
+
+
+def downgrade():
+    op.drop_table("ingest_watermark")
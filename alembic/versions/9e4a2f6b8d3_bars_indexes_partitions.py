@@ -0,0 +1,66 @@
+"""covering indexes for bars and funding, monthly range partitions for bars_1_min
+
+Revision ID: 9e4a2f6b8d3
+Revises: 7d3b9e2a4c1
+Create Date: 2026-10-18 12:20:04.671350
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = "9e4a2f6b8d3"
+down_revision = "7d3b9e2a4c1"
+
+import calendar, datetime
+from alembic import op
+import sqlalchemy as sa
+
+# partitions are created up to this many months past the current one; later bars
+# land in pmax until fetchBars_sql.extendBarPartitions splits it
+MONTHS_AHEAD = 3
+
+
+def _monthStart(year, month):
+    return calendar.timegm(datetime.date(year, month, 1).timetuple())
+
+
+def _partitions(firstTS):
+    """Returns the PARTITION clauses for one partition per month from the month of
+    firstTS to MONTHS_AHEAD months past the current one, then pmax."""
+    first = datetime.datetime.utcfromtimestamp(firstTS)
+    now = datetime.datetime.utcnow()
+    year, month = first.year, first.month
+    last = (now.year * 12 + now.month - 1) + MONTHS_AHEAD
+    parts = []
+    while year * 12 + month - 1 <= last:
+        nextYear, nextMonth = (year + 1, 1) if month == 12 else (year, month + 1)
+        parts.append("PARTITION p{:04d}{:02d} VALUES LESS THAN ({})".format(
+            year, month, _monthStart(nextYear, nextMonth)))
+        year, month = nextYear, nextMonth
+    parts.append("PARTITION pmax VALUES LESS THAN MAXVALUE")
+    return parts
+
+
+def upgrade():
+    # Every read filters on exchange, symbol and a ts range and only needs the
+    # columns below, so these answer it from the index alone.
+    op.create_index("ix_bars_1_min_cover", "bars_1_min",
+                    ["exchange", "symbol", "ts", "open", "high", "low", "close", "volume"])
+    op.create_index("ix_perpfunding_cover", "perpfunding", ["exchange", "symbol", "ts", "value"])
+
+    # Every unique key of a partitioned table must contain the partitioning
+    # column, so the primary key becomes (id, ts).
+    conn = op.get_bind()
+    firstTS = conn.execute(sa.text("SELECT MIN(ts) FROM bars_1_min")).scalar()
+    if firstTS is None:
+        firstTS = _monthStart(2017, 1)
+    op.alter_column("bars_1_min", "ts", existing_type=sa.Integer, nullable=False)
+    op.execute("ALTER TABLE bars_1_min DROP PRIMARY KEY, ADD PRIMARY KEY (id, ts)")
+    op.execute("ALTER TABLE bars_1_min PARTITION BY RANGE (ts) (" + ", ".join(_partitions(firstTS)) + ")")
+
+
+def downgrade():
+    op.execute("ALTER TABLE bars_1_min REMOVE PARTITIONING")
+    op.execute("ALTER TABLE bars_1_min DROP PRIMARY KEY, ADD PRIMARY KEY (id)")
+    op.alter_column("bars_1_min", "ts", existing_type=sa.Integer, nullable=True)
+    op.drop_index("ix_perpfunding_cover", "perpfunding")
+    op.drop_index("ix_bars_1_min_cover", "bars_1_min")
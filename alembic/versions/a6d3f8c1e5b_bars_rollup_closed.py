@@ -0,0 +1,76 @@
+"""bars_rollup: left closed buckets, first and last bar ts
+
+Revision ID: a6d3f8c1e5b
+Revises: f4a7c2b9e3d
+Create Date: 2026-10-18 17:09:42.186530
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = "a6d3f8c1e5b"
+down_revision = "f4a7c2b9e3d"
+
+from alembic import op
+import sqlalchemy as sa
+
+# as utils/rollups.py; each size is aggregated from the one before it
+ROLLUP_SECS = [5 * 60, 60 * 60, 8 * 60 * 60, 24 * 60 * 60]
+CLOSED = ["right", "left"]
+# ts span filled per statement, a whole number of days so no bucket is split
+CHUNK_SECS = 7 * 24 * 60 * 60
+
+
+def _fillSql(level, closed):
+    secs = str(ROLLUP_SECS[level])
+    k = "ts DIV " + secs if closed == "left" else "(ts + " + secs + " - 1) DIV " + secs
+    if level == 0:
+        src, where, bars, first, last = "bars_1_min", "", "COUNT(*)", "MIN(ts)", "MAX(ts)"
+    else:
+        src, bars, first, last = "bars_rollup", "SUM(bars)", "MIN(first_ts)", "MAX(last_ts)"
+        where = " AND {t}secs = " + str(ROLLUP_SECS[level - 1]) + " AND {t}closed = '" + closed + "'"
+    return sa.text(
+        "INSERT INTO bars_rollup (instrument_id, secs, closed, ts, open, high, low, close, volume, bars, first_ts, last_ts)"
+        " SELECT g.instrument_id, " + secs + ", '" + closed + "', g.k * " + secs + ", o.open, g.high, g.low, c.close,"
+        " g.volume, g.bars, g.first_ts, g.last_ts FROM"
+        " (SELECT instrument_id, " + k + " AS k, MIN(ts) AS first, MAX(ts) AS last,"
+        " MAX(high) AS high, MIN(low) AS low, SUM(volume) AS volume, " + bars + " AS bars,"
+        " " + first + " AS first_ts, " + last + " AS last_ts"
+        " FROM " + src + " WHERE instrument_id = :id" + where.format(t="") +
+        " AND ts > :lo AND ts <= :hi GROUP BY instrument_id, k) g"
+        " JOIN " + src + " o ON o.instrument_id = g.instrument_id" + where.format(t="o.") + " AND o.ts = g.first"
+        " JOIN " + src + " c ON c.instrument_id = g.instrument_id" + where.format(t="c.") + " AND c.ts = g.last")
+
+
+def upgrade():
+    # the right closed rows are refilled below along with their first_ts and last_ts
+    op.execute("TRUNCATE TABLE bars_rollup")
+    # 'right': (ts - secs, ts], labelled with its close time; 'left': [ts, ts + secs), the
+    # groups of readBarsDB_pd's default label 'last'
+    op.add_column("bars_rollup", sa.Column("closed", sa.CHAR(5), nullable=False, server_default="right"))
+    # ts of the first and last 1 minute bar in the bucket; 'last' bars are labelled with last_ts
+    op.add_column("bars_rollup", sa.Column("first_ts", sa.Integer, nullable=False))
+    op.add_column("bars_rollup", sa.Column("last_ts", sa.Integer, nullable=False))
+    op.execute("ALTER TABLE bars_rollup DROP PRIMARY KEY, ADD PRIMARY KEY (instrument_id, secs, closed, ts)")
+    conn = op.get_bind()
+    with op.get_context().autocommit_block():
+        spans = conn.execute(sa.text(
+            "SELECT i.id, w.earliest, w.latest FROM ingest_watermark w"
+            " JOIN instruments i ON i.exchange = w.exchange AND i.symbol = w.symbol WHERE w.tbl = 'bars_1_min'")).fetchall()
+        for instrumentId, lo, hi in spans:
+            lo = lo // CHUNK_SECS * CHUNK_SECS
+            while lo <= hi:
+                for closed in CLOSED:
+                    for level in range(len(ROLLUP_SECS)):
+                        # a chunk holds whole buckets of either convention: (lo, lo + CHUNK_SECS] or
+                        # [lo, lo + CHUNK_SECS)
+                        a, b = (lo - 1, lo + CHUNK_SECS - 1) if closed == "left" else (lo, lo + CHUNK_SECS)
+                        conn.execute(_fillSql(level, closed), id=instrumentId, lo=a, hi=b)
+                lo += CHUNK_SECS
+
+
+def downgrade():
+    op.execute("DELETE FROM bars_rollup WHERE closed = 'left'")
+    op.execute("ALTER TABLE bars_rollup DROP PRIMARY KEY, ADD PRIMARY KEY (instrument_id, secs, ts)")
+    op.drop_column("bars_rollup", "last_ts")
+    op.drop_column("bars_rollup", "first_ts")
+    op.drop_column("bars_rollup", "closed")
@@ -0,0 +1,95 @@
+"""instruments table; bars and funding reference it by instrument_id
+
+Revision ID: b5c8e1d7f2a
+Revises: 9e4a2f6b8d3
+Create Date: 2026-10-18 13:05:52.904417
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = "b5c8e1d7f2a"
+down_revision = "9e4a2f6b8d3"
+
+from alembic import op
+import sqlalchemy as sa
+
+# ts span rewritten per statement, so no single UPDATE locks or logs much
+CHUNK_SECS = 7 * 24 * 60 * 60
+
+BAR_COLUMNS = ["ts", "open", "high", "low", "close", "volume"]
+FUNDING_COLUMNS = ["ts", "value"]
+
+
+def _encode(table, columns):
+    """Replaces the exchange and symbol columns of table with instrument_id, filling
+    it one instrument and CHUNK_SECS of ts at a time. Each chunk commits on its own.
+    Rows the watermark spans missed are filled by a final pass before the column
+    becomes NOT NULL."""
+    conn = op.get_bind()
+    # left by a run stopped at the NULL check below; the filled chunks are kept
+    if "instrument_id" not in [c["name"] for c in sa.inspect(conn).get_columns(table)]:
+        op.add_column(table, sa.Column("instrument_id", sa.SmallInteger))
+    with op.get_context().autocommit_block():
+        spans = conn.execute(sa.text(
+            "SELECT i.id, i.exchange, i.symbol, w.earliest, w.latest FROM ingest_watermark w"
+            " JOIN instruments i ON i.exchange = w.exchange AND i.symbol = w.symbol WHERE w.tbl = :tbl"),
+            tbl=table).fetchall()
+        for instrumentId, exchange, symbol, lo, hi in spans:
+            while lo <= hi:
+                # an index range of the (exchange, symbol, ts, ...) covering index
+                conn.execute(sa.text(
+                    "UPDATE " + table + " SET instrument_id = :id"
+                    " WHERE exchange = :exchange AND symbol = :symbol AND ts >= :lo AND ts < :hi"),
+                    id=instrumentId, exchange=exchange, symbol=symbol, lo=lo, hi=lo + CHUNK_SECS)
+                lo += CHUNK_SECS
+        # rows outside the recorded spans: a stale watermark, or a symbol with none
+        conn.execute(sa.text(
+            "INSERT IGNORE INTO instruments (exchange, symbol)"
+            " SELECT DISTINCT exchange, symbol FROM " + table + " WHERE instrument_id IS NULL"))
+        conn.execute(sa.text(
+            "UPDATE " + table + " t JOIN instruments i ON i.exchange = t.exchange AND i.symbol = t.symbol"
+            " SET t.instrument_id = i.id WHERE t.instrument_id IS NULL"))
+        left = conn.execute(sa.text("SELECT COUNT(*) FROM " + table + " WHERE instrument_id IS NULL")).scalar()
+        if left:
+            raise RuntimeError("{} rows of {} have no instrument (NULL exchange or symbol); fix them and "
+                               "run the migration again".format(left, table))
+    op.alter_column(table, "instrument_id", existing_type=sa.SmallInteger, nullable=False)
+    op.drop_constraint("uq_" + table + "_exchange_symbol_ts", table, type_="unique")
+    op.drop_index("ix_" + table + "_cover", table)
+    op.drop_column(table, "exchange")
+    op.drop_column(table, "symbol")
+    op.create_unique_constraint("uq_" + table + "_instrument_ts", table, ["instrument_id", "ts"])
+    op.create_index("ix_" + table + "_cover", table, ["instrument_id"] + columns)
+
+
+def _decode(table, columns):
+    op.add_column(table, sa.Column("exchange", sa.CHAR(8)))
+    op.add_column(table, sa.Column("symbol", sa.CHAR(12)))
+    op.execute("UPDATE " + table + " t JOIN instruments i ON i.id = t.instrument_id"
+               " SET t.exchange = i.exchange, t.symbol = i.symbol")
+    op.drop_index("ix_" + table + "_cover", table)
+    op.drop_constraint("uq_" + table + "_instrument_ts", table, type_="unique")
+    op.drop_column(table, "instrument_id")
+    op.create_unique_constraint("uq_" + table + "_exchange_symbol_ts", table, ["exchange", "symbol", "ts"])
+    op.create_index("ix_" + table + "_cover", table, ["exchange", "symbol"] + columns)
+
+
+def upgrade():
+    # No foreign keys: partitioned InnoDB tables cannot have them.
+    op.create_table(
+        "instruments",
+        sa.Column("id", sa.SmallInteger, primary_key=True, autoincrement=True),
+        sa.Column("exchange", sa.CHAR(8), nullable=False),
+        sa.Column("symbol", sa.CHAR(12), nullable=False),
+        sa.UniqueConstraint("exchange", "symbol", name="uq_instruments_exchange_symbol"),
+    )
+    # ingest_watermark already lists every (exchange, symbol) stored
+    op.execute("INSERT IGNORE INTO instruments (exchange, symbol) SELECT DISTINCT exchange, symbol FROM ingest_watermark")
+    _encode("bars_1_min", BAR_COLUMNS)
+    _encode("perpfunding", FUNDING_COLUMNS)
+
+
+def downgrade():
+    _decode("perpfunding", FUNDING_COLUMNS)
+    _decode("bars_1_min", BAR_COLUMNS)
+    op.drop_table("instruments")
@@ -0,0 +1,68 @@
+"""bars_rollup: 5m, 1h, 8h and 1d bars aggregated from bars_1_min
+
+Revision ID: c3f9a2e6d1b
+Revises: b5c8e1d7f2a
+Create Date: 2026-10-18 14:02:37.518290
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = "c3f9a2e6d1b"
+down_revision = "b5c8e1d7f2a"
+
+from alembic import op
+import sqlalchemy as sa
+
+# as utils/rollups.py; each size is aggregated from the one before it
+ROLLUP_SECS = [5 * 60, 60 * 60, 8 * 60 * 60, 24 * 60 * 60]
+# ts span filled per statement, a whole number of days so no bucket is split
+CHUNK_SECS = 7 * 24 * 60 * 60
+
+
+def _fillSql(level):
+    secs = str(ROLLUP_SECS[level])
+    if level == 0:
+        src, where, bars = "bars_1_min", "", "COUNT(*)"
+    else:
+        src, where, bars = "bars_rollup", " AND {t}secs = " + str(ROLLUP_SECS[level - 1]), "SUM(bars)"
+    return sa.text(
+        "INSERT INTO bars_rollup (instrument_id, secs, ts, open, high, low, close, volume, bars)"
+        " SELECT g.instrument_id, " + secs + ", g.k * " + secs + ", o.open, g.high, g.low, c.close, g.volume, g.bars FROM"
+        " (SELECT instrument_id, (ts + " + secs + " - 1) DIV " + secs + " AS k, MIN(ts) AS first, MAX(ts) AS last,"
+        " MAX(high) AS high, MIN(low) AS low, SUM(volume) AS volume, " + bars + " AS bars"
+        " FROM " + src + " WHERE instrument_id = :id" + where.format(t="") +
+        " AND ts > :lo AND ts <= :hi GROUP BY instrument_id, k) g"
+        " JOIN " + src + " o ON o.instrument_id = g.instrument_id" + where.format(t="o.") + " AND o.ts = g.first"
+        " JOIN " + src + " c ON c.instrument_id = g.instrument_id" + where.format(t="c.") + " AND c.ts = g.last")
+
+
+def upgrade():
+    op.create_table(
+        "bars_rollup",
+        sa.Column("instrument_id", sa.SmallInteger, nullable=False),
+        sa.Column("secs", sa.Integer, nullable=False),
+        # close time: the bucket holds the 1 minute bars with ts - secs < bar ts <= ts
+        sa.Column("ts", sa.Integer, nullable=False),
+        sa.Column("open", sa.FLOAT(8)),
+        sa.Column("high", sa.FLOAT(8)),
+        sa.Column("low", sa.FLOAT(8)),
+        sa.Column("close", sa.FLOAT(8)),
+        sa.Column("volume", sa.FLOAT(8)),
+        sa.Column("bars", sa.Integer, nullable=False),
+        sa.PrimaryKeyConstraint("instrument_id", "secs", "ts"),
+    )
+    conn = op.get_bind()
+    with op.get_context().autocommit_block():
+        spans = conn.execute(sa.text(
+            "SELECT i.id, w.earliest, w.latest FROM ingest_watermark w"
+            " JOIN instruments i ON i.exchange = w.exchange AND i.symbol = w.symbol WHERE w.tbl = 'bars_1_min'")).fetchall()
+        for instrumentId, lo, hi in spans:
+            lo = lo // CHUNK_SECS * CHUNK_SECS
+            while lo <= hi:
+                for level in range(len(ROLLUP_SECS)):
+                    conn.execute(_fillSql(level), id=instrumentId, lo=lo, hi=lo + CHUNK_SECS)
+                lo += CHUNK_SECS
+
+
+def downgrade():
+    op.drop_table("bars_rollup")
@@ -0,0 +1,31 @@
+"""derived_series: values of the series registered in utils/derived.py
+
+Revision ID: e8b2d5f1a4c
+Revises: c3f9a2e6d1b
+Create Date: 2026-10-18 14:48:11.306724
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = "e8b2d5f1a4c"
+down_revision = "c3f9a2e6d1b"
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    # filled by fetchBars_sql.updateDerived; the key gives it the last ts of a series
+    op.create_table(
+        "derived_series",
+        sa.Column("name", sa.CHAR(24), nullable=False),
+        sa.Column("instrument_id", sa.SmallInteger, nullable=False),
+        sa.Column("ts", sa.Integer, nullable=False),
+        # double: cumulative series carry on from the stored value
+        sa.Column("value", sa.Float(53), nullable=False),
+        sa.PrimaryKeyConstraint("name", "instrument_id", "ts"),
+    )
+
+
+def downgrade():
+    op.drop_table("derived_series")
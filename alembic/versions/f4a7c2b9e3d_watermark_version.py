@@ -0,0 +1,26 @@
+"""ingest_watermark: write version
+
+Revision ID: f4a7c2b9e3d
+Revises: e8b2d5f1a4c
+Create Date: 2026-10-18 16:21:05.743918
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = "f4a7c2b9e3d"
+down_revision = "e8b2d5f1a4c"
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    # version counts the writes to a symbol; revised is the version of the last write that
+    # reached back to or before its latest ts, so may have replaced stored rows
+    op.add_column("ingest_watermark", sa.Column("version", sa.BigInteger, nullable=False, server_default="0"))
+    op.add_column("ingest_watermark", sa.Column("revised", sa.BigInteger, nullable=False, server_default="0"))
+
+
+def downgrade():
+    op.drop_column("ingest_watermark", "revised")
+    op.drop_column("ingest_watermark", "version")
@@ -0,0 +1,128 @@
+"""Spot long / perp short carry trade over a grid of parameters.
+
+The trade is the one binance_perp_leverage_analysis.ipynb simulates. Of the
+capital, a fraction split is posted as perp margin, and the perp is shorted at
+leverage L against it at the start price p0. The rest buys the same amount spot.
+Funding on the short is credited at every funding event, and the perp account
+is liquidated once its leverage reaches 100 / maintenance margin rate (%).
+
+Per unit of margin the account is 1 + L / p0 * (p0 - p + G), where G is the sum
+of rate * price over the funding events since the start. Leverage is therefore
+L * p / (p0 + L * (p0 - p + G)). It depends on neither the capital nor the
+split, and it reaches M = 100 / rate exactly when
+
+    p - c * G >= c * (1 + L) * p0 / L,    with c = M / (1 + M).
+
+For each start and margin rate, the running maximum of the left side is then
+one nondecreasing array, and one searchsorted gives the liquidation time of
+every leverage. The grid costs starts x margin rates passes over the prices,
+whatever the number of leverages and splits. Equity at or below 0 is the case
+c = 1, which liquidates too: with a finite M the threshold is crossed first,
+but it is checked on its own so a bar gapping past both is never missed.
+Peak leverage is read from each leverage's path up to its last liquidation or
+the last bar, one leverage at a time, over the bars with positive equity.
+"""
+import numpy as np
+import pandas as pd
+
+
+def fundingOnBars(ts, fundingTs, fundingRate):
+    """Returns an array like ts holding each funding rate at the first bar at or after its event
+    and 0 elsewhere, the rate column the notebook builds on df_1m. ts are seconds."""
+    ts = np.asarray(ts, dtype = np.int64)
+    rate = np.zeros(len(ts))
+    i = np.searchsorted(ts, np.asarray(fundingTs, dtype = np.int64))
+    keep = i < len(ts)
+    np.add.at(rate, i[keep], np.asarray(fundingRate, dtype = float)[keep])
+    return rate
+
+def _startIndices(ts, starts):
+    if starts is None:
+        return np.array([0])
+    return np.unique(np.minimum(np.searchsorted(ts, np.asarray(starts, dtype = np.int64)), len(ts) - 1))
+
+def leveragePaths(price, rate, leverages, start = 0, end = None):
+    """Returns the perp leverage of each of leverages from bar start to end, shape (len(leverages), bars),
+    fut_lev in the notebook. Bars where the account has no positive equity left are bankrupt, so
+    liquidated, and hold inf."""
+    price = np.asarray(price, dtype = float)[start:end]
+    g = np.cumsum(np.asarray(rate, dtype = float)[start:end] * price)
+    L = np.asarray(leverages, dtype = float)[:, None]
+    p0 = price[0]
+    equity = p0 + L * (p0 - price + g)
+    with np.errstate(divide = 'ignore'):
+        return np.where(equity > 0, L * price / equity, np.inf)
+
+def carryGrid(ts, price, rate, leverages, marginRates, starts = None, splits = None, capital = 10000):
+    """Simulates the carry trade for every combination of leverages, marginRates (percent), starts
+    (seconds, the first bar by default) and splits (fraction of capital posted as perp margin;
+    by default 1 / (L + 1), the notebook's allocation).
+
+    ts, price -- the bars, ts in seconds; rate -- the funding rate at each bar, see fundingOnBars.
+    Returns a df with one row per cell:
+        liquidation    ts of the bar the account is liquidated at, NaN if it never is
+        end            ts the results are taken at: liquidation or the last bar
+        max_leverage   highest leverage up to end, over the bars with positive equity
+        funding_credit funding credited up to end, in the currency of capital
+        apy            funding credit up to end over capital, annualized, percent
+    """
+    ts = np.asarray(ts, dtype = np.int64)
+    price = np.asarray(price, dtype = float)
+    rate = np.asarray(rate, dtype = float)
+    flow = np.cumsum(rate * price)
+    L = np.asarray(leverages, dtype = float)
+    maxLev = 100.0 / np.asarray(marginRates, dtype = float)
+    c = maxLev / (1 + maxLev)
+    startIdx = _startIndices(ts, starts)
+    nL, nM, nS = len(L), len(maxLev), len(startIdx)
+
+    endIdx = np.empty((nL, nM, nS), dtype = np.int64)
+    liquidated = np.empty((nL, nM, nS), dtype = bool)
+    gains = np.empty((nL, nM, nS))
+    peaks = np.empty((nL, nM, nS))
+    for k, s in enumerate(startIdx):
+        p = price[s:]
+        p0 = p[0]
+        g = flow[s:] - (flow[s - 1] if s else 0.0)
+        #running max of p - c * g for every margin rate, shape (nM, bars)
+        reach = np.maximum.accumulate(p[None, :] - c[:, None] * g[None, :], axis = 1)
+        threshold = c[None, :] * (1 + L[:, None]) * p0 / L[:, None]
+        first = np.array([np.searchsorted(reach[m], threshold[:, m]) for m in range(nM)]).T
+        #bankruptcy, equity <= 0, liquidates whatever the margin rate
+        bankrupt = np.searchsorted(np.maximum.accumulate(p - g), (1 + L) * p0 / L)
+        first = np.minimum(first, bankrupt[:, None])
+        liquidated[:, :, k] = first < len(p)
+        last = np.minimum(first, len(p) - 1)
+        endIdx[:, :, k] = s + last
+        gains[:, :, k] = L[:, None] * g[last] / p0
+        #each leverage's path only up to its latest end, so paths stop at liquidation;
+        #a bankrupt bar has no leverage to report and is left out of the peak
+        for i in range(nL):
+            path = leveragePaths(price, rate, L[i:i + 1], s, s + last[i].max() + 1)[0]
+            runningPeak = np.maximum.accumulate(np.where(np.isfinite(path), path, -np.inf))
+            peaks[i, :, k] = runningPeak[last[i]]
+
+    if splits is None:
+        f = (1 / (L + 1))[:, None, None, None]
+        splitValues = np.broadcast_to(f, (nL, nM, nS, 1))
+    else:
+        splitValues = np.broadcast_to(np.asarray(splits, dtype = float)[None, None, None, :], (nL, nM, nS, len(splits)))
+    shape = splitValues.shape
+    credit = capital * splitValues * gains[..., None]
+    days = (ts[endIdx] - ts[startIdx][None, None, :]) / 86400.0
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        apy = np.where(days[..., None] > 0, 365 / days[..., None] * credit / capital * 100, np.nan)
+    grid = np.meshgrid(np.arange(nL), np.arange(nM), np.arange(nS), np.arange(shape[3]), indexing = 'ij')
+    iL, iM, iS, _ = [a.ravel() for a in grid]
+    endTs = ts[endIdx][iL, iM, iS]
+    return pd.DataFrame({
+        'L': L[iL],
+        'mm_rate': np.asarray(marginRates, dtype = float)[iM],
+        'start': ts[startIdx][iS],
+        'split': splitValues.ravel(),
+        'liquidation': np.where(liquidated[iL, iM, iS], endTs, np.nan),
+        'end': endTs,
+        'max_leverage': peaks[iL, iM, iS],
+        'funding_credit': credit.ravel(),
+        'apy': apy.ravel(),
+    })
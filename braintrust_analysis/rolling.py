@@ -0,0 +1,351 @@
+"""Rolling statistics over NumPy arrays.
+
+Every statistic has a batch function over a whole array and a class whose
+update(x) takes one value at a time, with O(1) work per step, and returns the
+statistic up to it, so a notebook and a live loop compute the same numbers.
+Windows hold the last n values; until n values have been seen the result is NaN.
+
+Window sums come from cumulative sums restarted every n values in the batch
+functions and from running sums in the classes, which recompute them from the
+window every n steps, so rounding does not build up over long series. Both
+subtract the first value seen before summing, so prices far from zero do not
+cancel away precision.
+Rolling min and max use van Herk/Gil-Werman block scans in batch and a
+monotonic deque when streaming. EMA is computed in blocks short enough that
+the decay factors stay within float range.
+
+    python rolling.py    (checks that the batch and streaming forms agree)
+"""
+import collections, math
+import numpy as np
+
+
+def _windowSums(x, n):
+    """Sums of the windows x[i - n + 1:i + 1], over the values present for i < n - 1.
+
+    The cumulative sums restart every n values, so they never grow past a window's worth:
+    a window is the head of its block plus the tail of the block before."""
+    m = len(x)
+    blocks = np.r_[x, np.zeros(-m % n)].reshape(-1, n).cumsum(axis = 1)
+    c = blocks.ravel()[:m]
+    out = c.copy()
+    i = np.arange(n, m)
+    i = i[i % n != n - 1]
+    out[i] += blocks[i // n - 1, -1] - c[i - n]
+    return out
+
+def _counts(length, n):
+    return np.minimum(np.arange(1, length + 1), n).astype(float)
+
+def _full(a, n):
+    a[:n - 1] = np.nan
+    return a
+
+def sma(x, n, minPeriods = None):
+    """Mean of the last n values. minPeriods values are enough for a partial window (n by default)."""
+    x = np.asarray(x, dtype = float)
+    if not len(x):
+        return x.copy()
+    shift = x[0]
+    out = _windowSums(x - shift, n) / _counts(len(x), n) + shift
+    out[:(n if minPeriods is None else minPeriods) - 1] = np.nan
+    return out
+
+def ema(x, n = None, alpha = None):
+    """Exponential moving average y[i] = alpha * x[i] + (1 - alpha) * y[i - 1], y[0] = x[0].
+    alpha defaults to 2 / (n + 1)."""
+    x = np.asarray(x, dtype = float)
+    a = 2.0 / (n + 1) if alpha is None else alpha
+    out = np.empty_like(x)
+    if not len(x):
+        return out
+    if a == 1:
+        out[:] = x
+        return out
+    d = 1 - a
+    #block length over which d ** -k stays below 1e100
+    block = len(x) if d == 0 else max(1, min(len(x), int(-100 * math.log(10) / math.log(d))))
+    p = d ** np.arange(block)
+    prev = x[0]
+    for start in range(0, len(x), block):
+        xb = x[start:start + block]
+        pb = p[:len(xb)]
+        y = pb * d * prev + a * pb * np.cumsum(xb / pb)
+        out[start:start + len(xb)] = y
+        prev = y[-1]
+    return out
+
+def _moments(x, n, ddof):
+    """Window mean and variance of x."""
+    shift = x[0]
+    s = x - shift
+    s1 = _windowSums(s, n)
+    s2 = _windowSums(s * s, n)
+    var = np.maximum(s2 - s1 * s1 / n, 0) / (n - ddof)
+    return _full(s1 / n + shift, n), _full(var, n)
+
+def std(x, n, ddof = 1):
+    """Standard deviation of the last n values."""
+    x = np.asarray(x, dtype = float)
+    if not len(x):
+        return x.copy()
+    return np.sqrt(_moments(x, n, ddof)[1])
+
+def zscore(x, n, ddof = 1):
+    """(x - mean) / std over the last n values, NaN where std is 0."""
+    x = np.asarray(x, dtype = float)
+    if not len(x):
+        return x.copy()
+    mean, var = _moments(x, n, ddof)
+    sd = np.sqrt(var)
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        return np.where(sd > 0, (x - mean) / sd, np.nan)
+
+def vwap(price, volume, n = None):
+    """Volume weighted average price of the last n bars, or of every bar so far if n is None."""
+    price = np.asarray(price, dtype = float)
+    volume = np.asarray(volume, dtype = float)
+    if not len(price):
+        return price.copy()
+    shift = price[0]
+    w = n or len(price)
+    v = _windowSums(volume, w)
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        out = _windowSums((price - shift) * volume, w) / v + shift
+    return out if n is None else _full(out, n)
+
+def _scan(x, n, accumulate, fill):
+    """van Herk/Gil-Werman: per block of n, prefix and suffix scans; window i is
+    accumulate(suffix[i - n + 1], prefix[i])."""
+    x = np.asarray(x, dtype = float)
+    if len(x) < n:
+        return np.full(len(x), np.nan)
+    padded = np.r_[x, np.full(-len(x) % n, fill)].reshape(-1, n)
+    prefix = accumulate.accumulate(padded, axis = 1).ravel()[:len(x)]
+    suffix = accumulate.accumulate(padded[:, ::-1], axis = 1)[:, ::-1].ravel()[:len(x)]
+    out = np.full(len(x), np.nan)
+    out[n - 1:] = accumulate(suffix[:len(x) - n + 1], prefix[n - 1:])
+    return out
+
+def rollingMin(x, n):
+    """Minimum of the last n values."""
+    return _scan(x, n, np.minimum, np.inf)
+
+def rollingMax(x, n):
+    """Maximum of the last n values."""
+    return _scan(x, n, np.maximum, -np.inf)
+
+def corr(x, y, n):
+    """Pearson correlation of x and y over the last n values, NaN where either is constant."""
+    x = np.asarray(x, dtype = float)
+    y = np.asarray(y, dtype = float)
+    if not len(x):
+        return x.copy()
+    sx, sy = x - x[0], y - y[0]
+    mx, my = _windowSums(sx, n) / n, _windowSums(sy, n) / n
+    cov = _windowSums(sx * sy, n) / n - mx * my
+    vx = np.maximum(_windowSums(sx * sx, n) / n - mx * mx, 0)
+    vy = np.maximum(_windowSums(sy * sy, n) / n - my * my, 0)
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        out = np.where((vx > 0) & (vy > 0), cov / np.sqrt(vx * vy), np.nan)
+    return _full(out, n)
+
+
+class _Window:
+    """Last n rows of k values with their running sums, recomputed from the rows once per n updates."""
+    def __init__(self, n, k):
+        self.n = n
+        self.rows = collections.deque()
+        self.sums = [0.0] * k
+        self.steps = 0
+
+    def push(self, row):
+        self.rows.append(row)
+        if len(self.rows) > self.n:
+            old = self.rows.popleft()
+            self.sums = [s + a - b for s, a, b in zip(self.sums, row, old)]
+        else:
+            self.sums = [s + a for s, a in zip(self.sums, row)]
+        self.steps += 1
+        if self.steps % self.n == 0:
+            self.sums = [math.fsum(col) for col in zip(*self.rows)]
+
+    def full(self):
+        return len(self.rows) == self.n
+
+
+class SMA:
+    """Streaming sma."""
+    def __init__(self, n, minPeriods = None):
+        self.window = _Window(n, 1)
+        self.minPeriods = n if minPeriods is None else minPeriods
+        self.shift = None
+
+    def update(self, x):
+        if self.shift is None:
+            self.shift = x
+        w = self.window
+        w.push((x - self.shift,))
+        return w.sums[0] / len(w.rows) + self.shift if len(w.rows) >= self.minPeriods else math.nan
+
+
+class EMA:
+    """Streaming ema."""
+    def __init__(self, n = None, alpha = None):
+        self.alpha = 2.0 / (n + 1) if alpha is None else alpha
+        self.value = None
+
+    def update(self, x):
+        self.value = x if self.value is None else self.alpha * x + (1 - self.alpha) * self.value
+        return self.value
+
+
+class Std:
+    """Streaming std; zscore() gives the z-score of the last value."""
+    def __init__(self, n, ddof = 1):
+        self.window = _Window(n, 2)
+        self.ddof = ddof
+        self.shift = None
+        self.last = math.nan
+
+    def _moments(self):
+        n = self.window.n
+        s1, s2 = self.window.sums
+        return s1 / n + self.shift, max(s2 - s1 * s1 / n, 0) / (n - self.ddof)
+
+    def update(self, x):
+        if self.shift is None:
+            self.shift = x
+        s = x - self.shift
+        self.window.push((s, s * s))
+        self.last = x
+        return math.sqrt(self._moments()[1]) if self.window.full() else math.nan
+
+    def zscore(self):
+        if not self.window.full():
+            return math.nan
+        mean, var = self._moments()
+        return (self.last - mean) / math.sqrt(var) if var > 0 else math.nan
+
+
+class ZScore:
+    """Streaming zscore."""
+    def __init__(self, n, ddof = 1):
+        self.std = Std(n, ddof)
+
+    def update(self, x):
+        self.std.update(x)
+        return self.std.zscore()
+
+
+class VWAP:
+    """Streaming vwap; update takes a bar's price and volume. With n None, every bar so far."""
+    def __init__(self, n = None):
+        self.n = n
+        self.window = _Window(n, 2) if n else None
+        self.sums = [0.0, 0.0]
+        self.shift = None
+
+    def update(self, price, volume):
+        if self.shift is None:
+            self.shift = price
+        row = ((price - self.shift) * volume, volume)
+        if self.window is None:
+            self.sums = [s + a for s, a in zip(self.sums, row)]
+            pv, v = self.sums
+        else:
+            self.window.push(row)
+            if not self.window.full():
+                return math.nan
+            pv, v = self.window.sums
+        return pv / v + self.shift if v else math.nan
+
+
+class _Extreme:
+    """Monotonic deque of (index, value): values that may still be the window's extreme."""
+    def __init__(self, n, before):
+        self.n = n
+        self.before = before
+        self.deque = collections.deque()
+        self.i = 0
+
+    def update(self, x):
+        d = self.deque
+        while d and not self.before(d[-1][1], x):
+            d.pop()
+        d.append((self.i, x))
+        if d[0][0] <= self.i - self.n:
+            d.popleft()
+        self.i += 1
+        return d[0][1] if self.i >= self.n else math.nan
+
+
+class RollingMin(_Extreme):
+    """Streaming rollingMin."""
+    def __init__(self, n):
+        _Extreme.__init__(self, n, lambda kept, x: kept < x)
+
+
+class RollingMax(_Extreme):
+    """Streaming rollingMax."""
+    def __init__(self, n):
+        _Extreme.__init__(self, n, lambda kept, x: kept > x)
+
+
+class Corr:
+    """Streaming corr; update takes one x and one y."""
+    def __init__(self, n):
+        self.window = _Window(n, 5)
+        self.shift = None
+
+    def update(self, x, y):
+        if self.shift is None:
+            self.shift = (x, y)
+        sx, sy = x - self.shift[0], y - self.shift[1]
+        self.window.push((sx, sy, sx * sy, sx * sx, sy * sy))
+        if not self.window.full():
+            return math.nan
+        n = self.window.n
+        s1x, s1y, sxy, sxx, syy = [s / n for s in self.window.sums]
+        vx, vy = max(sxx - s1x * s1x, 0), max(syy - s1y * s1y, 0)
+        return (sxy - s1x * s1y) / math.sqrt(vx * vy) if vx > 0 and vy > 0 else math.nan
+
+
+def _stream(stat, *columns):
+    return np.array([stat.update(*values) for values in zip(*columns)], dtype = float)
+
+def selfCheck(length = 20000, n = 50, seed = 0):
+    """Compares every batch function with its streaming class on a random walk. Returns
+    {name: largest difference}, NaNs included (a NaN in one form only counts as inf)."""
+    rng = np.random.RandomState(seed)
+    price = 10000 + np.cumsum(rng.normal(0, 5, length))
+    volume = rng.exponential(10, length)
+    other = price + np.cumsum(rng.normal(0, 3, length))
+    pairs = {
+        'sma': (sma(price, n), _stream(SMA(n), price)),
+        'sma partial': (sma(price, n, 1), _stream(SMA(n, 1), price)),
+        'ema': (ema(price, n), _stream(EMA(n), price)),
+        'std': (std(price, n), _stream(Std(n), price)),
+        'zscore': (zscore(price, n), _stream(ZScore(n), price)),
+        'vwap': (vwap(price, volume, n), _stream(VWAP(n), price, volume)),
+        'vwap cumulative': (vwap(price, volume), _stream(VWAP(), price, volume)),
+        'rollingMin': (rollingMin(price, n), _stream(RollingMin(n), price)),
+        'rollingMax': (rollingMax(price, n), _stream(RollingMax(n), price)),
+        'corr': (corr(price, other, n), _stream(Corr(n), price, other)),
+    }
+    diffs = {}
+    for name, (a, b) in pairs.items():
+        if not np.array_equal(np.isnan(a), np.isnan(b)):
+            diffs[name] = np.inf
+        else:
+            ok = ~np.isnan(a)
+            diffs[name] = float(np.max(np.abs(a[ok] - b[ok]) / np.maximum(1, np.abs(a[ok])))) if ok.any() else 0.0
+    return diffs
+
+
+if __name__ == "__main__":
+    diffs = selfCheck()
+    for name, d in diffs.items():
+        print('{:16s} {:.2e}'.format(name, d))
+    assert max(diffs.values()) < 1e-9, 'batch and streaming forms differ'
+    print('Batch and streaming forms agree.')
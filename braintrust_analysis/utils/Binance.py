@@ -1,9 +1,10 @@
 #bittrex API 
-import requests, json, datetime, pytz, time
-from threading import Lock
+import requests, json, datetime, pytz, time, asyncio
+from threading import Lock, Condition
 import _thread
 import hmac, hashlib, math
 from misc import getTimeStamp
+from transport import getTransport
 import logging
 
 logger = logging.getLogger(__name__)
@@ -13,85 +14,149 @@ formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(messag
 fh.setFormatter(formatter)
 logger.addHandler(fh)
 
+INTERVAL_SECS = {'SECOND': 1, 'MINUTE': 60, 'HOUR': 60 * 60, 'DAY': 60 * 60 * 24}
+
+class _RateWindow:
+    """Counter for one rateLimits entry from exchangeInfo.
+    Binance counts usage in windows aligned to multiples of the interval, so a
+    single counter per window is exact and every operation is O(1)."""
+    __slots__ = ('seconds', 'limit', 'header', 'window', 'used')
+
+    def __init__(self, interval, intervalNum, limit):
+        self.seconds = INTERVAL_SECS[interval] * intervalNum
+        self.limit = limit
+        self.header = str(intervalNum) + interval[0]    #suffix of the X-MBX-* headers, e.g. 1M, 10S, 1D
+        self.window = 0
+        self.used = 0
+
+    def _roll(self, now):
+        w = int(now // self.seconds)
+        if w != self.window:
+            self.window = w
+            self.used = 0
+
+    def wait(self, now, weight):
+        """Seconds until weight fits in the window, 0 if it fits now."""
+        self._roll(now)
+        if self.used + weight <= self.limit or self.used == 0:
+            return 0
+        return (self.window + 1) * self.seconds - now
+
+    def sync(self, now, used):
+        """Corrects the counter with the usage reported by the exchange."""
+        self._roll(now)
+        self.used = max(self.used, used)
+
+    def __repr__(self):
+        return '{}: {}/{}'.format(self.header, self.used, self.limit)
+
+
 class binanceRateLimits:
-    def __init__(self, rateLimitJson, lock):
+    """Blocking rate limiter for the rateLimits entries in exchangeInfo.
+
+    REQUEST_WEIGHT entries are charged under the REQUESTS weight type, ORDERS
+    entries under ORDERS, and RAW_REQUESTS entries are charged 1 for every call.
+    Counters are reconciled with the X-MBX-USED-WEIGHT-* and X-MBX-ORDER-COUNT-*
+    response headers, and 429/418 responses stop all callers for Retry-After seconds.
+    """
+    def __init__(self, rateLimitJson, lock, clock = getTimeStamp):
         self.lock = lock
-        self.rateLimits = {'REQUESTS': [], 'ORDERS': []}
+        self.cond = Condition(lock)
+        self.clock = clock
+        self.blockedUntil = 0
+        self.rateLimits = {'REQUESTS': [], 'ORDERS': [], 'RAW_REQUESTS': []}
         for d in rateLimitJson:
-            intervalSecs= 0
-            if d['interval'] == 'SECOND':
-                intervalSecs = 1
-            elif d['interval'] == 'MINUTE':
-                intervalSecs = 60
-            elif d['interval'] == 'DAY':
-                intervalSecs = 60 * 60 * 24                                
-            d2 = {'interval': intervalSecs, 'limit': None, 'counter': 0, 'lstOfEntries': []} 
-            if d['rateLimitType'] == 'REQUESTS':
-                d2.update({'limit': d['limit']})
-                self.rateLimits['REQUESTS'].append(d2)
-            elif d['rateLimitType'] == 'ORDERS':
-                d2.update({'limit': d['limit']})
-                self.rateLimits['ORDERS'].append(d2)
+            if not d['interval'] in INTERVAL_SECS:
+                continue
+            w = _RateWindow(d['interval'], d.get('intervalNum', 1), d['limit'])
+            if d['rateLimitType'] in ('REQUEST_WEIGHT', 'REQUESTS'):
+                self.rateLimits['REQUESTS'].append(w)
+            elif d['rateLimitType'] in self.rateLimits:
+                self.rateLimits[d['rateLimitType']].append(w)
         logger.info('Binance rate limits: %s', self.rateLimits)
         
+    def _reserve(self, weightType, weight):
+        """Charges weight if every window has room and returns 0, otherwise returns
+        the seconds to wait. Must be called with the lock held."""
+        now = self.clock()
+        wait = self.blockedUntil - now
+        if wait > 0:
+            return wait
+        charges = [(w, weight) for w in self.rateLimits[weightType]]
+        charges += [(w, 1) for w in self.rateLimits['RAW_REQUESTS']]
+        wait = max([w.wait(now, n) for w, n in charges] + [0])
+        if wait > 0:
+            return wait
+        for w, n in charges:
+            w.used += n
+        return 0
                 
-    def update(self, weightType, weight):
+    def acquire(self, weightType, weight, blocking = True):
+        """Charges weight to the REQUESTS or ORDERS limits, waiting until there is room.
+        Returns False instead of waiting if blocking is False."""
+        with self.cond:
+            while True:
+                wait = self._reserve(weightType, weight)
+                if wait <= 0:
+                    return True
+                if not blocking:
+                    logger.info("Binance: Rate violation for %s type", weightType)
+                    return False
+                self.cond.wait(wait)
+
+    async def acquireAsync(self, weightType, weight):
+        """Same as acquire, for use from a coroutine."""
+        while True:
+            with self.lock:
+                wait = self._reserve(weightType, weight)
+            if wait <= 0:
+                return True
+            await asyncio.sleep(wait)
+
+    def update(self, weightType, weight, blocking = True):
         """Update the counter value of the REQUESTS or ORDERS weight.
-        Returns False if the counter is above an acceptable limit."""
-        #increment counters
-        blnOutput = True
-        nowTS = getTimeStamp()
-        self.lock.acquire() 
-        if weightType == 'REQUESTS':
-            for d in self.rateLimits['REQUESTS']:
-                #update counter and list of previous entries 
-                d['counter'] += weight
-                d['lstOfEntries'].append((weight, nowTS))
+        Waits until the weight fits; returns False only if blocking is False and it does not."""
+        return self.acquire(weightType, weight, blocking)
                 
-                #delete entries as appropriate
-                deleteCount = 0
-                totalAdj = 0
-                for w, ts in d['lstOfEntries']:
-                    if nowTS - ts > d['interval']:
-                        totalAdj += w
-                        deleteCount += 1
-                    else:
-                        break
-                d['counter'] = d['counter'] - totalAdj
-                del d['lstOfEntries'][:deleteCount]   #delete expired entries   
+    def reconcile(self, headers):
+        """Corrects the counters from the usage headers of a response."""
+        with self.lock:
+            now = self.clock()
+            for k, v in headers.items():
+                k = k.upper()
+                if k.startswith('X-MBX-USED-WEIGHT-'):
+                    windows, suffix = self.rateLimits['REQUESTS'], k[len('X-MBX-USED-WEIGHT-'):]
+                elif k.startswith('X-MBX-ORDER-COUNT-'):
+                    windows, suffix = self.rateLimits['ORDERS'], k[len('X-MBX-ORDER-COUNT-'):]
+                else:
+                    continue
+                for w in windows:
+                    if w.header == suffix:
+                        w.sync(now, int(v))
                 
-                #check if rate violation
-                if d['counter'] >= d['limit']:
-                    blnOutput = False
-                    logger.info("Binance: Rate violation for REQUESTS type")
-        elif weightType == 'ORDERS':
-            for d in self.rateLimits['ORDERS']:
-                d['counter'] += weight
-                d['lstOfEntries'].append((weight, nowTS))
-                #delete entries as appropriate
-                deleteCount = 0
-                totalAdj = 0
-                for w, ts in d['lstOfEntries']:
-                    if nowTS - ts < d['interval']:
-                        totalAdj += w
-                        deleteCount += 1
-                    else:
-                        break
-                d['counter'] = d['counter'] - totalAdj
-                del d['lstOfEntries'][:deleteCount]   #delete expired entries   
-                if d['counter'] >= d['limit']:
-                    blnOutput = False
-                    logger.info("Binance: Rate violation for ORDERS type")
-        self.lock.release()        
-        
-        return blnOutput
-        
+    def backoff(self, seconds):
+        """Blocks all callers for seconds."""
+        with self.cond:
+            self.blockedUntil = max(self.blockedUntil, self.clock() + seconds)
+        
+    def checkResponse(self, r):
+        """Reconciles with the response headers. Returns True if the request was
+        rejected for rate limiting (429, or 418 for an IP ban) and should be retried."""
+        self.reconcile(r.headers)
+        if r.status_code == 429 or r.status_code == 418:
+            retryAfter = int(r.headers.get('Retry-After', 60))
+            logger.error('Binance returned %s, backing off for %s seconds', r.status_code, retryAfter)
+            self.backoff(retryAfter)
+            return True
+        return False
             
 
 class binance:
-    def __init__(self, APIKey = None, Secret = None):
+    def __init__(self, APIKey = None, Secret = None, transport = None):
+        """transport -- transport.Transport used for every request; defaults to the shared one."""
         self.APIKey = APIKey
         self.Secret = Secret
+        self.transport = transport if transport is not None else getTransport()
         self.URL = 'https://api.binance.com'
         
         r = self.exchangeInfo()
@@ -109,7 +174,10 @@ class binance:
             raise Exception()
         
         self.lock = Lock()
-        self.rateLimits = binanceRateLimits(r['rateLimits'], self.lock)                
+        clock = lambda: getTimeStamp() + self.timeStampOffset
+        self.rateLimits = binanceRateLimits(r['rateLimits'], self.lock, clock)
+        self.futuresURL = 'https://fapi.binance.com'
+        self.futuresRateLimits = None
             
         self.OrderBookQuotes = {}
         
@@ -146,32 +214,23 @@ class binance:
         if not limit in validLimit:
             logger.error("invalid limit value in call to getOrderBook")
             return -1, -1     
-        rateLimitOK = self.rateLimits.update("REQUESTS", weight)
-        
-        if rateLimitOK:                
-            payload = {'symbol':symbol, 'limit':limit}
-            r = requests.get(self.URL + '/api/v1/depth', params = payload)   
-            if r.status_code == 429:
-                logger.info('Rate limit violation (429 error) received from Binance in getOrderBook call')
-                return -1, -1    
-            elif str(r.status_code)[0] == '4' or str(r.status_code)[0] == '5': 
-                logger.debug('Return code error in getOrderBook call: ' + str(r.status_code))
-                return -1, -1    
-            elif r.status_code == 200:
-                #parse quotes
-                res = r.json()     
-                bids = res["bids"]
-                bidsOut = [(float(x[0]), float(x[1])) for x in bids]
-                asks = res["asks"]
-                asksOut = [(float(x[0]), float(x[1])) for x in asks]                           
-                return bidsOut, asksOut
-        else:
-            logger.debug("Rate limit violation for call to getOrderBook")
+        payload = {'symbol':symbol, 'limit':limit}
+        r = self._request(lambda: self.transport.get(self.URL + '/api/v1/depth', params = payload, retries = 0), "REQUESTS", weight)
+        if str(r.status_code)[0] == '4' or str(r.status_code)[0] == '5': 
+            logger.debug('Return code error in getOrderBook call: ' + str(r.status_code))
             return -1, -1
+        elif r.status_code == 200:
+            #parse quotes
+            res = r.json()     
+            bids = res["bids"]
+            bidsOut = [(float(x[0]), float(x[1])) for x in bids]
+            asks = res["asks"]
+            asksOut = [(float(x[0]), float(x[1])) for x in asks]                           
+            return bidsOut, asksOut
         return None, None
                      
     def exchangeInfo(self):
-        r = requests.get(self.URL + '/api/v1/exchangeInfo')        
+        r = self.transport.get(self.URL + '/api/v1/exchangeInfo')        
         if r.status_code == 200:
             return r.json()        
         else:
@@ -203,12 +262,8 @@ class binance:
         "count": 76         // Trade count
         }
         """
-        r = requests.get(self.URL + '/api/v1/ticker/24hr')        
+        r = self._request(lambda: self.transport.get(self.URL + '/api/v1/ticker/24hr', retries = 0), "REQUESTS", 40)
         res = r.json()    
-        
-        weight = max(int(len(res)/2), 1)
-        
-        rateLimitOK = self.rateLimits.update("REQUESTS", weight)
 
         return res
     
@@ -233,16 +288,10 @@ class binance:
               ]
             ]            
         """
-        rateLimitOK = self.rateLimits.update("REQUESTS", 1)
-    
-        if rateLimitOK:           
-            payload = {'symbol': symbol, 'interval': '1m', 'startTime': startTime, 'endTime': endTime}
-            r = requests.get(self.URL + '/api/v1/klines', payload)        
-            res = r.json()        
-            return res        
-        else:
-            logger.error('rate limit violation in getBarData')
-            return -1
+        payload = {'symbol': symbol, 'interval': '1m', 'startTime': startTime, 'endTime': endTime}
+        r = self._request(lambda: self.transport.get(self.URL + '/api/v1/klines', payload, retries = 0), "REQUESTS", 1)
+        res = r.json()        
+        return res
         
     def getBarDataFutures(self, symbol, startTime, endTime):
         """Get 1 minute bar data for the symbol. 500 bars should be returned per call.
@@ -265,17 +314,12 @@ class binance:
               ]
             ]            
         """
-        rateLimitOK = self.rateLimits.update("REQUESTS", 1)
-        futures_url = "https://fapi.binance.com"        
-    
-        if rateLimitOK:           
-            payload = {'symbol': symbol, 'interval': '1m', 'startTime': int(startTime * 1000), 'limit': 1500}
-            r = requests.get(futures_url + '/fapi/v1/klines', payload)        
-            res = r.json()        
-            return res        
-        else:
-            logger.error('rate limit violation in getBarData')
-            return -1
+        payload = {'symbol': symbol, 'interval': '1m', 'startTime': int(startTime * 1000), 'limit': 1500}
+        #a limit above 1000 costs 10 weight on the futures api
+        r = self._request(lambda: self.transport.get(self.futuresURL + '/fapi/v1/klines', payload, retries = 0), "REQUESTS", 10,
+                          self._getFuturesRateLimits())
+        res = r.json()        
+        return res
             
         
     def getFundingRateHistory(self, symbol, startTime = None, endTime= None):
@@ -294,46 +338,32 @@ class binance:
                 {...}
             ]            
         """
-        rateLimitOK = self.rateLimits.update("REQUESTS", 1)
-        futures_url = "https://fapi.binance.com"
-    
-        if rateLimitOK:           
-            if startTime == None:
-                payload = {'symbol': symbol, 'limit':1000}
-            else:
-                payload = {'symbol': symbol, 'startTime': int(startTime*1000), 'endTime': int(endTime*1000),  'limit':1000}
-            r = requests.get(futures_url + '/fapi/v1/fundingRate', payload)        
-            res = r.json()        
-            return res        
+        if startTime == None:
+            payload = {'symbol': symbol, 'limit':1000}
         else:
-            logger.error('rate limit violation in getBarData')
-            return -1        
+            payload = {'symbol': symbol, 'startTime': int(startTime*1000), 'endTime': int(endTime*1000),  'limit':1000}
+        r = self._request(lambda: self.transport.get(self.futuresURL + '/fapi/v1/fundingRate', payload, retries = 0), "REQUESTS", 1,
+                          self._getFuturesRateLimits())
+        res = r.json()        
+        return res
         
     
     ####Account Endpoints - Trade methods
     def getAllOrders(self, symbol, orderId = None):
         """If orderId is set, it will get orders >= that orderId. Otherwise most recent orders are returned."""
-        rateLimitOK = self.rateLimits.update("ORDERS", 5)
-        if rateLimitOK:
-            ts = int((getTimeStamp() + self.timeStampOffset) * 1000)
+        payload = {'symbol':symbol}
+        if orderId != None:
+            payload['orderId'] = orderId
             
-            payload = {'symbol':symbol, 'timestamp': ts}
-            if orderId != None:
-                payload['orderId'] = orderId
+        r = self._signedRequest(self.URL + '/api/v3/allOrders', payload, 'GET', "ORDERS", 5)
                     
-            authReq = self._prepareAuthRequest(self.URL + '/api/v3/allOrders', payload, reqType = 'GET')  
-            s = requests.Session()
-            r = s.send(authReq)
+        if r.status_code != 200:
+            logger.error('Return code error in placeOrder: ' + str(r.status_code) + "  " + str(r.content))  
+            return -1
             
-            if r.status_code != 200:
-                logger.error('Return code error in placeOrder: ' + str(r.status_code) + "  " + str(r.content))  
-                return -1
+        res = r.json()   
             
-            res = r.json()   
-                       
-            return res
-        else:
-            return -1        
+        return res
         
     def placeOrder(self, symbol, side, ordType, quantity, clientOrderID, asMaker = False, price = 0, otherParams = {}):
         """
@@ -343,55 +373,48 @@ class binance:
         price - decimal (optional). If price = 0, order will be a market order.
         otherParams - optional list of additional key-value pairs to write to db (not otherwise used)
         """
-        rateLimitOK = self.rateLimits.update("ORDERS", 1)
-        if rateLimitOK:
-            if price == 0 and not ordType == 'MARKET':
-                logger.error('price indicates Market order order but ordType is not market.' )
-                return -1
-            ts = int((getTimeStamp() + self.timeStampOffset) * 1000)
+        if price == 0 and not ordType == 'MARKET':
+            logger.error('price indicates Market order order but ordType is not market.' )
+            return -1
             
-            #Apply filters to price and quantity
-            price, quantity = self._applyFilters(price, quantity, symbol)
-            if price == None:
-                return -1
+        #Apply filters to price and quantity
+        price, quantity = self._applyFilters(price, quantity, symbol)
+        if price == None:
+            return -1
             
-            if price == 0:
-                payload = {'symbol':symbol, 'side': side, 'type': ordType, 'quantity': quantity, 'timestamp': ts, 
-                           'newClientOrderId': clientOrderID}
-            else:
-                price = round(price, self.symbolExchInfo[symbol]['quotePrecision'])
-                fmtStr= '{:.' + str(self.symbolExchInfo[symbol]['quotePrecision']) + 'f}'
-                payload = {'symbol':symbol, 'side': side, 'type': ordType, 'quantity': quantity, 'timestamp': ts, 'price': fmtStr.format(price), 
-                           'timeInForce': 'GTC', 'newClientOrderId': clientOrderID}            
-            authReq = self._prepareAuthRequest(self.URL + '/api/v3/order', payload)  
-            s = requests.Session()
-            r = s.send(authReq)
+        if price == 0:
+            payload = {'symbol':symbol, 'side': side, 'type': ordType, 'quantity': quantity,
+                       'newClientOrderId': clientOrderID}
+        else:
+            price = round(price, self.symbolExchInfo[symbol]['quotePrecision'])
+            fmtStr= '{:.' + str(self.symbolExchInfo[symbol]['quotePrecision']) + 'f}'
+            payload = {'symbol':symbol, 'side': side, 'type': ordType, 'quantity': quantity, 'price': fmtStr.format(price), 
+                       'timeInForce': 'GTC', 'newClientOrderId': clientOrderID}            
+        r = self._signedRequest(self.URL + '/api/v3/order', payload, 'POST', "ORDERS", 1)
             
-            if r.status_code != 200:
-                logger.error('Return code error in placeOrder: ' + str(r.status_code) + "  " + str(r.content))  
-                return -1
+        if r.status_code != 200:
+            logger.error('Return code error in placeOrder: ' + str(r.status_code) + "  " + str(r.content))  
+            return -1
             
-            res = r.json()   
-            newD = {'orderID': res['orderId'],
-                                'exchange': 'binance',
-                                'side': res['side'].lower(),
-                                'amt':float(res['origQty']),
-                                'amtFilled': float(res['executedQty']),
-                                'amtRemaining': float(res['origQty']) - float(res['executedQty']),
-                                'timestamp': res['transactTime']/1000,
-                                'symbol': res['symbol'],
-                                'clientTradeLabel': res['clientOrderId'],
-                                'price' : float(res['price']),
-                                'asMaker': asMaker}   
+        res = r.json()   
+        newD = {'orderID': res['orderId'],
+                            'exchange': 'binance',
+                            'side': res['side'].lower(),
+                            'amt':float(res['origQty']),
+                            'amtFilled': float(res['executedQty']),
+                            'amtRemaining': float(res['origQty']) - float(res['executedQty']),
+                            'timestamp': res['transactTime']/1000,
+                            'symbol': res['symbol'],
+                            'clientTradeLabel': res['clientOrderId'],
+                            'price' : float(res['price']),
+                            'asMaker': asMaker}   
             
-            #add additional parameters to the dictionary
-            for k in otherParams.keys():
-                if not k in newD:
-                    newD[k] = otherParams[k]            
+        #add additional parameters to the dictionary
+        for k in otherParams.keys():
+            if not k in newD:
+                newD[k] = otherParams[k]            
                     
-            return newD                
-        else:
-            return -1
+        return newD
         
     def queryOrder(self, orderId, symbol):
         """Check an order's status.
@@ -414,45 +437,31 @@ class binance:
         }
         
         """
-        rateLimitOK = self.rateLimits.update("ORDERS", 1)
-        if rateLimitOK:
-            ts = int((getTimeStamp() + self.timeStampOffset) * 1000)
-            payload = {'symbol':symbol, 'orderId': orderId, 'timestamp': ts}            
+        payload = {'symbol':symbol, 'orderId': orderId}            
             
-            authReq = self._prepareAuthRequest(self.URL + '/api/v3/order', payload, reqType  = 'GET')  
-            s = requests.Session()
-            r = s.send(authReq)
+        r = self._signedRequest(self.URL + '/api/v3/order', payload, 'GET', "ORDERS", 1)
             
-            if str(r.status_code)[0] == '4' or str(r.status_code)[0] == '5': 
-                logger.debug('Return code error in queryOrder: ' + str(r.status_code))  
-                return None
+        if str(r.status_code)[0] == '4' or str(r.status_code)[0] == '5': 
+            logger.debug('Return code error in queryOrder: ' + str(r.status_code))  
+            return None
             
-            res = r.json()  
-            logger.info('Query order: ' + str(res))
-            return res
-        else:
-            return None        
+        res = r.json()  
+        logger.info('Query order: ' + str(res))
+        return res
         
     def cancelOrder(self, orderID, symbol):
         """Returns a list of the orderIDs of the canceled orders."""
-        rateLimitOK = self.rateLimits.update("ORDERS", 1)
-        if rateLimitOK:
-            ts = int((getTimeStamp() + self.timeStampOffset) * 1000)
-            payload = {'symbol':symbol, 'orderId': orderID, 'timestamp': ts}            
+        payload = {'symbol':symbol, 'orderId': orderID}            
             
-            authReq = self._prepareAuthRequest(self.URL + '/api/v3/order', payload, reqType  = 'DELETE')  
-            s = requests.Session()
-            r = s.send(authReq)
+        r = self._signedRequest(self.URL + '/api/v3/order', payload, 'DELETE', "ORDERS", 1)
             
-            if str(r.status_code)[0] == '4' or str(r.status_code)[0] == '5': 
-                logger.debug('Return code error in cancelOrder: ' + str(r.status_code))  
-                return -1
+        if str(r.status_code)[0] == '4' or str(r.status_code)[0] == '5': 
+            logger.debug('Return code error in cancelOrder: ' + str(r.status_code))  
+            return -1
             
-            res = r.json()   
-            logger.info('Binance: Cancel order executed: ' + str(res))
-            return [res['orderId']]
-        else:
-            return -1          
+        res = r.json()   
+        logger.info('Binance: Cancel order executed: ' + str(res))
+        return [res['orderId']]
         
     def getOpenOrders(self, symbol):
         """Get open orders on a symbol. Set symbol to None for all open orders. Returns -1 if an error.
@@ -474,39 +483,33 @@ class binance:
         "isWorking": trueO
         }      
         """
-        rateLimitOK = self.rateLimits.update("ORDERS", 1)
-        if rateLimitOK:
-            ts = int((getTimeStamp() + self.timeStampOffset) * 1000)
-            payload = {'timestamp': ts}            
-            if symbol:
-                payload.update({'symbol': symbol})
+        payload = {}            
+        if symbol:
+            payload.update({'symbol': symbol})
             
-            authReq = self._prepareAuthRequest(self.URL + '/api/v3/openOrders', payload, reqType  = 'GET')  
-            s = requests.Session()
-            r = s.send(authReq)
+        r = self._signedRequest(self.URL + '/api/v3/openOrders', payload, 'GET', "ORDERS", 1)
             
-            if str(r.status_code)[0] == '4' or str(r.status_code)[0] == '5': 
-                logger.error('Return code error in getOpenOrders: ' + str(r.status_code) + ';' + json.loads(r.content)['msg'])  
-                return -1
+        if str(r.status_code)[0] == '4' or str(r.status_code)[0] == '5': 
+            logger.error('Return code error in getOpenOrders: ' + str(r.status_code) + ';' + json.loads(r.content)['msg'])  
+            return -1
             
-            res = r.json()   
-            logger.debug('get open orders executed: ' + str(res))
-            outL = []
-            for d in res:
-                newD = {'orderID': d['orderId'],
-                        'exchange': 'binance',
-                        'side': d['side'].lower(),
-                        'amt': float(d['origQty']),
-                        'amtFilled': float(d['executedQty']),
-                        'amtRemaining': float(d['origQty']) - float(d['executedQty']),
-                        'timestamp': d['time']/1000,
-                        'symbol': d['symbol'],
-                        'clientOrdID' : d['clientOrderId']}  
-                if newD['amtFilled'] < newD['amt']:
-                    outL.append(newD)            
-            return outL
-        else:
-            return -1            
+        res = r.json()   
+        logger.debug('get open orders executed: ' + str(res))
+        outL = []
+        for d in res:
+            newD = {'orderID': d['orderId'],
+                    'exchange': 'binance',
+                    'side': d['side'].lower(),
+                    'amt': float(d['origQty']),
+                    'amtFilled': float(d['executedQty']),
+                    'amtRemaining': float(d['origQty']) - float(d['executedQty']),
+                    'timestamp': d['time']/1000,
+                    'symbol': d['symbol'],
+                    'clientOrdID' : d['clientOrderId']}  
+            if newD['amtFilled'] < newD['amt']:
+                outL.append(newD)            
+        return outL
+
     def getAccountBalances(self):
         """Returns a list of dictionaries of the balances. Returns -1 if error.
         Example output:
@@ -523,24 +526,15 @@ class binance:
         }
         ]
       """
-        rateLimitOK = self.rateLimits.update("ORDERS", 5)
-        if rateLimitOK:
-            ts = int((getTimeStamp() + self.timeStampOffset) * 1000)
-            payload = {'timestamp': ts}            
+        r = self._signedRequest(self.URL + '/api/v3/account', {}, 'GET', "ORDERS", 5)
                        
-            authReq = self._prepareAuthRequest(self.URL + '/api/v3/account', payload, reqType  = 'GET')  
-            s = requests.Session()
-            r = s.send(authReq)
-            
-            if str(r.status_code)[0] == '4' or str(r.status_code)[0] == '5': 
-                logger.error('Return code error in getAccountBalances: ' + str(r.status_code) + ';' + str(r.content))  
-                return -1
+        if str(r.status_code)[0] == '4' or str(r.status_code)[0] == '5': 
+            logger.error('Return code error in getAccountBalances: ' + str(r.status_code) + ';' + str(r.content))  
+            return -1
             
-            res = r.json()   
-            logger.debug('get account balances executed: ' + str(res))
-            return res['balances']
-        else:
-            return -1    
+        res = r.json()   
+        logger.debug('get account balances executed: ' + str(res))
+        return res['balances']
         
     def getAggTrades(self, symbol, startTime = None, endTime = None):
         """
@@ -569,28 +563,21 @@ class binance:
         }
       ]
         """
-        rateLimitOK = self.rateLimits.update("ORDERS", 1)
-        if rateLimitOK:
-            ts = int((getTimeStamp() + self.timeStampOffset) * 1000)
-            payload = {'timestamp': ts, 'symbol': symbol}            
-            if startTime != None:
-                payload['startTime'] = startTime
-            if endTime != None:
-                payload['endTime'] = endTime
+        payload = {'symbol': symbol}            
+        if startTime != None:
+            payload['startTime'] = startTime
+        if endTime != None:
+            payload['endTime'] = endTime
                        
-            authReq = self._prepareAuthRequest(self.URL + '/api/v1/aggTrades', payload, reqType  = 'GET')  
-            s = requests.Session()
-            r = s.send(authReq)
+        r = self._signedRequest(self.URL + '/api/v1/aggTrades', payload, 'GET', "ORDERS", 1)
             
-            if r.status_code != 200:
-                logger.error('Return code error in getAccountBalances: ' + str(r.status_code) + ';' + str(r.content))  
-                return -1
+        if r.status_code != 200:
+            logger.error('Return code error in getAccountBalances: ' + str(r.status_code) + ';' + str(r.content))  
+            return -1
             
-            res = r.json()   
-            logger.debug('get aggTrade executed: ' + str(res))
-            return res
-        else:
-            return -1    
+        res = r.json()   
+        logger.debug('get aggTrade executed: ' + str(res))
+        return res
         
      
     def _OBQuote(self,  symbol, requestPerMinute):
@@ -601,36 +588,66 @@ class binance:
             return r['symbol'], d
         
         sleepAmount = 60.0/requestPerMinute
+        payload = {'symbol':symbol} if symbol else None
         while True:         
-            rateLimitOK = self.rateLimits.update("REQUESTS", 1)
+            r = self._request(lambda: self.transport.get(self.URL + '/api/v3/ticker/bookTicker', params = payload, retries = 0),
+                              "REQUESTS", 1 if symbol else 2)
             
-            if rateLimitOK:                
-                if symbol:
-                    payload = {'symbol':symbol}
-                    r = requests.get(self.URL + '/api/v3/ticker/bookTicker', params = payload)   
-                else:
-                    r = requests.get(self.URL + '/api/v3/ticker/bookTicker')       
+            if str(r.status_code)[0] == '4' or str(r.status_code)[0] == '5': 
+                logger.debug('Return code error ' + str(r.status_code))
+            elif r.status_code == 200:
+                #parse quotes
+                res = r.json()     
+                d2 = {}
+                if not isinstance(res, list):
+                    res = [res]
+                for q in res:
+                    symbolTemp, d = processQuote(q)
+                    d2[symbolTemp] = d
                     
-                if r.status_code == 429:
-                    logger.info('Rate limit violation (429 error) received from Binance')
-                elif str(r.status_code)[0] == '4' or str(r.status_code)[0] == '5': 
-                    logger.debug('Return code error ' + str(r.status_code))
-                elif r.status_code == 200:
-                    #parse quotes
-                    res = r.json()     
-                    d2 = {}
-                    if not isinstance(res, list):
-                        res = [res]
-                    for q in res:
-                        symbolTemp, d = processQuote(q)
-                        d2[symbolTemp] = d
-                        
-                    self.lock.acquire() 
-                    self.OrderBookQuotes.update(d2)
-                    self.lock.release()
+                self.lock.acquire() 
+                self.OrderBookQuotes.update(d2)
+                self.lock.release()
                 
             time.sleep(sleepAmount)
             
+    def _getFuturesRateLimits(self):
+        """The futures api has its own limits; they are read from its exchangeInfo on first use.
+        Built under self.lock, so threads starting together share one limiter and one budget."""
+        if self.futuresRateLimits is None:
+            with self.lock:
+                if self.futuresRateLimits is None:
+                    r = self.transport.get(self.futuresURL + '/fapi/v1/exchangeInfo').json()
+                    clock = lambda: getTimeStamp() + self.timeStampOffset
+                    self.futuresRateLimits = binanceRateLimits(r['rateLimits'], Lock(), clock)
+        return self.futuresRateLimits
+
+    def _request(self, send, weightType, weight, rateLimits = None, method = 'GET'):
+        """Waits for rate limit budget, then calls send() and returns its response.
+        Requests rejected with 429/418 are retried once Retry-After has passed. send makes a
+        single attempt (retries = 0); the transport's retries of failed idempotent requests
+        call it again from here, so each attempt waits for budget too."""
+        if rateLimits is None:
+            rateLimits = self.rateLimits
+        def attempt():
+            while True:
+                rateLimits.acquire(weightType, weight)
+                r = send()
+                if not rateLimits.checkResponse(r):
+                    return r
+        return self.transport.retrying(method, attempt)
+
+    def _signedRequest(self, URL, params, reqType, weightType, weight):
+        """Same as _request for an endpoint that needs a signature. The timestamp is
+        set and the request signed on every attempt, so it is still valid after waiting
+        for budget or backing off."""
+        def send():
+            payload = dict(params)
+            payload['timestamp'] = int((getTimeStamp() + self.timeStampOffset) * 1000)
+            authReq = self._prepareAuthRequest(URL, payload, reqType = reqType)
+            return self.transport.send(authReq)
+        return self._request(send, weightType, weight, method = reqType)
+            
     def _prepareAuthRequest(self, URL, params, reqType = 'POST'):
         #generate signature as HMAC of queryString and secretkey
         req = requests.Request(reqType, URL, params = params)
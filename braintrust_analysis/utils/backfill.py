@@ -0,0 +1,185 @@
+"""Concurrent backfill engine.
+
+Fetch jobs run on a thread pool and hand each page they download back to the
+thread that called run(), which does all of the database writes. The module
+level connections in fetchBars*.py are therefore never shared between threads,
+and the only throttle on the fetchers is the exchange rate limiter they call
+through.
+
+A long range for one symbol can be split with splitRange into windows that run
+as separate jobs; WindowTracker then tells the caller how far the completed
+prefix of those windows reaches.
+"""
+import queue, threading, time
+from concurrent.futures import ThreadPoolExecutor
+import logging
+
+logger = logging.getLogger(__name__)
+
+_DONE = object()
+
+
+class ThroughputStats:
+    """Rows written per job key and overall, with rows/s since the engine started."""
+    def __init__(self):
+        self.started = time.time()
+        self.rows = {}
+        self.finished = {}
+
+    def add(self, key, n):
+        self.rows[key] = self.rows.get(key, 0) + n
+
+    def done(self, key):
+        self.finished[key] = time.time()
+
+    def rate(self, key = None):
+        """Returns rows/s for key, or for all keys if key is None."""
+        if key is None:
+            n = sum(self.rows.values())
+            elapsed = time.time() - self.started
+        else:
+            n = self.rows.get(key, 0)
+            elapsed = self.finished.get(key, time.time()) - self.started
+        return n / elapsed if elapsed > 0 else 0.0
+
+    def report(self):
+        lines = []
+        for key in sorted(self.rows):
+            lines.append('{}: {} rows, {:.1f} rows/s'.format(' '.join(key), self.rows[key], self.rate(key)))
+        lines.append('TOTAL: {} rows, {:.1f} rows/s'.format(sum(self.rows.values()), self.rate()))
+        return '\n'.join(lines)
+
+
+def splitRange(startTS, endTS, seconds):
+    """Splits (startTS, endTS] into consecutive windows of at most seconds."""
+    windows = []
+    while startTS < endTS:
+        windows.append((startTS, min(startTS + seconds, endTS)))
+        startTS += seconds
+    return windows
+
+
+class WindowTracker:
+    """Tracks which windows of a sharded backfill are complete.
+
+    Windows finish in any order, but watermark only advances over the contiguous
+    prefix of completed windows, so every row at or below it has been written."""
+    def __init__(self, windows):
+        self.windows = windows
+        self.completed = set()
+        self.next = 0
+        self.watermark = windows[0][0] if windows else None
+
+    def complete(self, i):
+        """Marks window i complete. Returns True if the watermark advanced."""
+        self.completed.add(i)
+        advanced = False
+        while self.next in self.completed:
+            self.completed.discard(self.next)
+            self.watermark = self.windows[self.next][1]
+            self.next += 1
+            advanced = True
+        return advanced
+
+    @property
+    def finished(self):
+        return self.next == len(self.windows)
+
+
+class BackfillJob:
+    def __init__(self, key, pages, write, onDone):
+        self.key = key
+        self.pages = pages
+        self.write = write
+        self.onDone = onDone
+
+
+class BackfillEngine:
+    """Runs many fetch jobs at once.
+
+    maxWorkers -- number of jobs fetching at the same time.
+    queueSize -- pages that may wait for the writer before fetchers block.
+    reportEvery -- seconds between progress reports, None to only report at the end.
+    """
+    def __init__(self, maxWorkers = 8, queueSize = 64, reportEvery = 30):
+        self.maxWorkers = maxWorkers
+        self.queueSize = queueSize
+        self.reportEvery = reportEvery
+        self.jobs = []
+
+    def add(self, key, pages, write, onDone = None):
+        """Adds a job.
+
+        key -- tuple of strings naming the job in reports, e.g. ('klines', 'BTCUSDT').
+               Jobs sharing a key (the windows of one symbol) are reported together.
+        pages -- callable returning an iterable of pages; it runs on a worker thread.
+        write -- called with each page on the thread that calls run().
+        onDone -- called without arguments on the same thread once every page of the
+                  job has been written. It is not called if the job fails.
+        """
+        self.jobs.append(BackfillJob(key, pages, write, onDone))
+
+    def run(self):
+        """Runs all jobs to completion and returns their ThroughputStats.
+
+        A failing job does not stop the others; the first error is raised once
+        every job has finished."""
+        stats = ThroughputStats()
+        q = queue.Queue(self.queueSize)
+        stop = threading.Event()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    q.put(item, timeout = 0.5)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def work(job):
+            try:
+                for page in job.pages():
+                    if not put((job, page, None)):
+                        return
+            except Exception as e:
+                put((job, None, e))
+                return
+            put((job, _DONE, None))
+
+        errors = []
+        pending = {}
+        for job in self.jobs:
+            pending[job.key] = pending.get(job.key, 0) + 1
+        lastReport = time.time()
+        with ThreadPoolExecutor(max_workers = self.maxWorkers) as pool:
+            for job in self.jobs:
+                pool.submit(work, job)
+            remaining = len(self.jobs)
+            try:
+                while remaining:
+                    job, page, err = q.get()
+                    if err is not None or page is _DONE:
+                        remaining -= 1
+                        pending[job.key] -= 1
+                        if err is not None:
+                            logger.error('Backfill job %s failed: %s', job.key, err)
+                            errors.append(err)
+                        elif job.onDone is not None:
+                            job.onDone()
+                        if pending[job.key] == 0:
+                            stats.done(job.key)
+                            print(' '.join(job.key), 'done:', stats.rows.get(job.key, 0), 'rows,',
+                                  round(stats.rate(job.key), 1), 'rows/s')
+                    elif page:
+                        job.write(page)
+                        stats.add(job.key, len(page))
+                    if self.reportEvery is not None and time.time() - lastReport >= self.reportEvery:
+                        print(stats.report())
+                        lastReport = time.time()
+            finally:
+                stop.set()
+        print(stats.report())
+        if errors:
+            raise errors[0]
+        return stats
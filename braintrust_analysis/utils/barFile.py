@@ -0,0 +1,135 @@
+"""Fixed-width binary bar files, one per exchange and symbol.
+
+A file is a 64 byte header followed by 48 byte records of int64 ts and float64
+open, high, low, close and volume, in ts order. The header holds a magic string,
+the format version, the record size and the number of committed records. sync()
+writes records before it raises that count, so a reader never sees a partly
+written one. The ts of every INDEX_STRIDE-th record is kept in a .idx file next
+to it, so a range lookup reads a page or two of the file instead of binary
+searching all of it.
+
+BarFile memory-maps the file read-only. Kernels and sweep workers that open the
+same symbol share its page cache pages, and opening a multi-year series takes
+milliseconds whatever its length.
+
+    python barFile.py sync <exchange> <symbol>...    (copies new bars from fetchBars_sql)
+    python barFile.py info <path>
+"""
+import os, struct, sys
+import numpy as np
+from barSeries import BarSeries, toSeconds
+
+MAGIC = b'BTBARS\x00\x00'
+VERSION = 1
+HEADER = struct.Struct('<8sIIqq')
+HEADER_SIZE = 64
+RECORD = np.dtype([('ts', '<i8'), ('open', '<f8'), ('high', '<f8'), ('low', '<f8'), ('close', '<f8'),
+                   ('volume', '<f8')])
+INDEX_STRIDE = 4096
+
+
+def _readHeader(f):
+    f.seek(0)
+    magic, version, recordSize, rows, stride = HEADER.unpack(f.read(HEADER.size))
+    if magic != MAGIC or version != VERSION or recordSize != RECORD.itemsize:
+        raise ValueError('Not a version {} bar file: {}'.format(VERSION, f.name))
+    return rows, stride
+
+def _writeHeader(f, rows):
+    f.seek(0)
+    f.write(HEADER.pack(MAGIC, VERSION, RECORD.itemsize, rows, INDEX_STRIDE).ljust(HEADER_SIZE, b'\x00'))
+
+def sync(path, fetchAfter):
+    """Appends the bars after the last one in the file at path, creating it if needed.
+
+    fetchAfter(ts) yields chunks of the bars after ts (all of them if ts is None) in ts order, as
+    dicts of arrays 'ts', 'O', 'H', 'L', 'C', 'V' like fetchBars_sql.iterBars(asNumpy = True).
+    Each chunk is committed on its own. Returns the number of bars appended."""
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok = True)
+        with open(path, 'wb') as f:
+            _writeHeader(f, 0)
+        open(path + '.idx', 'wb').close()
+    appended = 0
+    with open(path, 'r+b') as f, open(path + '.idx', 'r+b') as idx:
+        rows, stride = _readHeader(f)
+        last = None
+        if rows:
+            f.seek(HEADER_SIZE + (rows - 1) * RECORD.itemsize)
+            last = int(np.frombuffer(f.read(8), '<i8')[0])
+        for chunk in fetchAfter(last):
+            ts = toSeconds(chunk['ts'])
+            keep = slice(int(np.searchsorted(ts, last, side = 'right')) if last is not None else 0, None)
+            records = np.empty(len(ts[keep]), RECORD)
+            if not len(records):
+                continue
+            records['ts'] = ts[keep]
+            for field, c in zip(RECORD.names[1:], 'OHLCV'):
+                records[field] = chunk[c][keep]
+            f.seek(HEADER_SIZE + rows * RECORD.itemsize)
+            f.write(records.tobytes())
+            #index entries for the records at multiples of stride in this chunk
+            first = -(-rows // stride) * stride
+            idx.truncate(-(-rows // stride) * 8)
+            idx.seek(0, os.SEEK_END)
+            idx.write(records['ts'][first - rows::stride].tobytes())
+            idx.flush()
+            f.flush()
+            os.fsync(f.fileno())
+            rows += len(records)
+            last = int(records['ts'][-1])
+            appended += len(records)
+            _writeHeader(f, rows)
+            f.flush()
+    return appended
+
+
+class BarFile:
+    """Read-only view of a bar file. Its arrays are memory-mapped, so nothing is read until used."""
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self.rows, self.stride = _readHeader(f)
+        if self.rows:
+            self.records = np.memmap(path, RECORD, 'r', offset = HEADER_SIZE, shape = (self.rows,))
+            self.index = np.memmap(path + '.idx', np.int64, 'r', shape = (-(-self.rows // self.stride),))
+        else:
+            self.records = np.empty(0, RECORD)
+            self.index = np.empty(0, np.int64)
+        self.ts = self.records['ts']
+
+    def __len__(self):
+        return self.rows
+
+    def _position(self, t, side):
+        b = int(np.searchsorted(self.index, t, side)) - 1
+        if b < 0:
+            return 0
+        lo = b * self.stride
+        return lo + int(np.searchsorted(self.ts[lo:lo + self.stride], t, side))
+
+    def series(self):
+        """Returns every bar as a BarSeries whose arrays are views of the file."""
+        r = self.records
+        return BarSeries(r['ts'], r['open'], r['high'], r['low'], r['close'], r['volume'])
+
+    def between(self, a = None, b = None):
+        """Returns the bars with a <= ts <= b as a BarSeries of views, found through the index."""
+        lo = 0 if a is None else self._position(toSeconds(a), 'left')
+        hi = self.rows if b is None else self._position(toSeconds(b), 'right')
+        return self.series()[lo:hi]
+
+    def toDataFrame(self, a = None, b = None):
+        """Returns the bars with a <= ts <= b as a df like readBarsDB_pd's. This copies them."""
+        return self.between(a, b).toDataFrame()
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    if args[:1] == ['sync']:
+        import fetchBars_sql
+        for s in args[2:]:
+            print(s, fetchBars_sql.syncBarFile(s, args[1]), 'bars appended')
+    elif args[:1] == ['info']:
+        bars = BarFile(args[1]).series()
+        print(bars, bars.memoryReport())
@@ -0,0 +1,219 @@
+"""Parquet store of bars and funding, partitioned by exchange, symbol and month.
+
+Files live under root/<table>/exchange=<exchange>/symbol=<symbol>/month=<YYYY-MM>/,
+one part file per write, sorted by ts and cut into row groups whose statistics
+record the ts range. A read only opens the month directories that overlap the
+range, skips row groups whose ts statistics fall outside it and reads only the
+requested columns. Part files are named by write time; where two of them hold
+the same ts the later one wins, as an upsert would. compact() merges the part
+files of each month into one; run it from cron with
+
+    python barLake.py compact <root> [table]
+
+Needs pyarrow (pip install pyarrow), which the database readers do not.
+"""
+import itertools, os, sys, time
+import numpy as np
+import pandas as pd
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+#value columns of each table; every table also has an int64 ts in seconds
+TABLES = {'bars': ['open', 'high', 'low', 'close', 'volume'], 'funding': ['value']}
+#readBarsDB_pd's column names
+BAR_NAMES = {'O': 'open', 'H': 'high', 'L': 'low', 'C': 'close', 'V': 'volume'}
+ROW_GROUP = 65536
+#orders part files written by this process within the same microsecond
+_seq = itertools.count()
+
+
+def _months(ts):
+    return ts.astype('datetime64[s]').astype('datetime64[M]')
+
+
+class BarLake:
+    """Parquet bar and funding store rooted at the directory root."""
+    def __init__(self, root):
+        if pq is None:
+            raise ImportError('BarLake needs pyarrow: pip install pyarrow')
+        self.root = os.path.expanduser(root)
+
+    def _symbolDir(self, table, exchange, symbol):
+        return os.path.join(self.root, table, 'exchange=' + exchange, 'symbol=' + symbol)
+
+    def _monthDirs(self, table, exchange, symbol, startTS = None, endTS = None):
+        base = self._symbolDir(table, exchange, symbol)
+        if not os.path.isdir(base):
+            return []
+        lo = None if startTS is None else str(_months(np.array([int(startTS)]))[0])
+        hi = None if endTS is None else str(_months(np.array([int(endTS)]))[0])
+        dirs = []
+        for d in sorted(os.listdir(base)):
+            month = d[len('month='):]
+            if (lo is None or month >= lo) and (hi is None or month <= hi):
+                dirs.append(os.path.join(base, d))
+        return dirs
+
+    @staticmethod
+    def _parts(d):
+        return sorted([os.path.join(d, f) for f in os.listdir(d) if f.endswith('.parquet')])
+
+    def write(self, table, exchange, symbol, ts, values):
+        """Writes rows of one symbol, one part file per month they fall in.
+
+        ts -- seconds; values -- {column: array} for the columns of TABLES[table]."""
+        ts = np.asarray(ts, dtype = np.int64)
+        if not len(ts):
+            return
+        order = np.argsort(ts, kind = 'mergesort')
+        ts = ts[order]
+        values = {c: np.asarray(values[c], dtype = np.float64)[order] for c in TABLES[table]}
+        months = _months(ts)
+        bounds = np.flatnonzero(np.r_[True, months[1:] != months[:-1], True])
+        name = '{:020d}-{:09d}-{}.parquet'.format(int(time.time() * 10 ** 6), next(_seq), os.getpid())
+        for a, b in zip(bounds[:-1], bounds[1:]):
+            d = os.path.join(self._symbolDir(table, exchange, symbol), 'month=' + str(months[a]))
+            os.makedirs(d, exist_ok = True)
+            self._writePart(os.path.join(d, name), table, ts[a:b], {c: v[a:b] for c, v in values.items()})
+
+    @staticmethod
+    def _writePart(path, table, ts, values):
+        columns = ['ts'] + TABLES[table]
+        arrays = [pa.array(ts, type = pa.int64())] + [pa.array(values[c], type = pa.float64()) for c in TABLES[table]]
+        tmp = path + '.tmp'
+        pq.write_table(pa.Table.from_arrays(arrays, names = columns), tmp, row_group_size = ROW_GROUP)
+        os.replace(tmp, path)
+
+    @staticmethod
+    def _readPart(path, columns, startTS, endTS):
+        """Reads columns of the row groups of path that may hold startTS < ts < endTS."""
+        f = pq.ParquetFile(path)
+        meta = f.metadata
+        tsIdx = [meta.schema.column(j).name for j in range(meta.num_columns)].index('ts')
+        groups = []
+        for i in range(meta.num_row_groups):
+            stats = meta.row_group(i).column(tsIdx).statistics
+            if stats is not None and stats.has_min_max:
+                if (startTS is not None and stats.max <= startTS) or (endTS is not None and stats.min >= endTS):
+                    continue
+            groups.append(f.read_row_group(i, columns = ['ts'] + columns).to_pandas())
+        return groups
+
+    def read(self, table, exchange, symbol, startTS = None, endTS = None, columns = None):
+        """Returns (ts, {column: values}) of the rows with startTS < ts < endTS in ts order.
+        columns defaults to every column of the table."""
+        columns = list(TABLES[table] if columns is None else columns)
+        frames = []
+        for d in self._monthDirs(table, exchange, symbol, startTS, endTS):
+            for path in self._parts(d):
+                frames.extend(self._readPart(path, columns, startTS, endTS))
+        if not frames:
+            return np.empty(0, np.int64), {c: np.empty(0) for c in columns}
+        ts = np.concatenate([f['ts'].values for f in frames]).astype(np.int64)
+        values = {c: np.concatenate([f[c].values for f in frames]) for c in columns}
+        keep = np.ones(len(ts), dtype = bool)
+        if startTS is not None:
+            keep &= ts > startTS
+        if endTS is not None:
+            keep &= ts < endTS
+        #parts were read oldest first, so a stable sort leaves the newest copy of a ts last
+        order = np.flatnonzero(keep)
+        order = order[np.argsort(ts[order], kind = 'mergesort')]
+        ts = ts[order]
+        last = np.r_[ts[1:] != ts[:-1], True]
+        return ts[last], {c: v[order][last] for c, v in values.items()}
+
+    def readBars(self, symbol, exchange, startTS = None, endTS = None, fields = ('O', 'H', 'L', 'C', 'V')):
+        """Returns a df of fields indexed by ts, like readBarsDB_pd."""
+        ts, values = self.read('bars', exchange, symbol, startTS, endTS, [BAR_NAMES[f] for f in fields])
+        index = pd.to_datetime(ts, unit = 's', utc = True)
+        index.name = 'ts'
+        return pd.DataFrame({f: values[BAR_NAMES[f]] for f in fields}, index = index, columns = list(fields))
+
+    def readFunding(self, symbol, exchange, startTS = None, endTS = None):
+        """Returns a df with column fund_rate indexed by ts, like fetchFundingData."""
+        ts, values = self.read('funding', exchange, symbol, startTS, endTS)
+        index = pd.to_datetime(ts, unit = 's', utc = True)
+        index.name = 'ts'
+        return pd.DataFrame({'fund_rate': values['value']}, index = index)
+
+    def compact(self, table = None, minParts = 2):
+        """Merges the part files of every month directory holding at least minParts of them into
+        one. Returns the number of directories compacted."""
+        compacted = 0
+        for t in ([table] if table else list(TABLES)):
+            top = os.path.join(self.root, t)
+            if not os.path.isdir(top):
+                continue
+            for exchangeDir in sorted(os.listdir(top)):
+                for symbolDir in sorted(os.listdir(os.path.join(top, exchangeDir))):
+                    base = os.path.join(top, exchangeDir, symbolDir)
+                    for monthDir in sorted(os.listdir(base)):
+                        if self._compactMonth(t, os.path.join(base, monthDir), minParts):
+                            compacted += 1
+        return compacted
+
+    def _compactMonth(self, table, d, minParts):
+        parts = self._parts(d)
+        if len(parts) < minParts:
+            return False
+        frames = []
+        for path in parts:
+            frames.extend(self._readPart(path, TABLES[table], None, None))
+        df = pd.concat(frames, ignore_index = True)
+        df = df.iloc[np.argsort(df['ts'].values, kind = 'mergesort')]
+        df = df.loc[~df['ts'].duplicated(keep = 'last')]
+        #the merged file replaces the newest part, so until the older ones are removed it still wins over them
+        self._writePart(parts[-1], table, df['ts'].values, {c: df[c].values for c in TABLES[table]})
+        for path in parts[:-1]:
+            os.remove(path)
+        return True
+
+
+class LakeHook:
+    """BulkWriter hook that copies each batch written to the database into a BarLake.
+
+    table -- 'bars' or 'funding'. columns, exchange and instruments identify each row's symbol
+    as for watermarks.WatermarkHook. A batch reaches the lake just before its transaction
+    commits, so a failed commit can leave rows in the lake only; writing them again replaces them."""
+    def __init__(self, lake, table, columns, exchange = None, instruments = None):
+        self.lake = lake
+        self.table = table
+        self.exchange = exchange
+        self.instruments = instruments
+        self.idx = [columns.index(c) for c in ['ts'] + TABLES[table]]
+        if instruments is not None:
+            self.keyIdx = [columns.index('instrument_id')]
+        elif exchange is not None:
+            self.keyIdx = [columns.index('symbol')]
+        else:
+            self.keyIdx = [columns.index('exchange'), columns.index('symbol')]
+
+    def _names(self, key):
+        if self.instruments is not None:
+            return self.instruments.name(key[0])
+        if self.exchange is not None:
+            return self.exchange, key[0]
+        return key
+
+    def beforeFlush(self, writer, cursor, rows):
+        pass
+
+    def afterFlush(self, writer, cursor, rows):
+        bySymbol = {}
+        for r in rows:
+            bySymbol.setdefault(tuple([r[i] for i in self.keyIdx]), []).append([r[i] for i in self.idx])
+        for key, symbolRows in bySymbol.items():
+            exchange, symbol = self._names(key)
+            a = np.array(symbolRows, dtype = np.float64)
+            self.lake.write(self.table, exchange, symbol, a[:, 0],
+                            {c: a[:, i + 1] for i, c in enumerate(TABLES[self.table])})
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    if args[:1] == ['compact']:
+        print('Compacted', BarLake(args[1]).compact(*args[2:3]), 'month directories')
@@ -0,0 +1,131 @@
+"""Columnar bar container.
+
+A BarSeries keeps bars as one NumPy array per column: int64 close timestamps in
+seconds and float64 prices and volume. It only becomes a DataFrame when
+toDataFrame is called.
+
+Lookups by timestamp are binary searches on ts, and slices and between() return
+BarSeries whose arrays are views of the original, so nothing is copied.
+Timestamps may be given as seconds, datetimes or pd.Timestamps.
+"""
+import datetime
+import numpy as np
+import pandas as pd
+
+FIELDS = ('ts', 'open', 'high', 'low', 'close', 'volume')
+
+
+def toSeconds(ts):
+    """Returns ts (seconds, datetime, pd.Timestamp or an array of them) as int64 epoch seconds."""
+    if isinstance(ts, (int, float, np.integer, np.floating)):
+        return int(ts)
+    if isinstance(ts, (pd.Timestamp, datetime.datetime)):
+        ts = pd.Timestamp(ts)
+        if ts.tz is None:
+            ts = ts.tz_localize('UTC')
+        return int(ts.timestamp())
+    if isinstance(ts, pd.DatetimeIndex):
+        index = ts
+        if index.tz is None:
+            index = index.tz_localize('UTC')
+        return np.asarray((index - pd.Timestamp(0, tz = 'UTC')) // pd.Timedelta(seconds = 1), dtype = np.int64)
+    a = np.asarray(ts)
+    if a.dtype.kind in 'iuf':
+        return a.astype(np.int64)
+    index = pd.DatetimeIndex(a)
+    if index.tz is None:
+        index = index.tz_localize('UTC')
+    return np.asarray((index - pd.Timestamp(0, tz = 'UTC')) // pd.Timedelta(seconds = 1), dtype = np.int64)
+
+
+class BarSeries:
+    """Bars of one symbol in ts order, struct of arrays."""
+    __slots__ = FIELDS
+
+    def __init__(self, ts, open, high, low, close, volume):
+        self.ts = np.asarray(ts, dtype = np.int64)
+        self.open = np.asarray(open, dtype = np.float64)
+        self.high = np.asarray(high, dtype = np.float64)
+        self.low = np.asarray(low, dtype = np.float64)
+        self.close = np.asarray(close, dtype = np.float64)
+        self.volume = np.asarray(volume, dtype = np.float64)
+
+    @classmethod
+    def empty(cls):
+        return cls(*[[]] * len(FIELDS))
+
+    @classmethod
+    def fromDict(cls, bars):
+        """Builds a BarSeries from readBarsDB's {ts: (ts, o, h, l, c, v)}."""
+        if not bars:
+            return cls.empty()
+        a = np.array([bars[ts] for ts in sorted(bars)], dtype = np.float64)
+        return cls(a[:, 0], *a[:, 1:].T)
+
+    def __len__(self):
+        return len(self.ts)
+
+    def __getitem__(self, i):
+        """A slice returns a BarSeries of views; an int returns the bar as (ts, o, h, l, c, v)."""
+        if isinstance(i, slice):
+            return BarSeries(*[getattr(self, f)[i] for f in FIELDS])
+        return tuple([getattr(self, f)[i].item() for f in FIELDS])
+
+    def __contains__(self, ts):
+        t = toSeconds(ts)
+        i = np.searchsorted(self.ts, t)
+        return i < len(self.ts) and self.ts[i] == t
+
+    def index(self, ts):
+        """Returns the position of the bar at exactly ts. Raises KeyError if there is none."""
+        t = toSeconds(ts)
+        i = int(np.searchsorted(self.ts, t))
+        if i == len(self.ts) or self.ts[i] != t:
+            raise KeyError(ts)
+        return i
+
+    def at(self, ts):
+        """Returns the bar at exactly ts as (ts, o, h, l, c, v), like a value of readBarsDB's dict."""
+        return self[self.index(ts)]
+
+    def asofIndex(self, ts):
+        """Returns the position of the last bar at or before each ts, -1 where there is none.
+        ts may be a scalar or an array."""
+        return np.searchsorted(self.ts, toSeconds(ts), side = 'right') - 1
+
+    def asof(self, ts, tolerance = None):
+        """Returns the last bar at or before ts as (ts, o, h, l, c, v), or None if there is none
+        or it is more than tolerance seconds older than ts."""
+        i = int(self.asofIndex(ts))
+        if i < 0 or (tolerance is not None and toSeconds(ts) - self.ts[i] > tolerance):
+            return None
+        return self[i]
+
+    def between(self, a, b):
+        """Returns the bars with a <= ts <= b as a BarSeries of views."""
+        lo = np.searchsorted(self.ts, toSeconds(a), side = 'left')
+        hi = np.searchsorted(self.ts, toSeconds(b), side = 'right')
+        return self[lo:hi]
+
+    @property
+    def nbytes(self):
+        """Bytes held by the column arrays; views report the size of what they show."""
+        return sum([getattr(self, f).nbytes for f in FIELDS])
+
+    def memoryReport(self):
+        perBar = sum([getattr(self, f).itemsize for f in FIELDS])
+        return '{} bars, {:.1f} MB, {:.1f} MB per million bars'.format(len(self), self.nbytes / 2 ** 20,
+                                                                       perBar * 10 ** 6 / 2 ** 20)
+
+    def __repr__(self):
+        if not len(self):
+            return 'BarSeries(0 bars)'
+        return 'BarSeries({} bars, {} to {})'.format(len(self), pd.Timestamp(self.ts[0], unit = 's', tz = 'UTC'),
+                                                     pd.Timestamp(self.ts[-1], unit = 's', tz = 'UTC'))
+
+    def toDataFrame(self):
+        """Returns a df with columns O, H, L, C, V indexed by ts, as readBarsDB_pd does."""
+        index = pd.to_datetime(self.ts, unit = 's', utc = True)
+        index.name = 'ts'
+        return pd.DataFrame({'O': self.open, 'H': self.high, 'L': self.low, 'C': self.close, 'V': self.volume},
+                            index = index)
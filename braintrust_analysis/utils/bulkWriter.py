@@ -0,0 +1,110 @@
+"""Batched write path for bars and funding rows.
+
+A BulkWriter buffers parsed rows for one table and writes them in batches, one
+transaction per batch. On SQLite the database is switched to WAL mode and each
+batch is a single executemany. On MySQL a batch is streamed as CSV through LOAD
+DATA LOCAL INFILE, falling back to executemany (which the connector sends as one
+multi-row INSERT) if the server does not allow local infile.
+
+With upsert set, a row that collides with a unique key replaces the stored row:
+INSERT OR REPLACE on SQLite, INSERT ... ON DUPLICATE KEY UPDATE or LOAD DATA ...
+REPLACE on MySQL. Re-fetching overlapping pages is then harmless.
+"""
+import csv, os, sqlite3, tempfile, time
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class BulkWriter:
+    """Buffers rows for table and writes them batchSize rows at a time.
+
+    conn -- sqlite3 or mysql.connector connection.
+    columns -- column names, in row order. None to insert every column of the table in order
+               (SQLite only).
+    upsert -- replace stored rows that collide with a unique key instead of failing.
+    loadData -- use LOAD DATA LOCAL INFILE on MySQL. The connection needs allow_local_infile=True.
+    hooks -- objects with beforeFlush(writer, cursor, rows) and afterFlush(writer, cursor, rows),
+             called around each batch inside its transaction (see watermarks.WatermarkHook).
+    """
+    def __init__(self, conn, table, columns = None, batchSize = 10000, upsert = True, loadData = True,
+                 hooks = ()):
+        self.conn = conn
+        self.table = table
+        self.columns = columns
+        self.batchSize = batchSize
+        self.upsert = upsert
+        self.hooks = list(hooks)
+        self.isSqlite = isinstance(conn, sqlite3.Connection)
+        self.loadData = loadData and not self.isSqlite and columns is not None
+        self.rows = []
+        self.written = 0
+        self.elapsed = 0.0
+        if self.isSqlite:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+
+    def _insertSql(self):
+        p = '?' if self.isSqlite else '%s'
+        cols = ' (' + ', '.join(self.columns) + ')' if self.columns else ''
+        n = len(self.columns) if self.columns else len(self.rows[0])
+        verb = 'INSERT OR REPLACE' if self.upsert and self.isSqlite else 'INSERT'
+        sql = verb + ' INTO ' + self.table + cols + ' VALUES (' + ', '.join([p] * n) + ')'
+        if self.upsert and not self.isSqlite:
+            sql += ' ON DUPLICATE KEY UPDATE ' + ', '.join([c + ' = VALUES(' + c + ')' for c in self.columns])
+        return sql
+
+    def add(self, rows):
+        """Buffers rows (a list of tuples), flushing once batchSize rows are waiting."""
+        self.rows.extend(rows)
+        if len(self.rows) >= self.batchSize:
+            self.flush()
+
+    def flush(self):
+        """Writes all buffered rows in one transaction. Returns the number of rows written."""
+        if not self.rows:
+            return 0
+        rows = self.rows
+        st = time.perf_counter()
+        cursor = self.conn.cursor()
+        try:
+            for hook in self.hooks:
+                hook.beforeFlush(self, cursor, rows)
+            if self.loadData:
+                try:
+                    self._loadData(cursor, rows)
+                except Exception as e:
+                    logger.info('LOAD DATA LOCAL INFILE failed (%s); using executemany', e)
+                    self.conn.rollback()
+                    self.loadData = False
+            if not self.loadData:
+                cursor.executemany(self._insertSql(), rows)
+            for hook in self.hooks:
+                hook.afterFlush(self, cursor, rows)
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+        self.rows = []
+        self.written += len(rows)
+        self.elapsed += time.perf_counter() - st
+        return len(rows)
+
+    def _loadData(self, cursor, rows):
+        f = tempfile.NamedTemporaryFile('w', suffix = '.csv', newline = '', delete = False)
+        try:
+            with f:
+                csv.writer(f, lineterminator = '\n').writerows(rows)
+            sql = ("LOAD DATA LOCAL INFILE %s " + ('REPLACE' if self.upsert else '') + " INTO TABLE " + self.table +
+                   " FIELDS TERMINATED BY ',' OPTIONALLY ENCLOSED BY '\"' LINES TERMINATED BY '\\n' (" +
+                   ', '.join(self.columns) + ")")
+            cursor.execute(sql, (f.name,))
+        finally:
+            os.remove(f.name)
+
+    def rate(self):
+        """Rows/s spent writing, excluding the time rows waited in the buffer."""
+        return self.written / self.elapsed if self.elapsed > 0 else 0.0
+
+    def report(self):
+        return '{}: {} rows written, {:.0f} rows/s'.format(self.table, self.written, self.rate())
@@ -0,0 +1,91 @@
+"""Read latency benchmarks for bars_1_min and perpfunding.
+
+The default benchmark times the readers' query for 1-day, 1-month and
+full-history ranges of one symbol, once as the server plans it and once with the
+secondary indexes ignored, which is the plan the table had before the covering
+indexes were added. The EXPLAIN of each query shows the partitions and index it
+uses.
+
+The readers benchmark reads a symbol's full history with each of the readers in
+fetchBars_sql and reports time and peak Python memory.
+
+    python dbBench.py [symbol] [exchange] [repeats]
+    python dbBench.py readers [symbol] [exchange] [repeats]
+"""
+import sys, time, tracemalloc
+import fetchBars_sql
+
+BARS_SQL = """SELECT ts, open, high, low, close, volume FROM bars_1_min {hint}
+              WHERE instrument_id = %s AND ts > %s AND ts < %s ORDER BY ts"""
+FUNDING_SQL = """SELECT ts, value FROM perpfunding {hint}
+                 WHERE instrument_id = %s AND ts > %s AND ts < %s ORDER BY ts"""
+SPANS = [('1 day', 24 * 60 * 60), ('1 month', 30 * 24 * 60 * 60), ('full', None)]
+
+
+def _secondaryIndexes(cursor, table):
+    cursor.execute("""SELECT DISTINCT INDEX_NAME FROM information_schema.STATISTICS
+                      WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND INDEX_NAME != 'PRIMARY'""", (table,))
+    return [r[0] for r in cursor.fetchall()]
+
+def _time(cursor, sql, params, repeats):
+    """Returns the median latency in ms and the number of rows."""
+    times = []
+    for _ in range(repeats):
+        st = time.perf_counter()
+        cursor.execute(sql, params)
+        n = len(cursor.fetchall())
+        times.append((time.perf_counter() - st) * 1000)
+    times.sort()
+    return times[len(times) // 2], n
+
+def _explain(cursor, sql, params):
+    cursor.execute("EXPLAIN " + sql, params)
+    cols = [d[0] for d in cursor.description]
+    r = dict(zip(cols, cursor.fetchall()[0]))
+    return 'partitions={} key={} rows={} extra={}'.format(r.get('partitions'), r.get('key'), r.get('rows'),
+                                                          r.get('Extra'))
+
+def benchmark(symbol = 'BTCUSDT', exchange = 'binance', repeats = 5):
+    cursor = fetchBars_sql.connbars.cursor(buffered = True)
+    latest = fetchBars_sql.bDateRange(symbol, exchange)[1]
+    for table, template in [('bars_1_min', BARS_SQL), ('perpfunding', FUNDING_SQL)]:
+        indexes = _secondaryIndexes(cursor, table)
+        plans = [('indexed', '')]
+        if indexes:
+            plans.append(('no index', 'IGNORE INDEX (' + ', '.join(indexes) + ')'))
+        print(table, symbol, exchange)
+        for name, span in SPANS:
+            startTS = 0 if span is None else latest - span
+            params = (fetchBars_sql.instruments.id(exchange, symbol), startTS, latest + 1)
+            for plan, hint in plans:
+                sql = template.format(hint = hint)
+                ms, n = _time(cursor, sql, params, repeats)
+                print('  {:8} {:9} {:10.2f} ms {:9} rows  {}'.format(name, plan, ms, n, _explain(cursor, sql, params)))
+
+READERS = [('readBarsDB', lambda s, e: fetchBars_sql.readBarsDB(s, e)),
+           ('readBarsDB_pd', lambda s, e: fetchBars_sql.readBarsDB_pd(s, e, cache = False)),
+           ('readBarsDB_np', lambda s, e: fetchBars_sql.readBarsDB_np(s, e)),
+           ('readBarsDB_np + df', lambda s, e: fetchBars_sql.readBarsDB_np(s, e).toDataFrame())]
+
+def benchmarkReaders(symbol = 'XBTUSD', exchange = 'bitmex', repeats = 3):
+    print('full history of', symbol, exchange)
+    for name, read in READERS:
+        times = []
+        for _ in range(repeats):
+            st = time.perf_counter()
+            n = len(read(symbol, exchange))
+            times.append(time.perf_counter() - st)
+        tracemalloc.start()
+        read(symbol, exchange)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        times.sort()
+        print('  {:20} {:9} bars {:8.2f} s {:9.1f} MB peak'.format(name, n, times[len(times) // 2], peak / 2 ** 20))
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    if args[:1] == ['readers']:
+        benchmarkReaders(*args[1:3], *[int(a) for a in args[3:4]])
+    else:
+        benchmark(*args[:2], *[int(a) for a in args[2:3]])
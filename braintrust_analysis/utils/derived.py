@@ -0,0 +1,65 @@
+"""Registry of series derived from bars and funding.
+
+Each entry computes its series over a ts range from inputs read by fetchBars_sql
+(see _DerivedInputs there). fetchBars_sql.updateDerived stores the values in
+derived_series and afterwards computes only the values after the last stored
+ts: entries that need history before it declare a lookback in seconds, and
+cumulative entries continue from the last stored value, passed in as prev.
+readDerived serves the stored series like fetchFundingData.
+
+New entries are plain functions decorated with register().
+"""
+
+#8 hour funding periods in a year
+PERIODS_PER_YEAR = 3 * 365
+#bitmex index each perp's basis is taken against
+BASIS_INDEX = {'XBTUSD': '.BXBT', 'ETHUSD': '.BETH'}
+
+DERIVED = {}
+
+
+class Derived:
+    __slots__ = ('name', 'compute', 'lookback')
+
+    def __init__(self, name, compute, lookback):
+        self.name = name
+        self.compute = compute
+        self.lookback = lookback
+
+
+def register(name, lookback = 0):
+    """Registers compute(inputs, symbol, startTS, prev) as the derived series name.
+
+    compute returns a pd.Series indexed by ts of the values with ts > startTS, computed
+    from inputs read from startTS - lookback on. prev is the last stored (ts, value), None
+    if nothing is stored yet."""
+    def wrap(compute):
+        DERIVED[name] = Derived(name, compute, lookback)
+        return compute
+    return wrap
+
+@register('funding_apr')
+def fundingApr(inputs, symbol, startTS, prev):
+    """Each funding rate compounded over a year, (1 + rate) ^ (3 * 365) - 1."""
+    return (1 + inputs.funding(symbol, startTS)) ** PERIODS_PER_YEAR - 1
+
+@register('funding_sum')
+def fundingSum(inputs, symbol, startTS, prev):
+    """Funding summed from the first funding event."""
+    return inputs.funding(symbol, startTS).cumsum() + (prev[1] if prev else 0.0)
+
+@register('funding_mean_7d', lookback = 7 * 24 * 60 * 60)
+def fundingMean7d(inputs, symbol, startTS, prev):
+    """Mean of the funding rates of the last 7 days."""
+    return inputs.funding(symbol, startTS).rolling('7D').mean()
+
+@register('basis')
+def basis(inputs, symbol, startTS, prev):
+    """Perp close over the close of its index, less one, at every minute both have a bar."""
+    return (inputs.close(symbol, startTS) / inputs.close(BASIS_INDEX[symbol], startTS) - 1).dropna()
+
+@register('predicted_funding')
+def predictedFunding(inputs, symbol, startTS, prev):
+    """Funding implied by the bitmex interest and premium indices of a perp such as XBTUSD
+    (readFundingComponents' F)."""
+    return inputs.components(symbol[:3], symbol[3:], startTS)['F'].dropna()
@@ -1,8 +1,64 @@
 import sqlite3, datetime, time, requests, dateutil, numpy as np
 #import matplotlib.pyplot as plt
 import pandas as pd
+from transport import getTransport
+from bulkWriter import BulkWriter
+from resample import resampleBars
+import watermarks
+from barLake import BarLake, LakeHook
+import atexit
 
 connbars = sqlite3.connect('../market-data-sqlite/barsDb.db')
+watermarks.ensureTable(connbars)
+
+#one buffered writer per table; anything that reads back what was written calls flushWrites() first
+writers = {}
+#set by useLake; readBarsDB_pd and fetchFundingData then read from it instead of the database
+lake = None
+lakeMirror = False
+
+def _columns(tb):
+    #bar tables are named after their exchange; perpfunding has an exchange column
+    if tb == 'perpfunding':
+        return ['exchange', 'symbol', 'ts', 'value']
+    return ['ts', 'symbol', 'open', 'high', 'low', 'close', 'volume']
+
+def _lakeHook(tb):
+    if tb == 'perpfunding':
+        return LakeHook(lake, 'funding', _columns(tb))
+    return LakeHook(lake, 'bars', _columns(tb), tb)
+
+def _writer(tb):
+    if not tb in writers:
+        hooks = [watermarks.WatermarkHook(tb, _columns(tb), None if tb == 'perpfunding' else tb)]
+        if lakeMirror:
+            hooks.append(_lakeHook(tb))
+        writers[tb] = BulkWriter(connbars, tb, hooks = hooks)
+    return writers[tb]
+
+def useLake(root = '~/braintrust-lake', mirror = True):
+    """Makes readBarsDB_pd and fetchFundingData read bars and funding from the Parquet lake at root
+    (see barLake). With mirror, every batch the writers store is also written to it."""
+    global lake, lakeMirror
+    lake = BarLake(root)
+    lakeMirror = mirror
+    for tb, w in writers.items():
+        w.hooks = [h for h in w.hooks if not isinstance(h, LakeHook)]
+        if mirror:
+            w.hooks.append(_lakeHook(tb))
+    return lake
+
+def flushWrites():
+    """Writes all buffered rows."""
+    for w in writers.values():
+        w.flush()
+
+def writeReport():
+    """Prints write throughput per table."""
+    for w in writers.values():
+        print(w.report())
+
+atexit.register(flushWrites)
 
 def timestampToDate(ts):
     """Returns a datetime object for the ts - whichis assumed to be in UTC time."""
@@ -12,14 +68,10 @@ def timestampToDate(ts):
 
 def bDateRange(s, tb = 'binance'):
     """Returns the earliest, latest timestamps for the symbol. """
-    cursor = connbars.cursor()
-    
-    sql = """SELECT ts FROM """ + tb + """ WHERE symbol = ? ORDER BY ts"""
-    cursor.execute(sql, (s,))
-    r = cursor.fetchall()
-    if r:
-        earliest = r[0][0]
-        latest = r[-1][0]
+    flushWrites()
+    w = watermarks.readWatermark(connbars.cursor(), True, tb, tb, s)
+    if w:
+        earliest, latest = w[0], w[1]
     else:
         earliest = 0
         latest = int(datetime.datetime(2019, 1, 1).timestamp())
@@ -27,9 +79,7 @@ def bDateRange(s, tb = 'binance'):
     return earliest, latest
         
 def writeBarsToMex(bars, symbol):    
-    cursor = connbars.cursor()
-    
-    sql = """INSERT OR IGNORE INTO bitmex VALUES (?,?,?,?,?,?,?)"""
+    rows = []
     for b in bars:
         try:
             ts = dateutil.parser.parse(b['timestamp'])
@@ -39,17 +89,16 @@ def writeBarsToMex(bars, symbol):
             l = float(b['low'])
             c = float(b['close'])
             v = float(b['volume'])
-            cursor.execute(sql, (ts, symbol, o, h, l, c, v))
+            rows.append((ts, symbol, o, h, l, c, v))
         except:
             pass
-    connbars.commit()
+    _writer('bitmex').add(rows)
     
 def writeBarsToGDAX(bars, symbol):
-    cursor = connbars.cursor()
     
     # bar format = [timestamp, low, high, open, close, volume ]
     
-    sql = """INSERT OR IGNORE INTO gdax VALUES (?,?,?,?,?,?,?)"""
+    rows = []
     for b in bars:
         try:
             ts = b[0]
@@ -58,10 +107,10 @@ def writeBarsToGDAX(bars, symbol):
             l = float(b[1])
             c = float(b[4])
             v = float(b[5])
-            cursor.execute(sql, (ts, symbol, o, h, l, c, v))
+            rows.append((ts, symbol, o, h, l, c, v))
         except:
             pass
-    connbars.commit()    
+    _writer('gdax').add(rows)
     
     
 def writeBarsToB(bars, symbol, tb = "binance"):    
@@ -81,9 +130,7 @@ def writeBarsToB(bars, symbol, tb = "binance"):
                 "17928899.62484339" // Ignore
               ]
     """
-    cursor = connbars.cursor()
-    
-    sql = """INSERT OR IGNORE INTO """ + tb + """ VALUES (?,?,?,?,?,?,?)"""
+    rows = []
     for b in bars:
         ts = round(b[6]/1000)
         o = float(b[1])
@@ -91,8 +138,8 @@ def writeBarsToB(bars, symbol, tb = "binance"):
         l = float(b[3])
         c = float(b[4])
         v = float(b[5])
-        cursor.execute(sql, (ts, symbol, o, h, l, c, v))
-    connbars.commit()   
+        rows.append((ts, symbol, o, h, l, c, v))
+    _writer(tb).add(rows)
     
 def writeBarsToFunding(bars, symbol, exchange):    
     """Bars is an array of:
@@ -104,14 +151,8 @@ def writeBarsToFunding(bars, symbol, exchange):
                 {...}
             ]      
     """
-    cursor = connbars.cursor()
-    
-    sql = """INSERT OR IGNORE INTO perpfunding VALUES (?,?,?,?)"""
-    for b in bars:
-        ts = round(b['fundingTime']/1000)
-        rate = float(b['fundingRate'])
-        cursor.execute(sql, (exchange, b['symbol'], ts, rate))
-    connbars.commit()        
+    _writer('perpfunding').add([(exchange, b['symbol'], round(b['fundingTime']/1000), float(b['fundingRate']))
+                                for b in bars])
     
 def fetchBinanceSyms(b, symbolList = ['ETHBTC', 'XRPBTC', 'LTCBTC', 'ADABTC', 'BCCBTC']):
     """Fetches 1m bars for symbolList. If symbolList is empty, fetches all binance symbols with 'BTC' in the name. """ 
@@ -138,6 +179,7 @@ def fetchBinanceSyms(b, symbolList = ['ETHBTC', 'XRPBTC', 'LTCBTC', 'ADABTC', 'B
             startTime = endTime 
             endTime = endTime + 499 * 60
             time.sleep(2)    
+    flushWrites()
             
 def fetchBinanceSymsFutures(b, symbolList):
     """Fetches 1m bars for symbolList."""
@@ -163,6 +205,7 @@ def fetchBinanceSymsFutures(b, symbolList):
             startTime = int(r[-1][0]/1000)
             endTime = startTime + 1499 * 60
             time.sleep(2)                
+    flushWrites()
             
 def fetchBinanceFunding(b, symbolList ):
     """Fetches funding data, from binance, for symbols in symbolList. """ 
@@ -189,6 +232,7 @@ def fetchBinanceFunding(b, symbolList ):
             startTime = endTime 
             endTime = startTime + EIGHT_HOURS * 1000
             time.sleep(2)    
+        flushWrites()
         print("Done fetching funding info for",s,"Samples fetched:", samples_fetched)
         
 def fetchBitmexFunding(symbolList):
@@ -209,7 +253,7 @@ def fetchBitmexFunding(symbolList):
         blnDone = False
         while datetime.datetime.fromisoformat(startTime[:-1]) < datetime.datetime.fromisoformat(currentTime[:-1]) and not blnDone:
             params = {'symbol': symbol, 'startTime' : startTime}
-            r = requests.get(baseURI + endpoint, params = params)
+            r = getTransport().get(baseURI + endpoint, params = params)
             r = r.json()
             samples_fetched += len(r)
             #convert to binance format
@@ -223,23 +267,14 @@ def fetchBitmexFunding(symbolList):
             writeBarsToFunding(res, symbol, "bitmex")
             startTime = r[-1]["timestamp"]
             time.sleep(2)    
+        flushWrites()
         print("Done fetching funding info for",symbol,"Samples fetched:", samples_fetched)
     
 def fundingDateRange(s, exchange):
     """Returns the earliest, latest timestamps for the symbol and exchange. Returns (0, 0) if no entry in db."""
-    cursor = connbars.cursor()
-    
-    sql = """SELECT ts FROM perpfunding WHERE symbol = ? AND exchange = ? ORDER BY ts"""
-    cursor.execute(sql, (s,exchange))
-    r = cursor.fetchall()
-    if r:
-        earliest = r[0][0]
-        latest = r[-1][0]
-    else:
-        earliest = 0
-        latest = 0
-        
-    return earliest, latest
+    flushWrites()
+    w = watermarks.readWatermark(connbars.cursor(), True, exchange, 'perpfunding', s)
+    return (w[0], w[1]) if w else (0, 0)
     
 def fetchMexSymbols(symbolList = ['XBTZ18', 'ADAM18', 'BCHM18', 'ETHM18', 'XRPM18', 'LTCM18', 'XBTUSD', 'XBTM18', 'XBTU18', 'XBTZ18']):   
     """Fetches bars from bitmex."""
@@ -259,11 +294,11 @@ def fetchMexSymbols(symbolList = ['XBTZ18', 'ADAM18', 'BCHM18', 'ETHM18', 'XRPM1
         else:
             binsize = '1m'
         params = {'binSize': binsize, 'symbol': symbol, 'count' : 1, 'start' : 0, 'reverse': 'false'}
-        r = requests.get(baseURI + endpoint, params = params)
+        r = getTransport().get(baseURI + endpoint, params = params)
         r = r.json()
         bitmexEarliest = r[0]['timestamp']          
         params = {'binSize': binsize, 'symbol': symbol, 'count' : 1, 'start' : 0, 'reverse': 'true'}
-        r = requests.get(baseURI + endpoint, params = params)
+        r = getTransport().get(baseURI + endpoint, params = params)
         r = r.json()
         bitmexLatest = r[0]['timestamp']
         
@@ -282,17 +317,18 @@ def fetchMexSymbols(symbolList = ['XBTZ18', 'ADAM18', 'BCHM18', 'ETHM18', 'XRPM1
                 
         while dateutil.parser.parse(latestDB + 'Z').timestamp() < dateutil.parser.parse(bitmexLatest).timestamp():
             params = {'binSize': binsize, 'symbol': symbol, 'count' : 300, 'startTime' : latestDB}
-            r = requests.get(baseURI + endpoint, params = params)
+            r = getTransport().get(baseURI + endpoint, params = params)
             try:
                 r = r.json()
                 writeBarsToMex(r, symbol)
-                earliestTs, latestTS = bDateRange(symbol, tb = 'bitmex')
+                latestTS = max(latestTS, int(dateutil.parser.parse(r[-1]['timestamp']).timestamp()))
                 latestDB = misc.timestampToDate(latestTS).isoformat()
                 if '+' in latestDB:
                     latestDB = latestDB[:latestDB.find('+')]            
             except:
                 pass
             time.sleep(2)
+    flushWrites()
             
 def fetchGDAXSymbols(symbolList = ['ETH-USD']):    
     print('Updating gdax symbols.')  
@@ -317,12 +353,13 @@ def fetchGDAXSymbols(symbolList = ['ETH-USD']):
             prevEnd = end
             if bars:
                 writeBarsToGDAX(bars, symbol)
-                earliestTs, latestTS = bDateRange(symbol, tb = 'gdax')
+                latestTS = max(latestTS, max(bar[0] for bar in bars))
                 print('{} bars fetched. Latest date is {}'.format(len(bars), misc.timestampToDate(latestTS).isoformat()))
             else:
                 latestTS = end
                 print('Zero bars fetched. Latest date is {}'.format(misc.timestampToDate(end).isoformat()))
             time.sleep(1)    
+    flushWrites()
                         
             
 def readBarsDB(symbol, exchange = 'binance', startTS = None, endTS = None):
@@ -349,35 +386,6 @@ def readBarsDB(symbol, exchange = 'binance', startTS = None, endTS = None):
         
     return bars
 
-def resampleBars(df, barSize):
-    """Valid barSizes are 5, 10, 30, 60."""
-    if not (barSize == 5 or barSize == 10 or barSize == 30 or barSize == 60):
-        raise ValueError('Error in resampleBars - unsupported bar size.')
-    
-    blnStarted = False
-    bars = []
-    Os = df['O'].values; Hs = df['H'].values; Ls = df['L'].values
-    Cs = df['C'].values; Vs = df['V'].values; TSs = df.index
-    i = 0
-    while i < len(Os):
-        if TSs[i].minute % barSize == 0:
-            if not blnStarted:
-                blnStarted = True
-            else:
-                bar = {'O': O[0], 'H' : max(H), 'L' : min(L),
-                       'C': C[-1], 'V' : sum(V), 'ts': T[-1]}
-                bars.append(bar)
-            O = [Os[i]]; H= [Hs[i]]; L=[Ls[i]]; C=[Cs[i]]; V= [Vs[i]]; T= [TSs[i]]
-        elif blnStarted:
-            O.append(Os[i]); H.append(Hs[i]); L.append(Ls[i])
-            C.append(Cs[i]); V.append(Vs[i]); T.append(TSs[i])
-        i += 1
-            
-    df = pd.DataFrame(bars)
-    df.set_index('ts', inplace = True)
-    return df
-    
-
 def readBarsDB_pd(symbol, exchange = 'binance', startTS = None, endTS = None, barSize = 1):
     """Reads bars for 'symbol' from the database. Returns pandas df with columns O, H, L, C, V, indexed by ts
     
@@ -385,7 +393,9 @@ def readBarsDB_pd(symbol, exchange = 'binance', startTS = None, endTS = None, ba
     
     Reads all bars if startTS, endTS are None.
     
-    barSize can return 5min (5), 10, 30, 60 min bars."""
+    barSize is minutes or a pandas offset string ('4h', '1D'); see resample.resampleBars.
+    
+    After useLake, bars are read from the lake instead."""
     
     if startTS == None:
         startTS = 0
@@ -395,6 +405,9 @@ def readBarsDB_pd(symbol, exchange = 'binance', startTS = None, endTS = None, ba
         endTS = time.time()
     else:
         endTS = endTS.timestamp()
+    if lake is not None:
+        df = lake.readBars(symbol, exchange, startTS, endTS)
+        return df if barSize == 1 else resampleBars(df, barSize)
         
 
     sql = "SELECT ts, open, high, low, close, volume FROM " + exchange + " WHERE symbol = ? AND ts > ? and ts < ? ORDER BY ts"
@@ -408,46 +421,17 @@ def readBarsDB_pd(symbol, exchange = 'binance', startTS = None, endTS = None, ba
 
     return df   
 
-def fetchFundingBars(startTS = None, endTS = None):
-    if startTS == None:
-        startTS = 0
-    else:
-        startTS = startTS.timestamp()
-    if endTS == None:
-        endTS = time.time()
-    else:
-        endTS = endTS.timestamp()
-        
-    sql = "SELECT ts, close FROM bitmex WHERE symbol = ? AND ts > ? and ts < ? ORDER BY ts"
-    df = pd.read_sql(sql, connbars, params = (".XBTBON8H", startTS, endTS), index_col = 'ts', parse_dates = {'ts': {'unit':'s', 'utc': True}})
-    df.columns = ['IBI']        
-    df = df.loc[~df.index.duplicated(keep='first')]
-    
-    sql = "SELECT ts, close FROM bitmex WHERE symbol = ? AND ts > ? and ts < ? ORDER BY ts"
-    df2 = pd.read_sql(sql, connbars, params = (".USDBON8H", startTS, endTS), index_col = 'ts', parse_dates = {'ts': {'unit':'s', 'utc': True}})
-    df2.columns = ['IQI']     
-    df2 = df2.loc[~df2.index.duplicated(keep='first')]
-    
-    sql = "SELECT ts, close FROM bitmex WHERE symbol = ? AND ts > ? and ts < ? ORDER BY ts"
-    df3 = pd.read_sql(sql, connbars, params = (".XBTUSDPI", startTS, endTS), index_col = 'ts', parse_dates = {'ts': {'unit':'s', 'utc': True}})
-    df3.columns = ['P1M']   
-    df3 = df3.loc[~df3.index.duplicated(keep='first')]
-    
-    sql = "SELECT ts, close FROM bitmex WHERE symbol = ? AND ts > ? and ts < ? ORDER BY ts"
-    df4 = pd.read_sql(sql, connbars, params = (".XBTUSDPI8H", startTS, endTS), index_col = 'ts', parse_dates = {'ts': {'unit':'s', 'utc': True}})
-    df4.columns = ['P8H']  
-    df4 = df4.loc[~df4.index.duplicated(keep='first')]
-    
-    #s = set.intersection(set(df.index), set(df2.index), set(df3.index), set(df4.index))
-    
-    #Todo - build a dictionary with an entry for each date in s.
-    
-    df5 = pd.concat([df, df2, df4, df3], axis = 1, ignore_index=True)
-    df5 = df5.rename({0:'IBI', 1:'IQI', 2:'P1M', 3:'P8H'}, axis = 'columns')
-
-    return df5
+#bitmex indices behind funding; {b} is the base currency, {q} the quote currency
+FUNDING_COMPONENTS = [('IBI', '.{b}BON8H'), ('IQI', '.{q}BON8H'), ('P1M', '.{b}{q}PI'), ('P8H', '.{b}{q}PI8H')]
+#bitmex clamps the interest rate component of funding to the premium +/- 0.05%
+FUNDING_CLAMP = 0.0005
 
-def fetchFundingBarsEth(startTS = None, endTS = None):
+def readFundingComponents(base = 'XBT', startTS = None, endTS = None, quote = 'USD', predicted = False):
+    """Reads the bitmex interest and premium indices of base in one query. Returns a df with columns
+    IBI, IQI (base and quote 8h interest), P1M and P8H (premium index, per minute and 8h), indexed by ts.
+    
+    startTS, endTS are datetimes. With predicted, adds F, the funding rate the indices imply:
+    F = P8H + clamp(I - P8H, -0.05%, 0.05%) with I = IQI - IBI."""
     if startTS == None:
         startTS = 0
     else:
@@ -457,33 +441,29 @@ def fetchFundingBarsEth(startTS = None, endTS = None):
     else:
         endTS = endTS.timestamp()
         
-    sql = "SELECT ts, close FROM bitmex WHERE symbol = ? AND ts > ? and ts < ? ORDER BY ts"
-    df = pd.read_sql(sql, connbars, params = (".ETHBON8H", startTS, endTS), index_col = 'ts', parse_dates = {'ts': {'unit':'s', 'utc': True}})
-    df.columns = ['IBI'] 
-    df = df.loc[~df.index.duplicated(keep='first')]
-    
-    sql = "SELECT ts, close FROM bitmex WHERE symbol = ? AND ts > ? and ts < ? ORDER BY ts"
-    df2 = pd.read_sql(sql, connbars, params = (".USDBON8H", startTS, endTS), index_col = 'ts', parse_dates = {'ts': {'unit':'s', 'utc': True}})
-    df2.columns = ['IQI']     
-    df2 = df2.loc[~df2.index.duplicated(keep='first')]
-    
-    sql = "SELECT ts, close FROM bitmex WHERE symbol = ? AND ts > ? and ts < ? ORDER BY ts"
-    df3 = pd.read_sql(sql, connbars, params = (".ETHUSDPI", startTS, endTS), index_col = 'ts', parse_dates = {'ts': {'unit':'s', 'utc': True}})
-    df3.columns = ['P1M']       
-    df3 = df3.loc[~df3.index.duplicated(keep='first')]
-    
-    sql = "SELECT ts, close FROM bitmex WHERE symbol = ? AND ts > ? and ts < ? ORDER BY ts"
-    df4 = pd.read_sql(sql, connbars, params = (".ETHUSDPI8H", startTS, endTS), index_col = 'ts', parse_dates = {'ts': {'unit':'s', 'utc': True}})
-    df4.columns = ['P8H']   
-    df4 = df4.loc[~df4.index.duplicated(keep='first')]
+    nameOf = {symbol.format(b = base, q = quote): name for name, symbol in FUNDING_COMPONENTS}
+    sql = ("SELECT ts, symbol, close FROM bitmex WHERE symbol IN (" + ", ".join(["?"] * len(nameOf)) +
+           ") AND ts > ? and ts < ?")
+    df = pd.read_sql(sql, connbars, params = tuple(nameOf) + (startTS, endTS))
+    df['symbol'] = df['symbol'].map(nameOf)
+    df = df.drop_duplicates(['ts', 'symbol']).pivot(index = 'ts', columns = 'symbol', values = 'close')
+    df = df.reindex(columns = [name for name, symbol in FUNDING_COMPONENTS]).sort_index()
+    df.index = pd.to_datetime(df.index.values.astype(np.int64), unit = 's', utc = True)
+    df.index.name = 'ts'
+    df.columns.name = None
+    if predicted:
+        premium = df['P8H']
+        df['F'] = premium + (df['IQI'] - df['IBI'] - premium).clip(-FUNDING_CLAMP, FUNDING_CLAMP)
+    return df
     
-    df5 = pd.concat([df, df2, df4, df3], axis = 1, ignore_index=True)
-    df5 = df5.rename({0:'IBI', 1:'IQI', 2:'P1M', 3:'P8H'}, axis = 'columns')
+def fetchFundingBars(startTS = None, endTS = None):
+    return readFundingComponents('XBT', startTS, endTS)
 
-    return df5
+def fetchFundingBarsEth(startTS = None, endTS = None):
+    return readFundingComponents('ETH', startTS, endTS)
 
 def fetchFundingData(symbol, exchange, startTS = None, endTS = None):
-    """Fetch funding data from the 'perpFunding' table."""
+    """Fetch funding data from the 'perpFunding' table, or from the lake after useLake."""
     if startTS == None:
         startTS = 0
     else:
@@ -492,6 +472,8 @@ def fetchFundingData(symbol, exchange, startTS = None, endTS = None):
         endTS = time.time()
     else:
         endTS = endTS.timestamp()
+    if lake is not None:
+        return lake.readFunding(symbol, exchange, startTS, endTS)
         
     sql = "SELECT ts, value FROM perpfunding WHERE symbol = ? AND exchange = ? AND ts > ? and ts < ? ORDER BY ts"
     df = pd.read_sql(sql, connbars, params = (symbol, exchange, startTS, endTS), index_col = 'ts', parse_dates = {'ts': {'unit':'s', 'utc': True}})
@@ -500,17 +482,16 @@ def fetchFundingData(symbol, exchange, startTS = None, endTS = None):
     return df
 
 def ma(v, period):
-    """Returns a moving average version of hte list v."""
-    v2 = v[:]
-    runSum = 0.0
-    for idx, x in enumerate(v):
-        runSum += x
-        if idx >= period:
-            runSum = runSum - v[idx - period]
-            v2[idx] = runSum / period
-        else:
-            v2[idx] = runSum / (idx + 1)
-    return v2
+    """Returns a moving average version of hte list v: the mean of the last period values, or of
+    all of them for the first period - 1. See rolling.sma; v may be a list, array or Series."""
+    try:
+        import rolling
+    except ImportError:
+        from braintrust_analysis import rolling
+    v2 = rolling.sma(v, period, 1)
+    if isinstance(v, pd.Series):
+        return pd.Series(v2, index = v.index, name = v.name)
+    return v2 if isinstance(v, np.ndarray) else v2.tolist()
 
 def fetchAll(b, exchange = 'b'):
     if exchange == 'b':
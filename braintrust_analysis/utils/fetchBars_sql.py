@@ -1,10 +1,94 @@
-import time, sqlite3, datetime, time, requests, dateutil, numpy as np, pytz
+import time, sqlite3, datetime, time, requests, dateutil, numpy as np, pytz, itertools, os
 import pandas as pd
 import mysql.connector
+import backfill
+from transport import getTransport
+from Binance import binanceRateLimits
+from threading import Lock
+from bulkWriter import BulkWriter
+from resample import resampleBars, barSeconds
+from barSeries import BarSeries, toSeconds
+import watermarks
+from instruments import Instruments
+from resultCache import ResultCache
+from seriesStore import SeriesStore
+from barLake import BarLake, LakeHook, BAR_NAMES
+import barFile
+import rollups
+import derived
+import atexit
 
 connbars = mysql.connector.connect(user='jupyter', password='password',
                               host='127.0.0.1',
-                              database='jupyter')
+                              database='jupyter', allow_local_infile=True)
+
+#writers buffer rows; anything that reads back what was written calls flushWrites() first
+#and ingest_watermark is updated in the same transaction as each batch
+instruments = Instruments(connbars)
+barsColumns = ['ts', 'instrument_id', 'open', 'high', 'low', 'close', 'volume']
+fundingColumns = ['instrument_id', 'ts', 'value']
+barsWriter = BulkWriter(connbars, 'bars_1_min', barsColumns,
+                        hooks = [watermarks.WatermarkHook('bars_1_min', barsColumns, instruments = instruments),
+                                 rollups.RollupHook(barsColumns)])
+fundingWriter = BulkWriter(connbars, 'perpfunding', fundingColumns,
+                           hooks = [watermarks.WatermarkHook('perpfunding', fundingColumns, instruments = instruments)])
+derivedColumns = ['name', 'instrument_id', 'ts', 'value']
+derivedWriter = BulkWriter(connbars, 'derived_series', derivedColumns)
+
+def flushWrites():
+    """Writes all buffered bars and funding rows."""
+    barsWriter.flush()
+    fundingWriter.flush()
+    derivedWriter.flush()
+
+def writeReport():
+    """Prints write throughput for bars and funding rows."""
+    print(barsWriter.report())
+    print(fundingWriter.report())
+
+atexit.register(flushWrites)
+
+#results of readBarsDB_pd and fetchFundingData, checked against ingest_watermark on every read
+resultCache = ResultCache(os.path.expanduser('~/.cache/braintrust-analysis'))
+
+#full histories kept as local column files, topped up by readHistory and readFundingHistory
+seriesStore = SeriesStore(os.path.expanduser('~/.cache/braintrust-analysis/series'))
+
+#one fixed-width bar file per exchange and symbol, kept by syncBarFile and opened by loadBarFile
+BAR_FILES = os.path.expanduser('~/.cache/braintrust-analysis/bars')
+
+#set by useLake; readBarsDB_pd and fetchFundingData then read from it instead of the database
+lake = None
+
+def useLake(root = '~/braintrust-lake', mirror = True):
+    """Makes readBarsDB_pd and fetchFundingData read bars and funding from the Parquet lake at root
+    (see barLake). With mirror, every batch barsWriter and fundingWriter store is also written to it."""
+    global lake
+    lake = BarLake(root)
+    for w in (barsWriter, fundingWriter):
+        w.hooks = [h for h in w.hooks if not isinstance(h, LakeHook)]
+    if mirror:
+        barsWriter.hooks.append(LakeHook(lake, 'bars', barsColumns, instruments = instruments))
+        fundingWriter.hooks.append(LakeHook(lake, 'funding', fundingColumns, instruments = instruments))
+    return lake
+
+def exportToLake(symbols, exchange, chunk = 500000):
+    """Copies the bars and funding of symbols from the database into lake, then compacts it."""
+    for s in symbols:
+        for a in iterBars(s, exchange, chunk = chunk, asNumpy = True):
+            lake.write('bars', exchange, s, a['ts'], {BAR_NAMES[f]: a[f] for f in 'OHLCV'})
+        funding = _fetchFundingData(s, exchange, None, None)
+        if len(funding):
+            lake.write('funding', exchange, s, toSeconds(funding.index), {'value': funding['fund_rate'].values})
+        print('Exported', s, 'to', lake.root)
+    lake.compact()
+
+#BitMEX allows 30 unauthenticated requests a minute
+mexRateLimits = binanceRateLimits([{'rateLimitType': 'REQUEST_WEIGHT', 'interval': 'MINUTE', 'intervalNum': 1,
+                                    'limit': 30}], Lock())
+#GDAX allows 3 public requests a second
+gdaxRateLimits = binanceRateLimits([{'rateLimitType': 'REQUEST_WEIGHT', 'interval': 'SECOND', 'intervalNum': 1,
+                                     'limit': 3}], Lock())
 
 def timestampToDate(ts):
     """Returns a datetime object for the ts - whichis assumed to be in UTC time."""
@@ -13,47 +97,115 @@ def timestampToDate(ts):
     return aware_utc_dt
 
 def bDateRange(s, exchange = 'binance'):
-    """Returns the earliest, latest timestamps for the symbol. Values are timestamps."""
-    cursor = connbars.cursor()
-    
-    sql = """SELECT MAX(ts) from bars_1_min WHERE symbol = %s AND exchange = %s ORDER BY ts"""
-    cursor.execute(sql, (s, exchange ))
-    r = cursor.fetchall()
-    latest = r[0][0]
-    
-    sql = """SELECT MIN(ts) from bars_1_min WHERE symbol = %s AND exchange = %s ORDER BY ts"""
-    cursor.execute(sql, (s, exchange ))
-    r = cursor.fetchall()
-    earliest = r[0][0]    
-    
-    if latest:
-        return earliest, latest
+    """Returns the earliest, latest timestamps for the symbol. Values are timestamps.
+    Reads ingest_watermark, so it costs one primary key lookup however many bars are stored."""
+    flushWrites()
+    w = watermarks.readWatermark(connbars.cursor(), False, exchange, 'bars_1_min', s)
+    if w:
+        return w[0], w[1]
     else:
         #symbol not in db, start downloading from 1/1/2019
         return 0, int(datetime.datetime(2019, 1, 1).timestamp())
         
-def writeBarsToMex(bars, symbol, exchange = "bitmex"):    
+def backfillProgress(s, exchange):
+    """Returns the watermark of an unfinished sharded backfill of the symbol, or None.
+    Every bar with ts at or below the watermark has been written."""
+    cursor = connbars.cursor()
+    sql = """SELECT watermark FROM backfill_progress WHERE symbol = %s AND exchange = %s"""
+    cursor.execute(sql, (s, exchange))
+    r = cursor.fetchall()
+    return r[0][0] if r else None
+
+def setBackfillProgress(s, exchange, watermark):
+    flushWrites()    #the watermark must never be ahead of the bars in the table
+    cursor = connbars.cursor()
+    sql = """INSERT INTO backfill_progress (exchange, symbol, watermark) VALUES (%s, %s, %s)
+             ON DUPLICATE KEY UPDATE watermark = VALUES(watermark)"""
+    cursor.execute(sql, (exchange, s, int(watermark)))
+    connbars.commit()
+
+def clearBackfillProgress(s, exchange):
+    flushWrites()
+    cursor = connbars.cursor()
+    cursor.execute("""DELETE FROM backfill_progress WHERE symbol = %s AND exchange = %s""", (s, exchange))
+    connbars.commit()
+
+def _resumePoint(s, exchange):
+    """Returns bDateRange for the symbol after undoing an interrupted sharded backfill:
+    bars above its watermark may have gaps, so they are deleted and latest becomes the watermark."""
+    earliest, latest = bDateRange(s, exchange)
+    watermark = backfillProgress(s, exchange)
+    if watermark is not None:
+        instrumentId = instruments.id(exchange, s, create = True)
+        cursor = connbars.cursor()
+        sql = """DELETE FROM bars_1_min WHERE instrument_id = %s AND ts > %s"""
+        cursor.execute(sql, (instrumentId, watermark))
+        cursor.execute("DELETE FROM bars_rollup WHERE instrument_id = %s AND ts > %s", (instrumentId, watermark))
+        rollups.refresh(cursor, instrumentId, watermark, watermark)
+        connbars.commit()
+        watermarks.recompute(connbars, False, 'bars_1_min', s, exchange, {'instrument_id': instrumentId})
+        clearBackfillProgress(s, exchange)
+        print('Resuming interrupted backfill of', s, 'from', timestampToDate(watermark))
+        if earliest != 0 and watermark >= earliest:
+            latest = watermark
+        else:
+            earliest, latest = bDateRange(s, exchange)
+    return earliest, latest
+
+def extendBarPartitions(monthsAhead = 3):
+    """Splits the pmax partition of bars_1_min so that monthly partitions exist up to monthsAhead
+    months past the current one. Cheap while pmax is empty; does nothing if the table is not partitioned."""
     cursor = connbars.cursor()
+    sql = """SELECT PARTITION_DESCRIPTION FROM information_schema.PARTITIONS
+             WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'bars_1_min' AND PARTITION_NAME IS NOT NULL"""
+    cursor.execute(sql)
+    bounds = [int(r[0]) for r in cursor.fetchall() if r[0] != 'MAXVALUE']
+    if not bounds:
+        return
+    start = timestampToDate(max(bounds))
+    now = datetime.datetime.utcnow()
+    last = now.year * 12 + now.month - 1 + monthsAhead
+    year, month = start.year, start.month
+    parts = []
+    while year * 12 + month - 1 <= last:
+        nextYear, nextMonth = (year + 1, 1) if month == 12 else (year, month + 1)
+        bound = int(datetime.datetime(nextYear, nextMonth, 1, tzinfo = pytz.utc).timestamp())
+        parts.append("PARTITION p{:04d}{:02d} VALUES LESS THAN ({})".format(year, month, bound))
+        year, month = nextYear, nextMonth
+    if parts:
+        parts.append("PARTITION pmax VALUES LESS THAN MAXVALUE")
+        cursor.execute("ALTER TABLE bars_1_min REORGANIZE PARTITION pmax INTO (" + ", ".join(parts) + ")")
+
+def _addWindowJobs(engine, key, s, exchange, startTS, endTS, windowDays, pages, write):
+    """Splits the bars with ts in (startTS, endTS] into windows of windowDays that are fetched as
+    separate jobs. pages(a, z) returns the pages of one window. Until every window is written,
+    backfill_progress holds the end of the completed prefix of windows."""
+    windows = backfill.splitRange(startTS, endTS, windowDays * 24 * 60 * 60)
+    if not windows:
+        return
+    tracker = backfill.WindowTracker(windows)
+    setBackfillProgress(s, exchange, startTS)
+    print(s, 'split into', len(windows), 'windows of', windowDays, 'days')
     
-    #sql = """INSERT INTO bars_1_min (ts, symbol, exchange, open, high, low, close, volume) VALUES (%s, %s, %s, %s, %s, %s, %s, %s)"""
-    sql = "INSERT INTO bars_1_min (ts, symbol, exchange, open, high, low, close, volume) VALUES "
-    x =  " (%s, %s, %s, %s, %s, %s, %s, %s),"
-    sql = sql + x * len(bars)
-    sql = sql[:-1]   #remove trailing comma
+    def onDone(i):
+        if tracker.complete(i):
+            if tracker.finished:
+                clearBackfillProgress(s, exchange)
+            else:
+                setBackfillProgress(s, exchange, tracker.watermark)
+            
+    for i, (a, z) in enumerate(windows):
+        engine.add(key, lambda a=a, z=z: pages(a, z), write, lambda i=i: onDone(i))
+        
+def writeBarsToMex(bars, symbol, exchange = "bitmex"):    
+    instrumentId = instruments.id(exchange, symbol, create = True)
     r = []    
     for b in bars:
         ts = dateutil.parser.parse(b['timestamp'])
         ts = int(ts.timestamp())
-        r.append(ts)
-        r.append(symbol)
-        r.append(exchange)
-        r.append(float(b['open']))
-        r.append(float(b['high']))
-        r.append(float(b['low']))
-        r.append(float(b['close']))
-        r.append(float(b['volume']))
-    cursor.execute(sql, tuple(r))   
-    connbars.commit()
+        r.append((ts, instrumentId, float(b['open']), float(b['high']), float(b['low']),
+                  float(b['close']), float(b['volume'])))
+    barsWriter.add(r)
     
    
     
@@ -74,24 +226,13 @@ def writeBarsToB(bars, symbol, exchange = "binance"):
                 "17928899.62484339" // Ignore
               ]
     """
-    cursor = connbars.cursor()
-    
-    sql = "INSERT INTO bars_1_min (ts, symbol, exchange, open, high, low, close, volume) VALUES "
-    x =  " (%s, %s, %s, %s, %s, %s, %s, %s),"
-    sql = sql + x * len(bars)
-    sql = sql[:-1]   #remove trailing comma
+    instrumentId = instruments.id(exchange, symbol, create = True)
     r = []
     for b in bars:
-        r.append(round(b[6]/1000))   #ts
-        r.append(symbol)   
-        r.append(exchange)   
-        r.append(float(b[1]))        #o
-        r.append(float(b[2]))        #h
-        r.append(float(b[3]))        #l
-        r.append(float(b[4]))        #c
-        r.append(float(b[5]))        #v
-    cursor.execute(sql, tuple(r))    
-    connbars.commit()   
+        #ts, instrument_id, o, h, l, c, v
+        r.append((round(b[6]/1000), instrumentId, float(b[1]), float(b[2]), float(b[3]),
+                  float(b[4]), float(b[5])))
+    barsWriter.add(r)
     
 def writeBarsToFunding(bars, symbol, exchange):    
     """Bars is an array of:
@@ -103,14 +244,8 @@ def writeBarsToFunding(bars, symbol, exchange):
                 {...}
             ]      
     """
-    cursor = connbars.cursor()
-    
-    sql = """INSERT INTO perpfunding (exchange, symbol, ts, value) VALUES (%s,%s,%s,%s)"""
-    for b in bars:
-        ts = round(b['fundingTime']/1000)
-        rate = float(b['fundingRate'])
-        cursor.execute(sql, (exchange, b['symbol'], ts, rate))
-    connbars.commit()        
+    fundingWriter.add([(instruments.id(exchange, b['symbol'], create = True), round(b['fundingTime']/1000),
+                        float(b['fundingRate'])) for b in bars])
     
 def fetchBinanceSyms(b, symbolList = ['ETHBTC', 'XRPBTC', 'LTCBTC', 'ADABTC', 'BCCBTC']):
     """Fetches 1m bars for symbolList. If symbolList is empty, fetches all binance symbols with 'BTC' in the name. """ 
@@ -136,63 +271,102 @@ def fetchBinanceSyms(b, symbolList = ['ETHBTC', 'XRPBTC', 'LTCBTC', 'ADABTC', 'B
             print(s, ' bars downloaded - latest date is: ', timestampToDate(endTime), 'Number:', len(r))
             startTime = endTime 
             endTime = endTime + 499 * 60
-            time.sleep(2)    
+    flushWrites()
             
-def fetchBinanceSymsFutures(b, symbolList):
-    """Fetches 1m bars for symbolList."""
-    currentTime = time.time() - 1
+def _runEngine(engine):
+    """Runs a backfill engine and writes out whatever its jobs left in the write buffers."""
+    try:
+        engine.run()
+    finally:
+        flushWrites()
+        writeReport()
+
+def _binanceCall(call, *args):
+    """Calls a binance method; its rate limiter waits for budget, so errors returned by the exchange are raised."""
+    r = call(*args)
+    if isinstance(r, dict):
+        raise RuntimeError('Binance error: ' + str(r))
+    return r
+
+def _futuresBarPages(b, s, startTime, endTime):
+    """Yields pages of 1m futures bars for s opening from startTime (a timestamp) until endTime."""
+    while startTime < endTime:
+        r = _binanceCall(b.getBarDataFutures, s, startTime, endTime)
+        r = [x for x in r if x[0]/1000 < endTime]
+        if not r:
+            return
+        yield r
+        startTime = int(r[-1][0]/1000) + 60
+
+def _fundingPages(b, s, startTime, currentTime):
+    """Yields pages of funding rates for s from startTime (a timestamp) until currentTime."""
+    while startTime < currentTime:
+        r = _binanceCall(b.getFundingRateHistory, s, startTime, currentTime)
+        if not r:
+            return
+        yield r
+        startTime = int(r[-1]['fundingTime']/1000) + 1
+
+def _addFuturesBarJobs(engine, b, symbolList, currentTime, windowDays = None):
     for s in symbolList:
-        print('Starting download of future symbol: ', s, ' from Binance.')
-        earliest, latest = bDateRange(s, "binance")
+        earliest, latest = _resumePoint(s, "binance")
         if earliest == 0:
-            print("No previous funding data for this exchange and symbol")
+            print('No previous entry for future symbol', s, 'in the db')
             startTime = 0
-            endTime = currentTime
+            if windowDays:
+                #windows need a real start, so ask for the first bars the exchange has
+                first = _binanceCall(b.getBarDataFutures, s, 0, currentTime)
+                if not first:
+                    continue
+                startTime = int(first[0][0]/1000)
         else:
             startTime = latest
-            endTime = startTime + 1499 * 60        
-        if earliest != 0:
-            print('Esimated total number of bars to download: ', int((currentTime - startTime)/60) ) 
+            print('Esimated total number of bars to download for', s, ':', int((currentTime - startTime)/60))
+        write = lambda r, s=s: writeBarsToB(r, s, "binance")
+        if windowDays:
+            _addWindowJobs(engine, ('klines', s), s, "binance", startTime, currentTime, windowDays,
+                           lambda a, z, s=s: _futuresBarPages(b, s, a, z), write)
         else:
-            print('No previous entry for the symbol in the db')
-        while startTime < currentTime:
-            r = b.getBarDataFutures(s, startTime, endTime)
-            writeBarsToB(r, s, "binance")
-            print(s, ' bars downloaded - latest date is: ', timestampToDate(r[-1][0]/1000), 'Number:', len(r))
-            startTime = int(r[-1][0]/1000)
-            endTime = startTime + 1499 * 60
-            time.sleep(2)                
+            engine.add(('klines', s), lambda s=s, t=startTime: _futuresBarPages(b, s, t, currentTime), write)
             
-def fetchBinanceFunding(b, symbolList ):
-    """Fetches funding data, from binance, for symbols in symbolList. """ 
-    
-    EIGHT_HOURS = 60 * 60 * 8
-    currentTime = time.time() - 1
+def _addFundingJobs(engine, b, symbolList, currentTime):
     for s in symbolList:
-        samples_fetched = 0
-        print('Starting download of funding data for symbol: ', s, ' from Binance.')
         earliest, latest = fundingDateRange(s, "binance")
         if earliest == 0:
-            print("No previous funding data for this exchange and symbol")
+            print("No previous funding data for", s)
             startTime = 0
-            endTime = currentTime
         else:
-            startTime = latest
-            endTime = currentTime
-        print('Estimated number of bars to download: ', int((currentTime - startTime)/(3600*8) )) 
-        while startTime < currentTime:
-            r = b.getFundingRateHistory(s, startTime, endTime)
-            samples_fetched += len(r)
-            writeBarsToFunding(r, s, "binance")
-            print(s, ' funding bars downloaded - latest date is: ', timestampToDate(endTime), 'Number:', len(r))
-            startTime = endTime 
-            endTime = startTime + EIGHT_HOURS * 1000
-            time.sleep(2)    
-        print("Done fetching funding info for",s,"Samples fetched:", samples_fetched)
+            startTime = latest + 1
+            print('Estimated number of funding rates to download for', s, ':', int((currentTime - startTime)/(3600*8)))
+        engine.add(('funding', s), lambda s=s, t=startTime: _fundingPages(b, s, t, currentTime),
+                   lambda r, s=s: writeBarsToFunding(r, s, "binance"))
+
+def fetchBinanceSymsFutures(b, symbolList, maxWorkers = 8, windowDays = None):
+    """Fetches 1m bars for symbolList. Symbols are fetched concurrently by maxWorkers threads.
+    
+    If windowDays is set, the missing range of each symbol is also split into windows of
+    that many days which are fetched in parallel. Use it for deep first-time backfills."""
+    engine = backfill.BackfillEngine(maxWorkers)
+    _addFuturesBarJobs(engine, b, symbolList, time.time() - 1, windowDays)
+    _runEngine(engine)
+
+def fetchBinanceFunding(b, symbolList, maxWorkers = 8):
+    """Fetches funding data, from binance, for symbols in symbolList. Symbols are fetched concurrently."""
+    engine = backfill.BackfillEngine(maxWorkers)
+    _addFundingJobs(engine, b, symbolList, time.time() - 1)
+    _runEngine(engine)
+
+def fetchBinanceFutures(b, symbolList, maxWorkers = 8, windowDays = None):
+    """Fetches 1m bars and funding data for symbolList, running both streams for all symbols at once.
+    windowDays is as for fetchBinanceSymsFutures."""
+    currentTime = time.time() - 1
+    engine = backfill.BackfillEngine(maxWorkers)
+    _addFundingJobs(engine, b, symbolList, currentTime)
+    _addFuturesBarJobs(engine, b, symbolList, currentTime, windowDays)
+    _runEngine(engine)
         
 def fetchBitmexFunding(symbolList):
-    """Fetches funding data, from bitmex, for symbols in symbolList. """ 
-    baseURI = "https://www.bitmex.com/api/v1"
+    """Fetches funding data, from bitmex, for symbols in symbolList. Requests are paced by mexRateLimits.""" 
     endpoint = "/funding"   
     currentTime = datetime.datetime.now().isoformat() + "Z"
     for symbol in symbolList:
@@ -208,8 +382,7 @@ def fetchBitmexFunding(symbolList):
         blnDone = False
         while datetime.datetime.fromisoformat(startTime[:-1]) < datetime.datetime.fromisoformat(currentTime[:-1]) and not blnDone:
             params = {'symbol': symbol, 'startTime' : startTime}
-            r = requests.get(baseURI + endpoint, params = params)
-            r = r.json()
+            r = _mexGet(endpoint, params)
             samples_fetched += len(r)
             #convert to binance format
             res = []
@@ -221,30 +394,74 @@ def fetchBitmexFunding(symbolList):
             if len(res) < 2: blnDone = True
             writeBarsToFunding(res, symbol, "bitmex")
             startTime = r[-1]["timestamp"]
-            time.sleep(2)    
+        flushWrites()
         print("Done fetching funding info for",symbol,"Samples fetched:", samples_fetched)
     
 def fundingDateRange(s, exchange):
     """Returns the earliest, latest timestamps for the symbol and exchange. Returns (0, 0) if no entry in db."""
-    cursor = connbars.cursor()
+    flushWrites()
+    w = watermarks.readWatermark(connbars.cursor(), False, exchange, 'perpfunding', s)
+    return (w[0], w[1]) if w else (0, 0)
     
-    sql = """SELECT ts FROM perpfunding WHERE symbol = %s AND exchange = %s ORDER BY ts"""
-    cursor.execute(sql, (s,exchange))
-    r = cursor.fetchall()
-    if r:
-        earliest = r[0][0]
-        latest = r[-1][0]
-    else:
-        earliest = 0
-        latest = 0
+def _mexGet(endpoint, params):
+    """GET from the bitmex api under mexRateLimits. Returns the parsed json.
+    Failed requests are retried here rather than by the transport, so each attempt waits for budget."""
+    def attempt():
+        while True:
+            mexRateLimits.acquire('REQUESTS', 1)
+            r = getTransport().get("https://www.bitmex.com/api/v1" + endpoint, params = params, retries = 0)
+            if not mexRateLimits.checkResponse(r):
+                return r
+    r = getTransport().retrying('GET', attempt).json()
+    if isinstance(r, dict) and 'error' in r:
+        raise RuntimeError('Bitmex error: ' + str(r['error']))
+    return r
         
-    return earliest, latest
+def _mexTime(ts):
+    return timestampToDate(ts).strftime('%Y-%m-%dT%H:%M:%S.000Z')
+    
+def _mexBarPages(symbol, binsize, startTS, endTS):
+    """Yields pages of bitmex bars for symbol with timestamps in (startTS, endTS]."""
+    step = 3600 if binsize == '1h' else 60
+    while startTS < endTS:
+        params = {'binSize': binsize, 'symbol': symbol, 'count' : 300,
+                  'startTime' : _mexTime(startTS + step), 'endTime': _mexTime(endTS)}
+        r = _mexGet("/trade/bucketed", params)
+        if not r:
+            return
+        yield r
+        startTS = int(dateutil.parser.parse(r[-1]['timestamp']).timestamp())
+
+def _fetchMexSymbolsSharded(symbolList, windowDays, maxWorkers):
+    engine = backfill.BackfillEngine(maxWorkers)
+    for symbol in symbolList:
+        binsize = '1h' if '8H' in symbol or '2H' in symbol else '1m'
+        step = 3600 if binsize == '1h' else 60
+        params = {'binSize': binsize, 'symbol': symbol, 'count' : 1, 'start' : 0, 'reverse': 'false'}
+        bitmexEarliest = int(dateutil.parser.parse(_mexGet("/trade/bucketed", params)[0]['timestamp']).timestamp())
+        params['reverse'] = 'true'
+        bitmexLatest = int(dateutil.parser.parse(_mexGet("/trade/bucketed", params)[0]['timestamp']).timestamp())
+        
+        earliestTs, latestTS = _resumePoint(symbol, 'bitmex')
+        startTS = latestTS if earliestTs != 0 else 0
+        startTS = max(startTS, bitmexEarliest - step)
+        print('Estimated number of', symbol, 'bars to fetch is ', int((bitmexLatest - startTS) / step))
+        _addWindowJobs(engine, ('bars', symbol), symbol, 'bitmex', startTS, bitmexLatest, windowDays,
+                       lambda a, z, symbol=symbol, binsize=binsize: _mexBarPages(symbol, binsize, a, z),
+                       lambda r, symbol=symbol: writeBarsToMex(r, symbol))
+    _runEngine(engine)
+    
+def fetchMexSymbols(symbolList = ['XBTZ18', 'ADAM18', 'BCHM18', 'ETHM18', 'XRPM18', 'LTCM18', 'XBTUSD', 'XBTM18', 'XBTU18', 'XBTZ18'],
+                    windowDays = None, maxWorkers = 8):   
+    """Fetches bars from bitmex.
     
-def fetchMexSymbols(symbolList = ['XBTZ18', 'ADAM18', 'BCHM18', 'ETHM18', 'XRPM18', 'LTCM18', 'XBTUSD', 'XBTM18', 'XBTU18', 'XBTZ18']):   
-    """Fetches bars from bitmex."""
+    If windowDays is set, the missing range of each symbol, back to the first bar bitmex has,
+    is split into windows of that many days that maxWorkers threads fetch in parallel."""
     print('Updating bitmex symbols.')  
+    if windowDays:
+        _fetchMexSymbolsSharded(symbolList, windowDays, maxWorkers)
+        return
 
-    baseURI = "https://www.bitmex.com/api/v1"
     endpoint = "/trade/bucketed" 
     for symbol in symbolList:
         print('Fetching data for', symbol,' from bitmex.')
@@ -254,16 +471,14 @@ def fetchMexSymbols(symbolList = ['XBTZ18', 'ADAM18', 'BCHM18', 'ETHM18', 'XRPM1
         else:
             binsize = '1m'
         params = {'binSize': binsize, 'symbol': symbol, 'count' : 1, 'start' : 0, 'reverse': 'false'}
-        r = requests.get(baseURI + endpoint, params = params)
-        r = r.json()
+        r = _mexGet(endpoint, params)
         bitmexEarliest = r[0]['timestamp']          
         params = {'binSize': binsize, 'symbol': symbol, 'count' : 1, 'start' : 0, 'reverse': 'true'}
-        r = requests.get(baseURI + endpoint, params = params)
-        r = r.json()
+        r = _mexGet(endpoint, params)
         bitmexLatest = r[0]['timestamp']
         
         
-        earliestTs, latestTS = bDateRange(symbol, exchange = 'bitmex')
+        earliestTs, latestTS = _resumePoint(symbol, 'bitmex')
         latestDB = timestampToDate(latestTS).isoformat()
         if latestDB < bitmexEarliest:
             latestDB = bitmexEarliest
@@ -277,13 +492,12 @@ def fetchMexSymbols(symbolList = ['XBTZ18', 'ADAM18', 'BCHM18', 'ETHM18', 'XRPM1
         currentTS = dateutil.parser.parse(latestDB + 'Z').timestamp()
         while currentTS < dateutil.parser.parse(bitmexLatest).timestamp():
             params = {'binSize': binsize, 'symbol': symbol, 'count' : 300, 'startTime' : latestDB}
-            r = requests.get(baseURI + endpoint, params = params)
-            r = r.json()
+            r = _mexGet(endpoint, params)
             writeBarsToMex(r, symbol)
             latestDB = r[-1]['timestamp']
             currentTS = dateutil.parser.parse(latestDB).timestamp()
             print(symbol, "Bars fetched:", len(r), "Latest date:", latestDB)
-            time.sleep(2)
+    flushWrites()
             
 def fetchGDAXSymbols(symbolList = ['ETH-USD']):    
     print('Updating gdax symbols.')  
@@ -292,7 +506,7 @@ def fetchGDAXSymbols(symbolList = ['ETH-USD']):
     for symbol in symbolList:
         print('Fetching data for', symbol,' from GDAX.')
         
-        earliestTs, latestTS = bDateRange(symbol, tb = 'gdax')
+        earliestTs, latestTS = bDateRange(symbol, 'gdax')
         stopTime = time.time() - 60
         
         prevEnd = 0
@@ -303,16 +517,16 @@ def fetchGDAXSymbols(symbolList = ['ETH-USD']):
                 end += 600; start += 600
             startISO = misc.timestampToDate(start).isoformat()
             endISO = misc.timestampToDate(end).isoformat()
+            gdaxRateLimits.acquire('REQUESTS', 1)
             bars = gdax.getHistoricBars(symbol, startISO, endISO, 60)
             prevEnd = end
             if bars:
                 writeBarsToGDAX(bars, symbol)
-                earliestTs, latestTS = bDateRange(symbol, tb = 'gdax')
+                latestTS = max(latestTS, max(bar[0] for bar in bars))
                 print('{} bars fetched. Latest date is {}'.format(len(bars), timestampToDate(latestTS).isoformat()))
             else:
                 latestTS = end
                 print('Zero bars fetched. Latest date is {}'.format(timestampToDate(end).isoformat()))
-            time.sleep(1)    
                         
             
 def readBarsDB(symbol, exchange = 'binance', startTS = None, endTS = None):
@@ -329,8 +543,8 @@ def readBarsDB(symbol, exchange = 'binance', startTS = None, endTS = None):
         endTS = int(time.time()) 
        
     bars = {} 
-    sql = """SELECT ts, open, high, low, close, volume FROM bars_1_min WHERE symbol = %s AND exchange = %s and ts > %s and ts < %s ORDER BY ts"""
-    cursor.execute(sql, (symbol, exchange, int(startTS), int(endTS)))
+    sql = """SELECT ts, open, high, low, close, volume FROM bars_1_min WHERE instrument_id = %s and ts > %s and ts < %s ORDER BY ts"""
+    cursor.execute(sql, (instruments.id(exchange, symbol), int(startTS), int(endTS)))
     res = cursor.fetchall()
     if res:
         for r in res:
@@ -339,63 +553,318 @@ def readBarsDB(symbol, exchange = 'binance', startTS = None, endTS = None):
         
     return bars
 
-def resampleBars(df, barSize):
-    """Valid barSizes are 5, 10, 30, 60."""
-    if not (barSize == 5 or barSize == 10 or barSize == 30 or barSize == 60):
-        raise ValueError('Error in resampleBars - unsupported bar size.')
-    
-    blnStarted = False
-    bars = []
-    Os = df['O'].values; Hs = df['H'].values; Ls = df['L'].values
-    Cs = df['C'].values; Vs = df['V'].values; TSs = df.index
-    i = 0
-    while i < len(Os):
-        if TSs[i].minute % barSize == 0:
-            if not blnStarted:
-                blnStarted = True
-            else:
-                bar = {'O': O[0], 'H' : max(H), 'L' : min(L),
-                       'C': C[-1], 'V' : sum(V), 'ts': T[-1]}
-                bars.append(bar)
-            O = [Os[i]]; H= [Hs[i]]; L=[Ls[i]]; C=[Cs[i]]; V= [Vs[i]]; T= [TSs[i]]
-        elif blnStarted:
-            O.append(Os[i]); H.append(Hs[i]); L.append(Ls[i])
-            C.append(Cs[i]); V.append(Vs[i]); T.append(TSs[i])
-        i += 1
+def readBarsDB_np(symbol, exchange = 'binance', startTS = None, endTS = None, batch = 50000):
+    """Reads bars for 'symbol' with startTS < ts < endTS into a BarSeries.
+    
+    Rows are streamed with fetchmany and copied batch by batch into preallocated column arrays
+    with np.fromiter, so no per-row Python objects outlive their batch and no DataFrame is built.
+    The arrays are sized from the symbol's row count in ingest_watermark, or the number of minutes
+    in the range if that is fewer, and grown if needed."""
+    if startTS == None:
+        startTS = 0
+    if endTS == None:
+        endTS = time.time()
+    w = watermarks.readWatermark(connbars.cursor(), False, exchange, 'bars_1_min', symbol)
+    minutes = int(endTS - startTS) // 60 + 1
+    capacity = max(min(w[2] if w else 0, minutes), 1)
+    cols = np.empty((6, capacity))
             
-    df = pd.DataFrame(bars)
-    df.set_index('ts', inplace = True)
+    sql = """SELECT ts, open, high, low, close, volume FROM bars_1_min WHERE instrument_id = %s and ts > %s and ts < %s ORDER BY ts"""
+    cursor = connbars.cursor()
+    cursor.execute(sql, (instruments.id(exchange, symbol), int(startTS), int(endTS)))
+    n = 0
+    while True:
+        rows = cursor.fetchmany(batch)
+        if not rows:
+            break
+        k = len(rows)
+        if n + k > capacity:
+            capacity = max(2 * capacity, n + k)
+            grown = np.empty((6, capacity))
+            grown[:, :n] = cols[:, :n]
+            cols = grown
+        cols[:, n:n + k] = np.fromiter(itertools.chain.from_iterable(rows), dtype = np.float64, count = 6 * k).reshape(k, 6).T
+        n += k
+    if n < capacity // 2:
+        #the BarSeries views would keep the whole buffer alive
+        cols = cols[:, :n].copy()
+    return BarSeries(cols[0, :n], *cols[1:, :n])
+
+def _aggregateRowsSql(instrumentIds, startTS, endTS, secs, label):
+    """Aggregates the 1 minute bars of instrumentIds into bars of secs in the database. Returns rows
+    (instrument_id, k, first ts, last ts, o, h, l, c, v) ordered by instrument_id and bucket k.
+    Rows are grouped on ts DIV secs, or on its ceiling for label 'right'/'left', and open and close
+    come from the bars at MIN(ts) and MAX(ts) of each group, read through the (instrument_id, ts) key."""
+    if label not in ('last', 'right', 'left'):
+        raise ValueError("label must be 'last', 'right' or 'left'")
+    if label == 'last':
+        bucket = "ts DIV " + str(secs)
+    else:
+        bucket = "(ts + " + str(secs - 1) + ") DIV " + str(secs)
+    sql = """SELECT g.instrument_id, g.k, g.first, g.last, o.open, g.high, g.low, c.close, g.volume FROM
+               (SELECT instrument_id, """ + bucket + """ AS k, MIN(ts) AS first, MAX(ts) AS last, MAX(high) AS high,
+                       MIN(low) AS low, SUM(volume) AS volume
+                FROM bars_1_min WHERE instrument_id IN (""" + ", ".join(["%s"] * len(instrumentIds)) + """)
+                AND ts > %s AND ts < %s GROUP BY instrument_id, k) g
+             JOIN bars_1_min o ON o.instrument_id = g.instrument_id AND o.ts = g.first
+             JOIN bars_1_min c ON c.instrument_id = g.instrument_id AND c.ts = g.last
+             ORDER BY g.instrument_id, g.k"""
+    cursor = connbars.cursor()
+    cursor.execute(sql, tuple(instrumentIds) + (int(startTS), int(endTS)))
+    return cursor.fetchall()
+
+def _aggregateBarsSql(instrumentId, startTS, endTS, secs, label):
+    """Aggregates one instrument's bars in the database. Returns a df like resampleBars."""
+    rows = _aggregateRowsSql([instrumentId], startTS, endTS, secs, label)
+    if label == 'last':
+        #as resampleBars: rows before the first boundary and the still open last bar are dropped
+        if rows and rows[0][2] % secs != 0:
+            rows = rows[1:]
+        rows = rows[:-1]
+        t = [r[3] for r in rows]
+    else:
+        t = [r[1] * secs - (secs if label == 'left' else 0) for r in rows]
+    df = pd.DataFrame([r[4:] for r in rows], columns = ['O', 'H', 'L', 'C', 'V'], dtype = float,
+                      index = pd.to_datetime(t, unit = 's', utc = True))
+    df.index.name = 'ts'
     return df
     
+def _readRollup(instrumentId, startTS, endTS, barSize, label):
+    """Resamples the largest rollup that barSize is a multiple of, with the 1 minute bars of the
+    partial rollup buckets at either end of the range, so the result is the same as from bars_1_min."""
+    r = rollups.rollupFor(barSeconds(barSize))
+    #the buckets (a, b] hold only bars with startTS < ts < endTS
+    a = -(-int(startTS) // r) * r
+    b = max(a, (int(np.ceil(endTS)) - 1) // r * r)
+    sql = """SELECT ts, open, high, low, close, volume FROM bars_1_min
+                       WHERE instrument_id = %s AND ts > %s AND ts <= %s AND ts < %s
+             UNION ALL SELECT ts, open, high, low, close, volume FROM bars_rollup
+                       WHERE instrument_id = %s AND secs = %s AND closed = 'right' AND ts > %s AND ts <= %s
+             UNION ALL SELECT ts, open, high, low, close, volume FROM bars_1_min WHERE instrument_id = %s AND ts > %s AND ts < %s
+             ORDER BY ts"""
+    df = pd.read_sql(sql, connbars, params = (instrumentId, startTS, a, endTS, instrumentId, r, a, b, instrumentId, b, endTS),
+                     index_col = 'ts', parse_dates = {'ts': {'unit':'s', 'utc': True}})
+    df.columns = ['O', 'H', 'L', 'C', 'V']
+    return resampleBars(df, barSize, label)
+
+def _readRollupLast(instrumentId, startTS, endTS, secs):
+    """Bars of secs with label 'last' from the left closed rollups, with the 1 minute bars of the
+    partial rollup buckets at either end of the range. The same bars as _aggregateBarsSql."""
+    r = rollups.rollupFor(secs)
+    #the buckets [a, b) hold only bars with startTS < ts < endTS
+    a = (int(startTS) // r + 1) * r
+    b = max(a, int(np.ceil(endTS)) // r * r)
+    sql = """SELECT ts AS first_ts, ts AS last_ts, open, high, low, close, volume FROM bars_1_min
+                       WHERE instrument_id = %s AND ts > %s AND ts < %s AND ts < %s
+             UNION ALL SELECT first_ts, last_ts, open, high, low, close, volume FROM bars_rollup
+                       WHERE instrument_id = %s AND secs = %s AND closed = 'left' AND ts >= %s AND ts < %s
+             UNION ALL SELECT ts, ts, open, high, low, close, volume FROM bars_1_min WHERE instrument_id = %s AND ts >= %s AND ts < %s
+             ORDER BY first_ts"""
+    cursor = connbars.cursor()
+    cursor.execute(sql, (instrumentId, int(startTS), a, endTS, instrumentId, r, a, b, instrumentId, b, endTS))
+    rows = np.array(cursor.fetchall(), dtype = float).reshape(-1, 7)
+    #group the pieces on the bucket of secs they fall in, as _aggregateBarsSql groups 1 minute bars
+    first, last = rows[:, 0].astype(np.int64), rows[:, 1].astype(np.int64)
+    k = first // secs
+    starts = np.flatnonzero(np.r_[True, k[1:] != k[:-1]]) if len(k) else np.array([], dtype = np.int64)
+    ends = np.r_[starts[1:], len(k)] - 1
+    if len(starts):
+        o, c = rows[starts, 2], rows[ends, 5]
+        h, l, v = [f.reduceat(rows[:, i], starts) for f, i in [(np.maximum, 3), (np.minimum, 4), (np.add, 6)]]
+    else:
+        o = h = l = c = v = np.array([])
+    df = pd.DataFrame({'O': o, 'H': h, 'L': l, 'C': c, 'V': v}, index = pd.to_datetime(last[ends], unit = 's', utc = True))
+    df.index.name = 'ts'
+    #as resampleBars: rows before the first boundary and the still open last bar are dropped
+    if len(starts) and first[starts[0]] % secs != 0:
+        df = df.iloc[1:]
+    return df.iloc[:-1]
+
+def rebuildRollups(symbols, exchange, startTS = None, endTS = None):
+    """Recomputes bars_rollup for symbols from startTS to endTS (all their bars by default), e.g. after a
+    backfill. Ingestion through barsWriter keeps it current otherwise."""
+    for s in symbols:
+        w = _watermark('bars_1_min', exchange, s)
+        if not w:
+            continue
+        rollups.rebuild(connbars, instruments.id(exchange, s), startTS or w[0], endTS or w[1])
+        print('Rebuilt rollups of', exchange, s)
 
-def readBarsDB_pd(symbol, exchange = 'binance', startTS = None, endTS = None, barSize = 1):
+def readBarsDB_pd(symbol, exchange = 'binance', startTS = None, endTS = None, barSize = 1, label = 'last', cache = True):
     """Reads bars for 'symbol' from the database. Returns pandas df with columns O, H, L, C, V, indexed by ts
     
     Exchange is 'binance' or 'bitmex' or 'gdax'
     
     Reads all bars if startTS, endTS are None.
     
-    barSize can return 5min (5), 10, 30, 60 min bars."""
+    barSize is minutes or a pandas offset string ('4h', '1D'); see resample.resampleBars for it and label.
+    With a multiple of 5m, 1h, 8h or 1d, bars come from bars_rollup.
+    Other bars larger than a minute are aggregated in the database, so only the output bars are transferred.
+    Unlike resampleBars, a boundary with no bar starts a new bar anyway instead of being merged
+    into the previous one.
     
+    With cache, results come from resultCache while the symbol's ingest_watermark is unchanged.
+    A range reaching past the stored bars at either end is cached as the open range, so e.g. an
+    endTS of now is served from one entry extended with new bars rather than a new entry per call.
+    
+    After useLake, bars are read from the lake and resampled client side; cache does not apply."""
+    if lake is not None:
+        df = lake.readBars(symbol, exchange, startTS, endTS)
+        return df if barSize == 1 else resampleBars(df, barSize, label)
+    if not cache:
+        return _readBarsDB_pd(symbol, exchange, startTS, endTS, barSize, label)
+    w = _watermark('bars_1_min', exchange, symbol)
+    startTS, endTS = _openRange(w, startTS, endTS)
+    loadAfter = None
+    if endTS == None and barSize == 1:
+        loadAfter = lambda ts: _readBarsDB_pd(symbol, exchange, max(ts, startTS or 0), None)
+    key = ('bars', exchange, symbol, startTS, endTS, barSize, label)
+    return resultCache.get(key, w, lambda: _readBarsDB_pd(symbol, exchange, startTS, endTS, barSize, label), loadAfter)
+
+def _openRange(w, startTS, endTS):
+    """Returns startTS, endTS with None for either end beyond the stored rows of watermark w. Reads
+    are startTS < ts < endTS, so the open end reads the same rows."""
+    if w and startTS != None and startTS < w[0]:
+        startTS = None
+    if w and endTS != None and endTS > w[1]:
+        endTS = None
+    return startTS, endTS
+
+def _watermark(tbl, exchange, symbol):
+    return watermarks.readWatermark(connbars.cursor(), False, exchange, tbl, symbol)
+
+def _readBarsDB_pd(symbol, exchange, startTS, endTS, barSize = 1, label = 'last'):
     if startTS == None:
         startTS = 0
     
     if endTS == None:
         endTS = time.time()
         
+    instrumentId = instruments.id(exchange, symbol)
+    if barSize != 1 and rollups.rollupFor(barSeconds(barSize)):
+        try:
+            if label == 'last':
+                return _readRollupLast(instrumentId, startTS, endTS, barSeconds(barSize))
+            return _readRollup(instrumentId, startTS, endTS, barSize, label)
+        except mysql.connector.Error as e:
+            print('Reading bars_rollup failed, aggregating 1 minute bars:', e)
+    if barSize != 1:
+        try:
+            return _aggregateBarsSql(instrumentId, startTS, endTS, barSeconds(barSize), label)
+        except mysql.connector.Error as e:
+            print('Aggregating bars in the database failed, resampling client side:', e)
 
-    sql = "SELECT ts, open, high, low, close, volume FROM bars_1_min WHERE symbol = %s AND ts > %s and ts < %s ORDER BY ts"
-    df = pd.read_sql(sql, connbars, params = (symbol, startTS, endTS), index_col = 'ts', parse_dates = {'ts': {'unit':'s', 'utc': True}})
+    sql = "SELECT ts, open, high, low, close, volume FROM bars_1_min WHERE instrument_id = %s AND ts > %s and ts < %s ORDER BY ts"
+    df = pd.read_sql(sql, connbars, params = (instrumentId, startTS, endTS), index_col = 'ts', parse_dates = {'ts': {'unit':'s', 'utc': True}})
     df.columns = ['O', 'H', 'L', 'C', 'V']
     
     if barSize != 1:
-        df = resampleBars(df, barSize)
-        
-    df = df.loc[~df.index.duplicated(keep='first')]
+        df = resampleBars(df, barSize, label)
 
     return df   
 
-def fetchFundingBars(startTS = None, endTS = None):
+def readHistory(symbol, exchange = 'binance', overlap = 3600, asSeries = False):
+    """Reads every bar of 'symbol' from seriesStore, first fetching from the database only the bars
+    after the last stored one, less overlap seconds that are read again in case they changed.
+    
+    Returns a df like readBarsDB_pd, or with asSeries a BarSeries of memory-mapped arrays."""
+    name = ('bars', exchange, symbol)
+    seriesStore.sync(name, lambda ts: _readBarsDB_pd(symbol, exchange, ts, None), overlap)
+    ts, cols = seriesStore.load(name)
+    bars = BarSeries(ts, cols['O'], cols['H'], cols['L'], cols['C'], cols['V'])
+    return bars if asSeries else bars.toDataFrame()
+
+def barFilePath(symbol, exchange = 'binance'):
+    return os.path.join(BAR_FILES, exchange, symbol + '.bars')
+
+def syncBarFile(symbol, exchange = 'binance'):
+    """Appends the bars of symbol stored after its bar file's last one to the file (see barFile).
+    Returns the number appended."""
+    return barFile.sync(barFilePath(symbol, exchange),
+                        lambda ts: iterBars(symbol, exchange, ts, None, asNumpy = True))
+
+def loadBarFile(symbol, exchange = 'binance', startTS = None, endTS = None, asSeries = True, sync = False):
+    """Returns the bars of symbol with startTS <= ts <= endTS from its bar file, as a BarSeries of
+    memory-mapped arrays or, without asSeries, a df like readBarsDB_pd's. With sync, brings the
+    file up to date first."""
+    if sync:
+        syncBarFile(symbol, exchange)
+    f = barFile.BarFile(barFilePath(symbol, exchange))
+    return f.between(startTS, endTS) if asSeries else f.toDataFrame(startTS, endTS)
+
+def iterBars(symbol, exchange = 'binance', startTS = None, endTS = None, chunk = 100000, asNumpy = False):
+    """Yields the bars of symbol with startTS < ts < endTS in ts order, chunk bars at a time, as dfs
+    like readBarsDB_pd's or, with asNumpy, dicts of arrays 'ts', 'O', 'H', 'L', 'C', 'V'.
+    
+    Each chunk is its own keyset query (ts above the last one yielded, LIMIT chunk) on the
+    (instrument_id, ts) key, so memory stays at about one chunk however long the range is."""
+    if startTS == None:
+        startTS = 0
+    if endTS == None:
+        endTS = time.time()
+    instrumentId = instruments.id(exchange, symbol)
+    sql = """SELECT ts, open, high, low, close, volume FROM bars_1_min
+             WHERE instrument_id = %s AND ts > %s AND ts < %s ORDER BY ts LIMIT %s"""
+    cursor = connbars.cursor()
+    last = int(startTS)
+    while True:
+        cursor.execute(sql, (instrumentId, last, int(endTS), int(chunk)))
+        rows = cursor.fetchall()
+        if not rows:
+            return
+        a = np.array(rows, dtype = float)
+        last = int(a[-1, 0])
+        if asNumpy:
+            yield {'ts': a[:, 0].astype(np.int64), 'O': a[:, 1], 'H': a[:, 2], 'L': a[:, 3], 'C': a[:, 4], 'V': a[:, 5]}
+        else:
+            df = pd.DataFrame(a[:, 1:], columns = ['O', 'H', 'L', 'C', 'V'],
+                              index = pd.to_datetime(a[:, 0].astype(np.int64), unit = 's', utc = True))
+            df.index.name = 'ts'
+            yield df
+        if len(rows) < chunk:
+            return
+
+def foldBars(fold, state, symbol, exchange = 'binance', startTS = None, endTS = None, chunk = 100000, asNumpy = False):
+    """Folds the chunks of iterBars into state with state = fold(state, chunk) and returns it,
+    without holding more than one chunk in memory. See barStats for a fold."""
+    for bars in iterBars(symbol, exchange, startTS, endTS, chunk, asNumpy):
+        state = fold(state, bars)
+    return state
+
+def barStats(stats, bars):
+    """foldBars fold of running totals over df chunks. Start it with stats = None.
+    Returns a dict with n, first, last, high, low, volume, mean and std of the close.
+    
+    Each chunk's (n, mean, M2) is merged into the totals with Chan's parallel update; sums of
+    squares of prices near 1e4 would cancel to noise in sumSq / n - mean ** 2."""
+    c = bars['C'].values
+    if stats is None:
+        stats = {'n': 0, 'first': bars.index[0], 'last': None, 'high': -np.inf, 'low': np.inf, 'volume': 0.0,
+                 'mean': 0.0, 'M2': 0.0}
+    n = stats['n'] + len(c)
+    mean = c.mean()
+    delta = mean - stats['mean']
+    stats['M2'] += ((c - mean) ** 2).sum() + delta * delta * stats['n'] * len(c) / n
+    stats['mean'] += delta * len(c) / n
+    stats['n'] = n
+    stats['last'] = bars.index[-1]
+    stats['high'] = max(stats['high'], bars['H'].max())
+    stats['low'] = min(stats['low'], bars['L'].min())
+    stats['volume'] += bars['V'].sum()
+    stats['std'] = np.sqrt(stats['M2'] / n)
+    return stats
+
+#bitmex indices behind funding; {b} is the base currency, {q} the quote currency
+FUNDING_COMPONENTS = [('IBI', '.{b}BON8H'), ('IQI', '.{q}BON8H'), ('P1M', '.{b}{q}PI'), ('P8H', '.{b}{q}PI8H')]
+#bitmex clamps the interest rate component of funding to the premium +/- 0.05%
+FUNDING_CLAMP = 0.0005
+
+def readFundingComponents(base = 'XBT', startTS = None, endTS = None, quote = 'USD', predicted = False):
+    """Reads the bitmex interest and premium indices of base in one query. Returns a df with columns
+    IBI, IQI (base and quote 8h interest), P1M and P8H (premium index, per minute and 8h), indexed by ts.
+    
+    startTS, endTS are datetimes. With predicted, adds F, the funding rate the indices imply:
+    F = P8H + clamp(I - P8H, -0.05%, 0.05%) with I = IQI - IBI."""
     if startTS == None:
         startTS = 0
     else:
@@ -405,103 +874,271 @@ def fetchFundingBars(startTS = None, endTS = None):
     else:
         endTS = endTS.timestamp()
         
-    sql = "SELECT ts, close FROM bitmex WHERE symbol = ? AND ts > ? and ts < ? ORDER BY ts"
-    df = pd.read_sql(sql, connbars, params = (".XBTBON8H", startTS, endTS), index_col = 'ts', parse_dates = {'ts': {'unit':'s', 'utc': True}})
-    df.columns = ['IBI']        
-    df = df.loc[~df.index.duplicated(keep='first')]
-    
-    sql = "SELECT ts, close FROM bitmex WHERE symbol = ? AND ts > ? and ts < ? ORDER BY ts"
-    df2 = pd.read_sql(sql, connbars, params = (".USDBON8H", startTS, endTS), index_col = 'ts', parse_dates = {'ts': {'unit':'s', 'utc': True}})
-    df2.columns = ['IQI']     
-    df2 = df2.loc[~df2.index.duplicated(keep='first')]
-    
-    sql = "SELECT ts, close FROM bitmex WHERE symbol = ? AND ts > ? and ts < ? ORDER BY ts"
-    df3 = pd.read_sql(sql, connbars, params = (".XBTUSDPI", startTS, endTS), index_col = 'ts', parse_dates = {'ts': {'unit':'s', 'utc': True}})
-    df3.columns = ['P1M']   
-    df3 = df3.loc[~df3.index.duplicated(keep='first')]
-    
-    sql = "SELECT ts, close FROM bitmex WHERE symbol = ? AND ts > ? and ts < ? ORDER BY ts"
-    df4 = pd.read_sql(sql, connbars, params = (".XBTUSDPI8H", startTS, endTS), index_col = 'ts', parse_dates = {'ts': {'unit':'s', 'utc': True}})
-    df4.columns = ['P8H']  
-    df4 = df4.loc[~df4.index.duplicated(keep='first')]
+    nameOf = {}
+    for name, symbol in FUNDING_COMPONENTS:
+        instrumentId = instruments.id('bitmex', symbol.format(b = base, q = quote))
+        if instrumentId is not None:
+            nameOf[instrumentId] = name
+    names = [name for name, symbol in FUNDING_COMPONENTS]
+    df = pd.DataFrame(columns = names, dtype = float)
+    if nameOf:
+        sql = ("SELECT instrument_id, ts, close FROM bars_1_min WHERE instrument_id IN (" +
+               ", ".join(["%s"] * len(nameOf)) + ") AND ts > %s AND ts < %s")
+        cursor = connbars.cursor()
+        cursor.execute(sql, tuple(nameOf) + (int(startTS), int(endTS)))
+        a = np.array(cursor.fetchall(), dtype = float).reshape(-1, 3)
+        df = _pivotPanel(a, ['close'], nameOf)['close'].reindex(columns = names).sort_index()
+    df.index = pd.to_datetime(df.index.values.astype(np.int64), unit = 's', utc = True)
+    df.index.name = 'ts'
+    df.columns.name = None
+    if predicted:
+        premium = df['P8H']
+        df['F'] = premium + (df['IQI'] - df['IBI'] - premium).clip(-FUNDING_CLAMP, FUNDING_CLAMP)
+    return df
     
-    #s = set.intersection(set(df.index), set(df2.index), set(df3.index), set(df4.index))
+def fetchFundingBars(startTS = None, endTS = None):
+    return readFundingComponents('XBT', startTS, endTS)
+
+def fetchFundingBarsEth(startTS = None, endTS = None):
+    return readFundingComponents('ETH', startTS, endTS)
+
+def fetchFundingData(symbol, exchange, startTS = None, endTS = None, interval = None, cache = True):
+    """Fetch funding data from the 'perpFunding' table.
     
-    #Todo - build a dictionary with an entry for each date in s.
+    With interval (a pandas offset string, e.g. '1D'), returns the funding summed over each
+    interval (t - interval, t], labelled t and computed in the database.
     
-    df5 = pd.concat([df, df2, df4, df3], axis = 1, ignore_index=True)
-    df5 = df5.rename({0:'IBI', 1:'IQI', 2:'P1M', 3:'P8H'}, axis = 'columns')
-
-    return df5
+    With cache, results come from resultCache while the symbol's ingest_watermark is unchanged;
+    ranges reaching past the stored rows are cached as open ranges, as for readBarsDB_pd.
+    After useLake, funding is read from the lake instead."""
+    if startTS != None:
+        startTS = startTS.timestamp()
+    if endTS != None:
+        endTS = endTS.timestamp()
+    if lake is not None:
+        df = lake.readFunding(symbol, exchange, startTS, endTS)
+        if interval is not None:
+            df = df.resample(interval, label = 'right', closed = 'right').sum(min_count = 1).dropna()
+        return df
+    if not cache:
+        return _fetchFundingData(symbol, exchange, startTS, endTS, interval)
+    w = _watermark('perpfunding', exchange, symbol)
+    startTS, endTS = _openRange(w, startTS, endTS)
+    loadAfter = None
+    if endTS == None and interval is None:
+        loadAfter = lambda ts: _fetchFundingData(symbol, exchange, max(ts, startTS or 0), None)
+    key = ('funding', exchange, symbol, startTS, endTS, interval)
+    return resultCache.get(key, w, lambda: _fetchFundingData(symbol, exchange, startTS, endTS, interval), loadAfter)
 
-def fetchFundingBarsEth(startTS = None, endTS = None):
+def _fetchFundingData(symbol, exchange, startTS, endTS, interval = None):
     if startTS == None:
         startTS = 0
-    else:
-        startTS = startTS.timestamp()
     if endTS == None:
         endTS = time.time()
-    else:
-        endTS = endTS.timestamp()
         
-    sql = "SELECT ts, close FROM bitmex WHERE symbol = ? AND ts > ? and ts < ? ORDER BY ts"
-    df = pd.read_sql(sql, connbars, params = (".ETHBON8H", startTS, endTS), index_col = 'ts', parse_dates = {'ts': {'unit':'s', 'utc': True}})
-    df.columns = ['IBI'] 
-    df = df.loc[~df.index.duplicated(keep='first')]
-    
-    sql = "SELECT ts, close FROM bitmex WHERE symbol = ? AND ts > ? and ts < ? ORDER BY ts"
-    df2 = pd.read_sql(sql, connbars, params = (".USDBON8H", startTS, endTS), index_col = 'ts', parse_dates = {'ts': {'unit':'s', 'utc': True}})
-    df2.columns = ['IQI']     
-    df2 = df2.loc[~df2.index.duplicated(keep='first')]
+    instrumentId = instruments.id(exchange, symbol)
+    if interval is not None:
+        secs = barSeconds(interval)
+        sql = ("SELECT ((ts + " + str(secs - 1) + ") DIV " + str(secs) + ") * " + str(secs) + """ AS t, SUM(value)
+                 FROM perpfunding WHERE instrument_id = %s AND ts > %s and ts < %s GROUP BY t ORDER BY t""")
+        try:
+            cursor = connbars.cursor()
+            cursor.execute(sql, (instrumentId, int(startTS), int(endTS)))
+            rows = cursor.fetchall()
+            df = pd.DataFrame([r[1] for r in rows], columns = ['fund_rate'], dtype = float,
+                              index = pd.to_datetime([r[0] for r in rows], unit = 's', utc = True))
+            df.index.name = 'ts'
+            return df
+        except mysql.connector.Error as e:
+            print('Aggregating funding in the database failed, resampling client side:', e)
     
-    sql = "SELECT ts, close FROM bitmex WHERE symbol = ? AND ts > ? and ts < ? ORDER BY ts"
-    df3 = pd.read_sql(sql, connbars, params = (".ETHUSDPI", startTS, endTS), index_col = 'ts', parse_dates = {'ts': {'unit':'s', 'utc': True}})
-    df3.columns = ['P1M']       
-    df3 = df3.loc[~df3.index.duplicated(keep='first')]
+    sql = "SELECT ts, value FROM perpfunding WHERE instrument_id = %s AND ts > %s and ts < %s ORDER BY ts"
+    df = pd.read_sql(sql, connbars, params = (instrumentId, startTS, endTS), index_col = 'ts', parse_dates = {'ts': {'unit':'s', 'utc': True}})
+    df.columns = ['fund_rate'] 
+    if interval is not None:
+        df = df.resample(interval, label = 'right', closed = 'right').sum(min_count = 1).dropna()
     
-    sql = "SELECT ts, close FROM bitmex WHERE symbol = ? AND ts > ? and ts < ? ORDER BY ts"
-    df4 = pd.read_sql(sql, connbars, params = (".ETHUSDPI8H", startTS, endTS), index_col = 'ts', parse_dates = {'ts': {'unit':'s', 'utc': True}})
-    df4.columns = ['P8H']   
-    df4 = df4.loc[~df4.index.duplicated(keep='first')]
+    return df
+
+def readFundingHistory(symbol, exchange, overlap = 8 * 60 * 60):
+    """Reads every funding value of 'symbol' like fetchFundingData, topping up seriesStore
+    as readHistory does."""
+    name = ('funding', exchange, symbol)
+    seriesStore.sync(name, lambda ts: _fetchFundingData(symbol, exchange, ts, None), overlap)
+    ts, cols = seriesStore.load(name)
+    index = pd.to_datetime(ts, unit = 's', utc = True)
+    index.name = 'ts'
+    return pd.DataFrame({'fund_rate': cols['fund_rate']}, index = index)
+
+class _DerivedInputs:
+    """What derived series are computed from: the rows of one exchange with ts > startTS."""
+    def __init__(self, exchange):
+        self.exchange = exchange
+
+    def funding(self, symbol, startTS):
+        return _fetchFundingData(symbol, self.exchange, startTS, None)['fund_rate']
+
+    def close(self, symbol, startTS):
+        return _readBarsDB_pd(symbol, self.exchange, startTS, None)['C']
+
+    def components(self, base, quote, startTS):
+        return readFundingComponents(base, timestampToDate(startTS), None, quote, predicted = True)
+
+def updateDerived(name, symbol, exchange):
+    """Computes the values of the derived series name (see derived.DERIVED) for symbol after the last
+    one stored in derived_series and stores them. Returns the number stored."""
+    flushWrites()
+    d = derived.DERIVED[name]
+    instrumentId = instruments.id(exchange, symbol)
+    if instrumentId is None:
+        return 0
+    cursor = connbars.cursor()
+    cursor.execute("SELECT ts, value FROM derived_series WHERE name = %s AND instrument_id = %s ORDER BY ts DESC LIMIT 1",
+                   (name, instrumentId))
+    rows = cursor.fetchall()
+    prev = rows[0] if rows else None
+    startTS = prev[0] if prev else 0
+    s = d.compute(_DerivedInputs(exchange), symbol, max(startTS - d.lookback, 0), prev).dropna()
+    ts = toSeconds(s.index)
+    new = ts > startTS
+    derivedWriter.add([(name, instrumentId, int(t), float(v)) for t, v in zip(ts[new], s.values[new])])
+    derivedWriter.flush()
+    return int(new.sum())
+
+def updateAllDerived(symbols, exchange, names = None):
+    """Brings the derived series names (all registered ones by default) of symbols up to date."""
+    for name in (names or list(derived.DERIVED)):
+        for s in symbols:
+            try:
+                print(name, s, updateDerived(name, s, exchange), 'values added')
+            except KeyError as e:
+                #no index or component symbols for this one
+                print('Skipping', name, 'for', s + ':', e)
+
+def readDerived(name, symbol, exchange, startTS = None, endTS = None, update = True):
+    """Reads the derived series name of symbol like fetchFundingData: a df with column name, indexed by ts.
+    startTS, endTS are datetimes. With update, values after the last stored one are computed first."""
+    if update:
+        updateDerived(name, symbol, exchange)
+    startTS = 0 if startTS == None else startTS.timestamp()
+    endTS = time.time() if endTS == None else endTS.timestamp()
+    sql = """SELECT ts, value FROM derived_series WHERE name = %s AND instrument_id = %s AND ts > %s AND ts < %s ORDER BY ts"""
+    df = pd.read_sql(sql, connbars, params = (name, instruments.id(exchange, symbol), startTS, endTS), index_col = 'ts',
+                     parse_dates = {'ts': {'unit':'s', 'utc': True}})
+    df.columns = [name]
+    return df
+
+def alignFundingToBars(symbols, exchange, startTS = None, endTS = None, tolerance = '5min'):
+    """Attaches to every funding event of symbols the close of the last bar at or before it.
     
-    df5 = pd.concat([df, df2, df4, df3], axis = 1, ignore_index=True)
-    df5 = df5.rename({0:'IBI', 1:'IQI', 2:'P1M', 3:'P8H'}, axis = 'columns')
+    startTS, endTS are datetimes, as for fetchFundingData. tolerance (seconds or a pandas offset
+    string) is how old that bar may be; events with no bar within it get a NaN price rather than
+    being dropped. Returns a df with columns symbol, ts, fund_rate, price, bar_ts and price_delta
+    (the price change since the symbol's previous funding event), sorted by ts."""
+    if not isinstance(tolerance, str):
+        tolerance = str(int(tolerance)) + 's'
+    tolerance = pd.Timedelta(tolerance)
+    funding, bars = [], []
+    for s in symbols:
+        f = fetchFundingData(s, exchange, startTS, endTS)
+        if not len(f):
+            continue
+        b = readBarsDB_pd(s, exchange, (f.index[0] - tolerance).timestamp() - 1, f.index[-1].timestamp() + 1,
+                          cache = False)
+        funding.append(f.reset_index().assign(symbol = s))
+        bars.append(pd.DataFrame({'bar_ts': b.index, 'price': b['C'].values, 'symbol': s}))
+    if not funding:
+        return pd.DataFrame(columns = ['symbol', 'ts', 'fund_rate', 'price', 'bar_ts', 'price_delta'])
+    funding = pd.concat(funding, ignore_index = True).sort_values('ts')
+    bars = pd.concat(bars, ignore_index = True).sort_values('bar_ts')
+    df = pd.merge_asof(funding, bars, left_on = 'ts', right_on = 'bar_ts', by = 'symbol',
+                       direction = 'backward', tolerance = tolerance)
+    df['price_delta'] = df.groupby('symbol')['price'].diff()
+    return df[['symbol', 'ts', 'fund_rate', 'price', 'bar_ts', 'price_delta']].reset_index(drop = True)
 
-    return df5
+PANEL_FIELDS = {'O': 'open', 'H': 'high', 'L': 'low', 'C': 'close', 'V': 'volume'}
 
-def fetchFundingData(symbol, exchange, startTS = None, endTS = None):
-    """Fetch funding data from the 'perpFunding' table."""
+def _pivotPanel(a, names, symbolOf):
+    """Pivots rows (instrument_id, ts, *names) into a df indexed by ts with (name, symbol) columns."""
+    df = pd.DataFrame(a[:, 2:], columns = names)
+    df['symbol'] = pd.Series(a[:, 0].astype(np.int64)).map(symbolOf).values
+    df['ts'] = a[:, 1].astype(np.int64)
+    return df.pivot(index = 'ts', columns = 'symbol', values = names)
+
+def readPanel(symbols, exchange = 'binance', fields = ('C',), startTS = None, endTS = None, barSize = 1,
+              asArray = False):
+    """Reads fields of many symbols into one panel on a shared ts index, with a single IN (...)
+    query on bars_1_min and one on perpfunding.
+    
+    fields -- any of 'O', 'H', 'L', 'C', 'V' and 'fund_rate'.
+    startTS, endTS are timestamps, as for readBarsDB_pd. With barSize > 1 bars are aggregated in
+    the database and labelled with the end of their interval ('right'), so all symbols share one
+    grid; fund_rate is then the funding summed over each bar.
+    
+    Returns a df indexed by ts with (field, symbol) columns, NaN where a symbol has no value. The
+    index is the union of the timestamps of every symbol's bars and funding events. With asArray,
+    returns (index, symbols, fields, cube) instead, cube being a time x symbol x field array."""
     if startTS == None:
         startTS = 0
-    else:
-        startTS = startTS.timestamp()
     if endTS == None:
         endTS = time.time()
-    else:
-        endTS = endTS.timestamp()
-        
-    sql = "SELECT ts, value FROM perpfunding WHERE symbol = %s AND exchange = %s AND ts > %s and ts < %s ORDER BY ts"
-    df = pd.read_sql(sql, connbars, params = (symbol, exchange, startTS, endTS), index_col = 'ts', parse_dates = {'ts': {'unit':'s', 'utc': True}})
-    df.columns = ['fund_rate'] 
+    fields = list(fields)
+    symbolOf = {}
+    for s in symbols:
+        instrumentId = instruments.id(exchange, s)
+        if instrumentId is not None:
+            symbolOf[instrumentId] = s
+    ids = list(symbolOf)
+    inList = "instrument_id IN (" + ", ".join(["%s"] * len(ids)) + ")"
+    secs = barSeconds(barSize) if barSize != 1 else None
+    cursor = connbars.cursor()
+    frames = []
     
-    df = df.loc[~df.index.duplicated(keep='first')]
+    barFields = [f for f in fields if f in PANEL_FIELDS]
+    if barFields and ids:
+        if secs is None:
+            sql = ("SELECT instrument_id, ts, " + ", ".join([PANEL_FIELDS[f] for f in barFields]) +
+                   " FROM bars_1_min WHERE " + inList + " AND ts > %s AND ts < %s")
+            cursor.execute(sql, tuple(ids) + (int(startTS), int(endTS)))
+            a = np.array(cursor.fetchall(), dtype = float).reshape(-1, 2 + len(barFields))
+        else:
+            r = np.array(_aggregateRowsSql(ids, startTS, endTS, secs, 'right'), dtype = float).reshape(-1, 9)
+            a = np.column_stack([r[:, 0], r[:, 1] * secs, r[:, [4 + 'OHLCV'.index(f) for f in barFields]]])
+        frames.append(_pivotPanel(a, barFields, symbolOf))
     
-    return df
+    if 'fund_rate' in fields and ids:
+        if secs is None:
+            sql = "SELECT instrument_id, ts, value FROM perpfunding WHERE " + inList + " AND ts > %s AND ts < %s"
+        else:
+            sql = ("SELECT instrument_id, ((ts + " + str(secs - 1) + ") DIV " + str(secs) + ") * " + str(secs) +
+                   " AS t, SUM(value) FROM perpfunding WHERE " + inList + " AND ts > %s AND ts < %s GROUP BY instrument_id, t")
+        cursor.execute(sql, tuple(ids) + (int(startTS), int(endTS)))
+        a = np.array(cursor.fetchall(), dtype = float).reshape(-1, 3)
+        frames.append(_pivotPanel(a, ['fund_rate'], symbolOf))
+    
+    panel = pd.concat(frames, axis = 1) if frames else pd.DataFrame(index = pd.Index([], dtype = np.int64))
+    panel = panel.reindex(columns = pd.MultiIndex.from_product([fields, list(symbols)])).sort_index()
+    panel.index = pd.to_datetime(panel.index.values.astype(np.int64), unit = 's', utc = True)
+    panel.index.name = 'ts'
+    if asArray:
+        cube = panel.to_numpy(dtype = float).reshape(len(panel), len(fields), len(symbols)).transpose(0, 2, 1)
+        return panel.index, list(symbols), fields, cube
+    return panel
 
 def ma(v, period):
-    """Returns a moving average version of hte list v."""
-    v2 = v[:]
-    runSum = 0.0
-    for idx, x in enumerate(v):
-        runSum += x
-        if idx >= period:
-            runSum = runSum - v[idx - period]
-            v2[idx] = runSum / period
-        else:
-            v2[idx] = runSum / (idx + 1)
-    return v2
+    """Returns a moving average version of hte list v: the mean of the last period values, or of
+    all of them for the first period - 1. See rolling.sma; v may be a list, array or Series."""
+    try:
+        import rolling
+    except ImportError:
+        from braintrust_analysis import rolling
+    v2 = rolling.sma(v, period, 1)
+    if isinstance(v, pd.Series):
+        return pd.Series(v2, index = v.index, name = v.name)
+    return v2 if isinstance(v, np.ndarray) else v2.tolist()
 
 def fetchAll(b, exchange = 'b'):
+    extendBarPartitions()
     if exchange == 'b':
         fetchBinanceSyms(b)
         fetchMexSymbols()             
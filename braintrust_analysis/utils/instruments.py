@@ -0,0 +1,40 @@
+"""Dictionary encoding of (exchange, symbol).
+
+bars_1_min and perpfunding store a SMALLINT instrument_id instead of the
+exchange and symbol text; the instruments table maps one to the other. Lookups
+go through an in-process cache, so each name costs one query per process.
+"""
+
+
+class Instruments:
+    """Cached two way lookup between (exchange, symbol) and instrument ids."""
+    def __init__(self, conn):
+        self.conn = conn
+        self.ids = {}
+        self.names = {}
+
+    def _load(self, sql, params):
+        cursor = self.conn.cursor()
+        cursor.execute(sql, params)
+        for instrumentId, exchange, symbol in cursor.fetchall():
+            self.ids[(exchange, symbol)] = instrumentId
+            self.names[instrumentId] = (exchange, symbol)
+
+    def id(self, exchange, symbol, create = False):
+        """Returns the id of the instrument, or None if it is unknown and create is False."""
+        key = (exchange, symbol)
+        if key not in self.ids:
+            sql = "SELECT id, exchange, symbol FROM instruments WHERE exchange = %s AND symbol = %s"
+            self._load(sql, key)
+            if key not in self.ids and create:
+                cursor = self.conn.cursor()
+                cursor.execute("INSERT IGNORE INTO instruments (exchange, symbol) VALUES (%s, %s)", key)
+                self.conn.commit()
+                self._load(sql, key)
+        return self.ids.get(key)
+
+    def name(self, instrumentId):
+        """Returns (exchange, symbol) of the instrument id."""
+        if instrumentId not in self.names:
+            self._load("SELECT id, exchange, symbol FROM instruments WHERE id = %s", (instrumentId,))
+        return self.names[instrumentId]
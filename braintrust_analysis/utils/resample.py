@@ -0,0 +1,87 @@
+"""Vectorized OHLCV resampling.
+
+Bars are grouped by boundary indices computed with NumPy and reduced with
+np.maximum/minimum/add.reduceat, so the cost is a few passes over the arrays
+whatever the bar size.
+"""
+import numpy as np
+import pandas as pd
+
+COLUMNS = ['O', 'H', 'L', 'C', 'V']
+
+
+def barSeconds(barSize):
+    """Returns the length in seconds of barSize: minutes as an int, or a pandas
+    offset string such as '15min', '4h', '8h' or '1D'."""
+    if isinstance(barSize, str):
+        secs = int(pd.Timedelta(barSize).total_seconds())
+    else:
+        secs = int(barSize) * 60
+    if secs <= 0:
+        raise ValueError('Error in resampleBars - unsupported bar size.')
+    return secs
+
+def _seconds(index):
+    epoch = pd.Timestamp(0) if index.tz is None else pd.Timestamp(0, tz = 'UTC')
+    return np.asarray((index - epoch) // pd.Timedelta(seconds = 1), dtype = np.int64)
+
+def _reduce(df, starts, stop = None):
+    """O, H, L, C, V of the groups of rows [starts[i], starts[i+1]), the last one ending at stop."""
+    cols = [df[c].values[:stop] for c in COLUMNS]
+    o, h, l, c, v = cols
+    ends = np.r_[starts[1:], len(o)] - 1
+    return {'O': o[starts], 'H': np.maximum.reduceat(h, starts), 'L': np.minimum.reduceat(l, starts),
+            'C': c[ends], 'V': np.add.reduceat(v, starts)}
+
+def _empty(index):
+    return pd.DataFrame({c: np.array([], dtype = float) for c in COLUMNS}, index = index[:0])
+
+def resampleBars(df, barSize, label = 'last', offset = 0, fillGaps = False):
+    """Resamples bars with columns O, H, L, C, V indexed by their close time.
+
+    barSize -- minutes as an int, or a pandas offset string ('15min', '4h', '1D'). Boundaries
+               are multiples of the bar size from the epoch, so '8h' lines up with funding
+               at 00:00, 08:00 and 16:00 UTC.
+    label -- 'last': a bar starts at each row whose ts is on a boundary and is labelled with
+             the ts of its last row. Rows before the first boundary and the bar still open at
+             the end are dropped. This is what resampleBars always did.
+             'right' / 'left': a bar holds the rows with ts in (t - barSize, t] and is labelled
+             with t or t - barSize. Partial first and last bars are kept.
+    offset -- seconds to shift the boundaries by.
+    fillGaps -- with 'right'/'left', also return bars for intervals with no rows, with
+                O = H = L = C = the previous close and V = 0.
+    """
+    secs = barSeconds(barSize)
+    if len(df) == 0:
+        return _empty(df.index)
+    ts = _seconds(df.index)
+
+    if label == 'last':
+        bounds = np.flatnonzero((ts - offset) % secs == 0)
+        if len(bounds) < 2:
+            return _empty(df.index)
+        starts = bounds[:-1]
+        return pd.DataFrame(_reduce(df, starts, bounds[-1]), index = df.index[bounds[1:] - 1])
+    if label not in ('right', 'left'):
+        raise ValueError("label must be 'last', 'right' or 'left'")
+
+    buckets = -((offset - ts) // secs)    #ceil((ts - offset) / secs)
+    starts = np.flatnonzero(np.r_[True, buckets[1:] != buckets[:-1]])
+    cols = _reduce(df, starts)
+    buckets = buckets[starts]
+    if fillGaps and len(buckets):
+        full = np.arange(buckets[0], buckets[-1] + 1)
+        pos = np.searchsorted(buckets, full)
+        have = buckets[np.minimum(pos, len(buckets) - 1)] == full
+        #the previous bar's close for each missing bar
+        prev = np.maximum.accumulate(np.where(have, np.arange(len(full)), 0))
+        src = pos[prev]
+        close = cols['C'][src]
+        cols = {c: np.where(have, cols[c][src], 0.0 if c == 'V' else close) for c in COLUMNS}
+        buckets = full
+    t = buckets * secs + offset
+    if label == 'left':
+        t = t - secs
+    index = pd.to_datetime(t, unit = 's', utc = df.index.tz is not None)
+    index.name = df.index.name
+    return pd.DataFrame(cols, index = index)
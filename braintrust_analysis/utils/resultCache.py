@@ -0,0 +1,170 @@
+"""Two level cache of reader results.
+
+Results are kept in an in-process LRU bounded by a byte budget and in a
+directory of .npz files that survives kernel restarts. Each entry records the
+ingest_watermark of the symbol it was read from, (earliest, latest, row_count,
+version, revised). A lookup compares it against the current watermark: every
+write bumps the version, so an unchanged watermark means the stored rows are
+unchanged and the entry is served. If rows were only appended after the entry's
+latest ts and no write since has revised the rows up to it, an entry that can be
+extended fetches just those rows; anything else is read again in full. Stale
+data is never served.
+"""
+import collections, hashlib, json, os
+import numpy as np
+import pandas as pd
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def _nbytes(df):
+    return int(df.memory_usage(index = True, deep = True).sum())
+
+def _toArrays(df):
+    arrays = {'index': df.index.values.astype('datetime64[ns]').view(np.int64)}
+    for i, c in enumerate(df.columns):
+        arrays['c' + str(i)] = df[c].values
+    return arrays
+
+def _upTo(df, latest):
+    """Rows of df with ts <= latest."""
+    ts = df.index.values.astype('datetime64[ns]').view(np.int64) // 10 ** 9
+    return df[ts <= latest]
+
+def _fromArrays(arrays, meta):
+    index = pd.to_datetime(arrays['index'], unit = 'ns', utc = meta['utc'])
+    index.name = meta['indexName']
+    return pd.DataFrame({c: arrays['c' + str(i)] for i, c in enumerate(meta['columns'])}, index = index,
+                        columns = meta['columns'])
+
+
+class CacheEntry:
+    __slots__ = ('df', 'watermark', 'nbytes')
+
+    def __init__(self, df, watermark):
+        self.df = df
+        self.watermark = watermark
+        self.nbytes = _nbytes(df)
+
+
+class ResultCache:
+    """LRU of DataFrames keyed by reader arguments, backed by a directory of .npz files.
+
+    directory -- where entries are stored on disk, None for memory only.
+    maxBytes -- memory budget of the LRU.
+    maxDiskBytes -- disk budget; the least recently written files are removed beyond it.
+    """
+    def __init__(self, directory = None, maxBytes = 512 * 2 ** 20, maxDiskBytes = 8 * 2 ** 30):
+        self.directory = directory
+        self.maxBytes = maxBytes
+        self.maxDiskBytes = maxDiskBytes
+        self.entries = collections.OrderedDict()
+        self.nbytes = 0
+        self.hits = self.extended = self.misses = 0
+        if directory is not None:
+            os.makedirs(directory, exist_ok = True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, hashlib.sha1(repr(key).encode()).hexdigest() + '.npz')
+
+    def _remember(self, key, entry):
+        if key in self.entries:
+            self.nbytes -= self.entries.pop(key).nbytes
+        if entry.nbytes > self.maxBytes:
+            return
+        self.entries[key] = entry
+        self.nbytes += entry.nbytes
+        while self.nbytes > self.maxBytes:
+            self.nbytes -= self.entries.popitem(last = False)[1].nbytes
+
+    def _lookup(self, key):
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return self.entries[key]
+        if self.directory is None or not os.path.exists(self._path(key)):
+            return None
+        try:
+            with np.load(self._path(key), allow_pickle = False) as f:
+                meta = json.loads(str(f['meta']))
+                if meta['key'] != repr(key):
+                    return None
+                entry = CacheEntry(_fromArrays(f, meta), tuple(meta['watermark']))
+        except Exception as e:
+            logger.info('Dropping unreadable cache file for %s: %s', key, e)
+            return None
+        self._remember(key, entry)
+        return entry
+
+    def _store(self, key, entry):
+        self._remember(key, entry)
+        if self.directory is None:
+            return
+        df = entry.df
+        meta = {'key': repr(key), 'watermark': list(entry.watermark), 'columns': [str(c) for c in df.columns],
+                'indexName': df.index.name, 'utc': getattr(df.index, 'tz', None) is not None}
+        path = self._path(key)
+        tmp = path + '.tmp.npz'
+        np.savez(tmp, meta = np.array(json.dumps(meta)), **_toArrays(df))
+        os.replace(tmp, path)
+        self._prune()
+
+    def _prune(self):
+        files = [os.path.join(self.directory, f) for f in os.listdir(self.directory) if f.endswith('.npz')]
+        files = sorted([(os.path.getmtime(f), os.path.getsize(f), f) for f in files])
+        total = sum([size for _, size, _ in files])
+        for _, size, f in files:
+            if total <= self.maxDiskBytes:
+                break
+            os.remove(f)
+            total -= size
+
+    def get(self, key, watermark, load, loadAfter = None):
+        """Returns a copy of the result cached under key, loading it with load() if there is none or
+        it is stale.
+
+        watermark -- the symbol's current (earliest, latest, row_count, version, revised), None if it
+                     has no rows. It is read before load() runs.
+        loadAfter -- for results that are every row up to now: loadAfter(ts) returns the rows after
+                     ts, used to extend an entry when rows were only appended after its latest ts.
+                     Such entries keep only the rows up to the watermark's latest ts, so rows written
+                     while loading are fetched again by the next extension rather than twice.
+        """
+        watermark = tuple(watermark) if watermark else ()
+        entry = self._lookup(key)
+        if entry is not None and entry.watermark == watermark:
+            self.hits += 1
+            return entry.df.copy()
+        if entry is not None and loadAfter is not None and self._appendOnly(entry.watermark, watermark):
+            tail = _upTo(loadAfter(entry.watermark[1]), watermark[1])
+            if len(tail) == watermark[2] - entry.watermark[2]:
+                self.extended += 1
+                entry = CacheEntry(pd.concat([entry.df, tail]), watermark)
+                self._store(key, entry)
+                return entry.df.copy()
+        self.misses += 1
+        df = load()
+        if loadAfter is not None and watermark:
+            df = _upTo(df, watermark[1])
+        entry = CacheEntry(df, watermark)
+        self._store(key, entry)
+        return entry.df.copy()
+
+    @staticmethod
+    def _appendOnly(old, new):
+        """True if new only adds rows after old's latest ts: nothing written since old revised
+        the rows up to it."""
+        return (len(old) == 5 and len(new) == 5 and old[0] == new[0] and new[1] > old[1] and new[2] > old[2] and
+                new[4] <= old[3])
+
+    def clear(self):
+        self.entries.clear()
+        self.nbytes = 0
+        if self.directory is not None:
+            for f in os.listdir(self.directory):
+                if f.endswith('.npz'):
+                    os.remove(os.path.join(self.directory, f))
+
+    def report(self):
+        return '{} hits, {} extended, {} misses; {} entries, {:.1f} MB in memory'.format(
+            self.hits, self.extended, self.misses, len(self.entries), self.nbytes / 2 ** 20)
@@ -0,0 +1,99 @@
+"""Rollup bars kept alongside bars_1_min.
+
+bars_rollup holds, for each instrument and each size in ROLLUP_SECS, the bar of
+every bucket that has 1 minute bars, in both conventions of CLOSED:
+  'right' -- the bucket (ts - secs, ts], labelled like bars_1_min with its close
+             time ts, so it is the bar resampleBars(label = 'right') would make.
+  'left'  -- the bucket [ts, ts + secs), labelled with its start ts. These are the
+             groups of the default label 'last', which is labelled with last_ts.
+first_ts and last_ts are the ts of the first and last 1 minute bar in the bucket.
+Each size is aggregated in the database from the next finer one of the same
+convention (5m from bars_1_min, 1h from 5m, 8h from 1h, 1d from 8h), so
+refreshing a bucket reads a few dozen rows at most.
+
+RollupHook refreshes the buckets a BulkWriter batch touched, inside the batch's
+transaction. Buckets are deleted and recomputed rather than added to, so
+upserted bars are not counted twice. rebuild() recomputes a span of history, e.g. after
+a backfill written with the hook off.
+"""
+ROLLUP_SECS = [5 * 60, 60 * 60, 8 * 60 * 60, 24 * 60 * 60]
+CLOSED = ['right', 'left']
+#rebuild() refreshes this much history per transaction; a whole number of the largest bucket
+REBUILD_SECS = 7 * 24 * 60 * 60
+
+
+def rollupFor(secs):
+    """Returns the largest rollup size that secs is a multiple of, None if there is none."""
+    sizes = [r for r in ROLLUP_SECS if secs % r == 0]
+    return sizes[-1] if sizes else None
+
+def _refreshSql(level, closed):
+    """INSERT ... SELECT that recomputes the ROLLUP_SECS[level] buckets of one instrument and convention
+    from the rows with lo < ts <= hi of level - 1, or of bars_1_min for level 0. Parameters:
+    instrument_id, lo, hi."""
+    secs = str(ROLLUP_SECS[level])
+    k = "ts DIV " + secs if closed == 'left' else "(ts + " + secs + " - 1) DIV " + secs
+    if level == 0:
+        src, where, bars, first, last = "bars_1_min", "", "COUNT(*)", "MIN(ts)", "MAX(ts)"
+    else:
+        src, bars, first, last = "bars_rollup", "SUM(bars)", "MIN(first_ts)", "MAX(last_ts)"
+        where = " AND {t}secs = " + str(ROLLUP_SECS[level - 1]) + " AND {t}closed = '" + closed + "'"
+    return ("INSERT INTO bars_rollup (instrument_id, secs, closed, ts, open, high, low, close, volume, bars, first_ts, last_ts)"
+            " SELECT g.instrument_id, " + secs + ", '" + closed + "', g.k * " + secs + ", o.open, g.high, g.low, c.close, g.volume,"
+            " g.bars, g.first_ts, g.last_ts FROM"
+            " (SELECT instrument_id, " + k + " AS k, MIN(ts) AS first, MAX(ts) AS last,"
+            " MAX(high) AS high, MIN(low) AS low, SUM(volume) AS volume, " + bars + " AS bars,"
+            " " + first + " AS first_ts, " + last + " AS last_ts"
+            " FROM " + src + " WHERE instrument_id = %s" + where.format(t = "") + " AND ts > %s AND ts <= %s GROUP BY instrument_id, k) g"
+            " JOIN " + src + " o ON o.instrument_id = g.instrument_id" + where.format(t = "o.") + " AND o.ts = g.first"
+            " JOIN " + src + " c ON c.instrument_id = g.instrument_id" + where.format(t = "c.") + " AND c.ts = g.last")
+
+def refresh(cursor, instrumentId, lo, hi):
+    """Recomputes every rollup bucket of instrumentId holding a 1 minute bar with lo <= ts <= hi."""
+    for closed in CLOSED:
+        a, b = lo, hi
+        for level, secs in enumerate(ROLLUP_SECS):
+            #the buckets holding a and b, and everything the finer level has in between
+            if closed == 'left':
+                first = int(a) // secs * secs
+                last = int(b) // secs * secs
+                src = (first - 1, last + secs - 1)
+            else:
+                first = -(-int(a) // secs) * secs
+                last = -(-int(b) // secs) * secs
+                src = (first - secs, last)
+            #deleted first, so buckets whose bars were all deleted go too
+            cursor.execute("DELETE FROM bars_rollup WHERE instrument_id = %s AND secs = %s AND closed = %s"
+                           " AND ts >= %s AND ts <= %s", (instrumentId, secs, closed, first, last))
+            cursor.execute(_refreshSql(level, closed), (instrumentId,) + src)
+            a, b = first, last
+
+def rebuild(conn, instrumentId, startTS, endTS):
+    """Recomputes the rollups of instrumentId from startTS to endTS, committing every REBUILD_SECS."""
+    cursor = conn.cursor()
+    lo = int(startTS) // REBUILD_SECS * REBUILD_SECS
+    while lo <= endTS:
+        refresh(cursor, instrumentId, lo + 1, lo + REBUILD_SECS)
+        conn.commit()
+        lo += REBUILD_SECS
+
+
+class RollupHook:
+    """BulkWriter hook that refreshes the rollups of the bars_1_min rows it writes.
+
+    columns -- the writer's column order, containing 'instrument_id' and 'ts'."""
+    def __init__(self, columns):
+        self.idIdx = columns.index('instrument_id')
+        self.tsIdx = columns.index('ts')
+
+    def beforeFlush(self, writer, cursor, rows):
+        pass
+
+    def afterFlush(self, writer, cursor, rows):
+        spans = {}
+        for r in rows:
+            key, ts = r[self.idIdx], r[self.tsIdx]
+            lo, hi = spans.get(key, (ts, ts))
+            spans[key] = (min(lo, ts), max(hi, ts))
+        for instrumentId, (lo, hi) in spans.items():
+            refresh(cursor, instrumentId, lo, hi)
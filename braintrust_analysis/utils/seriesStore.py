@@ -0,0 +1,109 @@
+"""Local append-only store for series that grow at the tail.
+
+Each series lives in its own directory: ts.bin holds int64 timestamps and every
+other column is a float64 .bin file of the same length, with meta.json listing
+the columns. sync() fetches only the rows after the last stored ts, less an
+overlap that absorbs late corrections. If the overlap comes back unchanged the
+new rows are appended in place; otherwise each file is rewritten from the start
+of the overlap into a new file that replaces it, so arrays already mapped from
+the old one (in this kernel or another) keep their pages. load() memory-maps
+the files, so reading a full history costs no copy.
+"""
+import json, os
+import numpy as np
+from barSeries import toSeconds
+
+
+class SeriesStore:
+    """Directory of append-only column files, one subdirectory per series.
+
+    Series are named by tuples of strings, e.g. ('bars', 'bitmex', 'XBTUSD')."""
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok = True)
+
+    def _dir(self, name):
+        return os.path.join(self.directory, *name)
+
+    def _file(self, name, column):
+        return os.path.join(self._dir(name), column + '.bin')
+
+    def columns(self, name):
+        """Returns the column names of the series, or None if it is not stored."""
+        path = os.path.join(self._dir(name), 'meta.json')
+        if not os.path.exists(path):
+            return None
+        with open(path) as f:
+            return json.load(f)['columns']
+
+    def _rows(self, name, columns):
+        #ts.bin is appended last, so a write cut short leaves it as the shortest file
+        return min([os.path.getsize(self._file(name, c)) // 8 for c in ['ts'] + columns])
+
+    def load(self, name):
+        """Returns (ts, {column: values}) as read-only memory-mapped arrays, or None if not stored."""
+        columns = self.columns(name)
+        if columns is None:
+            return None
+        n = self._rows(name, columns)
+        if n == 0:
+            return np.empty(0, np.int64), {c: np.empty(0) for c in columns}
+        ts = np.memmap(self._file(name, 'ts'), np.int64, 'r', shape = (n,))
+        return ts, {c: np.memmap(self._file(name, c), np.float64, 'r', shape = (n,)) for c in columns}
+
+    def sync(self, name, fetchAfter, overlap = 0):
+        """Brings the series up to date. fetchAfter(ts) returns a df, indexed by ts, of the rows after
+        ts (every row if ts is None). Returns the number of rows fetched."""
+        columns = self.columns(name)
+        if columns is None:
+            df = fetchAfter(None)
+            columns = [str(c) for c in df.columns]
+            os.makedirs(self._dir(name), exist_ok = True)
+            for c in ['ts'] + columns:
+                open(self._file(name, c), 'wb').close()
+            with open(os.path.join(self._dir(name), 'meta.json'), 'w') as f:
+                json.dump({'columns': columns}, f)
+            n = keep = 0
+        else:
+            n = self._rows(name, columns)
+            cutoff = None
+            keep = 0
+            if n:
+                stored = self.load(name)
+                cutoff = int(stored[0][-1]) - overlap
+                keep = int(np.searchsorted(stored[0], cutoff, side = 'right'))
+            df = fetchAfter(cutoff)
+            if n and self._unchanged(stored, keep, df, columns):
+                #the overlap came back as stored: append after it and leave mapped pages alone
+                df = df.iloc[n - keep:]
+                keep = n
+        rows = {'ts': toSeconds(df.index)}
+        for c in columns:
+            rows[c] = df[c].values
+        for c in columns + ['ts']:
+            path = self._file(name, c)
+            data = np.ascontiguousarray(rows[c], dtype = np.int64 if c == 'ts' else np.float64).tobytes()
+            if keep < n:
+                #mapped rows change: never truncate a file that may be mapped, replace it
+                with open(path, 'rb') as f:
+                    head = f.read(keep * 8)
+                with open(path + '.tmp', 'wb') as f:
+                    f.write(head)
+                    f.write(data)
+                os.replace(path + '.tmp', path)
+                continue
+            with open(path, 'r+b') as f:
+                #only a write cut short leaves a file longer than the mapped rows
+                if os.path.getsize(path) != keep * 8:
+                    f.truncate(keep * 8)
+                f.seek(keep * 8)
+                f.write(data)
+        return len(df)
+
+    @staticmethod
+    def _unchanged(stored, keep, df, columns):
+        ts, values = stored
+        n = len(ts)
+        if len(df) < n - keep or not np.array_equal(toSeconds(df.index[:n - keep]), ts[keep:]):
+            return False
+        return all([np.array_equal(df[c].values[:n - keep], values[c][keep:]) for c in columns])
@@ -0,0 +1,141 @@
+"""Shared HTTP transport for the exchange clients.
+
+One requests.Session with a connection pool is reused by every call, so
+connections (and their TLS sessions) are kept alive between requests. Idempotent
+requests that time out, fail to connect or get a 5xx response are retried with
+jittered exponential backoff. Clients with a rate limiter retry through
+retrying() instead, so every attempt waits for budget, and signed requests are
+re-signed for each attempt rather than resent by send().
+
+Run this module to benchmark per-request latency of a plain requests.get against
+the pooled transport on a local stand-in server.
+"""
+import random, time
+import requests
+from requests.adapters import HTTPAdapter
+import logging
+
+logger = logging.getLogger(__name__)
+
+RETRY_STATUS = (500, 502, 503, 504)
+IDEMPOTENT = ('GET', 'HEAD', 'OPTIONS', 'DELETE')
+
+
+class Transport:
+    """Pooled keep-alive HTTP transport.
+
+    poolConnections -- number of hosts to keep a pool for.
+    poolMaxsize -- connections kept alive per host; should be at least the number of threads using it.
+    timeout -- per-request timeout in seconds, or a (connect, read) tuple.
+    retries -- retries after the first attempt for idempotent requests.
+    backoff, maxBackoff -- the n-th retry waits a random time up to min(maxBackoff, backoff * 2**n) seconds.
+    """
+    def __init__(self, poolConnections = 10, poolMaxsize = 32, timeout = 10, retries = 3, backoff = 0.5,
+                 maxBackoff = 10):
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.maxBackoff = maxBackoff
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections = poolConnections, pool_maxsize = poolMaxsize)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def retrying(self, method, call, retries = None):
+        """Returns call(), calling it again with backoff while it times out, fails to connect or returns
+        a 5xx, up to retries times (self.retries by default) if method is idempotent. call makes one
+        attempt: e.g. waits for rate limit budget, signs and sends with retries = 0."""
+        if retries is None:
+            retries = self.retries
+        attempts = retries + 1 if method.upper() in IDEMPOTENT else 1
+        for attempt in range(attempts):
+            last = attempt == attempts - 1
+            try:
+                r = call()
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if last:
+                    raise
+                logger.info('%s request failed (%s), retrying', method, e)
+            else:
+                if r.status_code not in RETRY_STATUS or last:
+                    return r
+                logger.info('%s request returned %s, retrying', method, r.status_code)
+            time.sleep(random.uniform(0, min(self.maxBackoff, self.backoff * 2 ** attempt)))
+
+    def request(self, method, url, retries = None, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        return self.retrying(method, lambda: self.session.request(method, url, **kwargs), retries)
+
+    def get(self, url, params = None, **kwargs):
+        return self.request('GET', url, params = params, **kwargs)
+
+    def send(self, prepared, **kwargs):
+        """Sends a requests.PreparedRequest, e.g. a signed request, once. It is not retried: the
+        timestamp and signature of a resent request would be stale, so callers re-sign each attempt
+        under retrying()."""
+        kwargs.setdefault('timeout', self.timeout)
+        return self.session.send(prepared, **kwargs)
+
+
+_transport = None
+
+def getTransport():
+    """Returns the transport shared by the exchange clients."""
+    global _transport
+    if _transport is None:
+        _transport = Transport()
+    return _transport
+
+def configure(**kwargs):
+    """Replaces the shared transport with one built from kwargs (see Transport)."""
+    global _transport
+    _transport = Transport(**kwargs)
+    return _transport
+
+
+def benchmark(n = 200):
+    """Prints per-request latency of requests.get and the pooled transport against a local server."""
+    import socket, threading
+    from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def setup(self):
+            BaseHTTPRequestHandler.setup(self)
+            #headers and body go out in separate writes; don't let Nagle hold the body back
+            self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        def do_GET(self):
+            body = b'[[1499040000000,"0.01634790","0.80000000","0.01575800","0.01577100","148976.11427815"]]'
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target = server.serve_forever, daemon = True).start()
+    url = 'http://127.0.0.1:{}/fapi/v1/klines'.format(server.server_address[1])
+
+    def timeit(get):
+        times = []
+        for _ in range(n):
+            st = time.perf_counter()
+            get(url, params = {'symbol': 'BTCUSDT'}).json()
+            times.append((time.perf_counter() - st) * 1000)
+        times.sort()
+        return sum(times) / n, times[n // 2], times[int(n * 0.99)]
+
+    t = Transport()
+    for name, get in [('requests.get', requests.get), ('Transport.get', t.get)]:
+        mean, p50, p99 = timeit(get)
+        print('{:14} mean {:.3f} ms  p50 {:.3f} ms  p99 {:.3f} ms'.format(name, mean, p50, p99))
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    benchmark()
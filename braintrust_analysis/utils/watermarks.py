@@ -0,0 +1,153 @@
+"""Per-symbol ingestion watermarks.
+
+ingest_watermark holds one row per (exchange, tbl, symbol) with the earliest and
+latest ts stored and the number of rows. WatermarkHook keeps it up to date from
+inside each BulkWriter flush, in the same transaction as the rows, so readers
+get a symbol's date range with a primary key lookup instead of scanning its bars.
+
+Every flush also bumps the symbol's version. revised is the version of the last
+flush that wrote a ts at or before the latest then stored: only such a flush can
+have replaced stored rows, so rows are unchanged up to latest for as long as
+revised stays the same.
+
+Works against MySQL (the table comes from alembic) and SQLite (ensureTable
+creates it).
+"""
+
+def _p(isSqlite):
+    return '?' if isSqlite else '%s'
+
+def ensureTable(conn):
+    """Creates ingest_watermark in a SQLite database if it does not exist, seeding it from every
+    table that has ts and symbol columns. Tables without an exchange column are the per-exchange
+    bar tables, whose name is used as the exchange."""
+    if conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'ingest_watermark'").fetchall():
+        #tables made before the write version
+        cols = [r[1] for r in conn.execute("PRAGMA table_info(ingest_watermark)").fetchall()]
+        for c in ('version', 'revised'):
+            if c not in cols:
+                conn.execute("ALTER TABLE ingest_watermark ADD COLUMN " + c + " INTEGER NOT NULL DEFAULT 0")
+        conn.commit()
+        return
+    conn.execute("""CREATE TABLE ingest_watermark (
+                        exchange TEXT NOT NULL, tbl TEXT NOT NULL, symbol TEXT NOT NULL,
+                        earliest INTEGER NOT NULL, latest INTEGER NOT NULL, row_count INTEGER NOT NULL,
+                        version INTEGER NOT NULL DEFAULT 0, revised INTEGER NOT NULL DEFAULT 0,
+                        PRIMARY KEY (exchange, tbl, symbol))""")
+    tables = [r[0] for r in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'").fetchall()]
+    for tbl in tables:
+        cols = [r[1] for r in conn.execute("PRAGMA table_info(" + tbl + ")").fetchall()]
+        if 'ts' not in cols or 'symbol' not in cols or tbl == 'ingest_watermark':
+            continue
+        exchange = 'exchange' if 'exchange' in cols else "'" + tbl + "'"
+        conn.execute("INSERT INTO ingest_watermark (exchange, tbl, symbol, earliest, latest, row_count) SELECT " +
+                     exchange + ", '" + tbl + "', symbol, MIN(ts), MAX(ts), COUNT(*) FROM " + tbl +
+                     " GROUP BY " + exchange + ", symbol")
+    conn.commit()
+
+def readWatermark(cursor, isSqlite, exchange, tbl, symbol):
+    """Returns (earliest, latest, row_count, version, revised), or None if nothing is stored for the symbol."""
+    p = _p(isSqlite)
+    cursor.execute("SELECT earliest, latest, row_count, version, revised FROM ingest_watermark WHERE exchange = " + p +
+                   " AND tbl = " + p + " AND symbol = " + p, (exchange, tbl, symbol))
+    r = cursor.fetchall()
+    return tuple(r[0]) if r else None
+
+def _upsert(cursor, isSqlite, exchange, tbl, symbol, earliest, latest, rowCount, version = 1):
+    """Adds a write of rowCount rows spanning earliest to latest. version is the symbol's version
+    if it has no row yet; an existing row's version is bumped."""
+    #mysql assigns left to right, so revised is set from the version and latest before this write
+    if isSqlite:
+        sql = """INSERT INTO ingest_watermark (exchange, tbl, symbol, earliest, latest, row_count, version, revised)
+                 VALUES (?,?,?,?,?,?,?,?)
+                 ON CONFLICT (exchange, tbl, symbol) DO UPDATE SET
+                 revised = CASE WHEN excluded.earliest <= latest THEN version + 1 ELSE revised END,
+                 earliest = MIN(earliest, excluded.earliest), latest = MAX(latest, excluded.latest),
+                 row_count = row_count + excluded.row_count, version = version + 1"""
+    else:
+        sql = """INSERT INTO ingest_watermark (exchange, tbl, symbol, earliest, latest, row_count, version, revised)
+                 VALUES (%s,%s,%s,%s,%s,%s,%s,%s)
+                 ON DUPLICATE KEY UPDATE revised = IF(VALUES(earliest) <= latest, version + 1, revised),
+                 earliest = LEAST(earliest, VALUES(earliest)), latest = GREATEST(latest, VALUES(latest)),
+                 row_count = row_count + VALUES(row_count), version = version + 1"""
+    cursor.execute(sql, (exchange, tbl, symbol, earliest, latest, rowCount, version, version))
+
+def recompute(conn, isSqlite, tbl, symbol, exchange, key = None):
+    """Rebuilds the watermark of one symbol from its rows, e.g. after deleting some of them.
+    key maps columns to the values selecting the symbol's rows in tbl; it defaults to its
+    symbol and exchange."""
+    p = _p(isSqlite)
+    if key is None:
+        key = {'symbol': symbol, 'exchange': exchange}
+    cursor = conn.cursor()
+    where = " WHERE " + " AND ".join([c + " = " + p for c in key])
+    cursor.execute("SELECT MIN(ts), MAX(ts), COUNT(*) FROM " + tbl + where, tuple(key.values()))
+    earliest, latest, n = cursor.fetchall()[0]
+    #the rebuilt row carries on from the old version, so readers see the rows as revised
+    old = readWatermark(cursor, isSqlite, exchange, tbl, symbol)
+    version = old[3] + 1 if old else 1
+    cursor.execute("DELETE FROM ingest_watermark WHERE exchange = " + p + " AND tbl = " + p + " AND symbol = " + p,
+                   (exchange, tbl, symbol))
+    if n:
+        _upsert(cursor, isSqlite, exchange, tbl, symbol, earliest, latest, n, version)
+    conn.commit()
+    return (earliest, latest, n, version, version) if n else None
+
+
+class WatermarkHook:
+    """BulkWriter hook that maintains ingest_watermark for the rows it writes.
+
+    columns -- the writer's column order. It must contain 'ts', and either 'instrument_id'
+               (with instruments given), 'symbol' (with exchange given, for the per-exchange
+               SQLite tables) or 'exchange' and 'symbol'.
+    instruments -- instruments.Instruments resolving instrument ids to names.
+    Row counts are exact under upserts: the stored rows in each symbol's ts span are
+    counted before and after the write, which is an index range of about one batch."""
+    def __init__(self, table, columns, exchange = None, instruments = None):
+        self.table = table
+        self.exchange = exchange
+        self.instruments = instruments
+        self.tsIdx = columns.index('ts')
+        if instruments is not None:
+            self.keyColumns = ['instrument_id']
+        elif exchange is not None:
+            self.keyColumns = ['symbol']
+        else:
+            self.keyColumns = ['exchange', 'symbol']
+        self.keyIdx = [columns.index(c) for c in self.keyColumns]
+        self.spans = {}
+        self.before = {}
+
+    def _names(self, key):
+        if self.instruments is not None:
+            return self.instruments.name(key[0])
+        if self.exchange is not None:
+            return self.exchange, key[0]
+        return key
+
+    def _count(self, writer, cursor, key, lo, hi):
+        p = _p(writer.isSqlite)
+        sql = ("SELECT COUNT(*) FROM " + self.table + " WHERE " + " AND ".join([c + " = " + p for c in self.keyColumns]) +
+               " AND ts >= " + p + " AND ts <= " + p)
+        cursor.execute(sql, key + (lo, hi))
+        return cursor.fetchall()[0][0]
+
+    def beforeFlush(self, writer, cursor, rows):
+        spans = {}
+        keyIdx, tsIdx = self.keyIdx, self.tsIdx
+        for r in rows:
+            key = tuple([r[i] for i in keyIdx])
+            ts = r[tsIdx]
+            if key in spans:
+                lo, hi = spans[key]
+                spans[key] = (min(lo, ts), max(hi, ts))
+            else:
+                spans[key] = (ts, ts)
+        self.spans = spans
+        self.before = {k: self._count(writer, cursor, k, lo, hi) for k, (lo, hi) in spans.items()}
+
+    def afterFlush(self, writer, cursor, rows):
+        for key, (lo, hi) in self.spans.items():
+            added = self._count(writer, cursor, key, lo, hi) - self.before[key]
+            exchange, symbol = self._names(key)
+            _upsert(cursor, writer.isSqlite, exchange, self.table, symbol, lo, hi, added)